@@ -11,18 +11,16 @@ Aurélien VALENTIN for the ImHorPhen research team (Angers, France) - July 2023
 
 # IMPORT
 import omero, omero.clients
+from Connection import connect
+from itertools import product
 from omero.gateway import BlitzGateway
-from omero.rtypes import rstring
+from omero.rtypes import rlist, rlong, rstring
+from omero_sys_ParametersI import ParametersI
 from time import time
 
 start_time = time()
 
 
-# CONNECTION
-client = omero.client("localhost")
-session = client.createSession("root", "omero_root_password") 
-
-
 # FUNCTIONS
 def create_project(project_name: str, conn: BlitzGateway) -> int:
     """Create a project.
@@ -63,34 +61,123 @@ def create_dataset(dataset_name: str, project_ID: int, conn: BlitzGateway) -> in
     -------
     dataset_id: int
         The ID of the dataset you have just created.
+    
+    Note
+    ----
+    The new dataset is saved with its link, so there is a single round trip. To create many datasets, or to create only the
+    missing ones, see provision_tree.
     """
     
-    # Creating dataset
     dataset_obj = omero.model.DatasetI()
     dataset_obj.setName(rstring(dataset_name))
-    dataset_obj = conn.getUpdateService().saveAndReturnObject(dataset_obj)
-    dataset_id = dataset_obj.getId().getValue()
-
-    # Linking dataset
-    project = conn.getObject("Project", project_ID)
     link = omero.model.ProjectDatasetLinkI()
-    link.setParent(omero.model.ProjectI(project.getId(), False))
+    link.setParent(omero.model.ProjectI(project_ID, False))
     link.setChild(dataset_obj)
-    conn.getUpdateService().saveObject(link)
+    link = conn.getUpdateService().saveAndReturnObject(link, conn.SERVICE_OPTS)
+    dataset_id = link.getChild().getId().getValue()
 
     return dataset_id
 
+def dataset_names(pattern: str, **values) -> list:
+    """Make the names of one dataset per combination of values, e. g. per year, site and camera.
 
-# FUNCTION CALLS
-with BlitzGateway(host = "localhost", username = "root", passwd = "omero_root_password", secure = True) as conn: # Connection
-    project_id = create_project("Demo_OMERO", conn)
-    create_dataset("2020", project_id, conn)
-    create_dataset("2021", project_id, conn)
-    create_dataset("2022", project_id, conn)
+    Parameters
+    ----------
+    pattern: str
+        The name of the datasets, with a "{field}" for each field, e. g. "{year}_{site}".
+    values: lists
+        The values of each field, e. g. year = ["2020", "2021"], site = ["Angers", "Avrillé"].
+    
+    Returns
+    -------
+    names: list of str
+        The names of the datasets, the last field varying the fastest.
+    """
+
+    fields = list(values.keys())
+    return [pattern.format(**dict(zip(fields, combination))) for combination in product(*values.values())]
+
+def provision_tree(spec: dict, conn: BlitzGateway) -> dict:
+    """Get or create projects and their datasets, so that running it again creates nothing.
 
-client.closeSession() # Disconnection
+    Parameters
+    ----------
+    spec: dict
+        The names of the datasets of each project, by project name. For example: {"Demo_OMERO": ["2020", "2021", "2022"]}
+        or {"Field_trials": dataset_names("{year}_{site}", year = ["2022", "2023"], site = ["Angers", "Avrillé"])}.
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    
+    Returns
+    -------
+    tree: dict
+        The ID of each project and the IDs of its datasets by name, by project name: {project_name: (project_id, {dataset_name: dataset_id})}.
+    
+    Note
+    ----
+    The existing projects of the user and their datasets are found with one query, then the missing projects are created
+    with one saveAndReturnArray call and the missing datasets and their links with another one. The links refer to the
+    saved projects by ID, since a new project shared by several objects of one call would be created once per object.
+    When several projects of the user have the same name, the oldest one is used.
+    """
+
+    # Existing projects and datasets
+    params = ParametersI()
+    params.map = {"names": rlist([rstring(name) for name in spec]), "owner": rlong(conn.getUserId())}
+    results = conn.getQueryService().projection(
+        "select p.id, p.name, d.id, d.name from Project p left outer join p.datasetLinks l left outer join l.child d"
+        " where p.name in (:names) and p.details.owner.id = :owner order by p.id",
+        params,
+        conn.SERVICE_OPTS
+        )
+    tree = {}
+    for r in results:
+        project_id, project_name = r[0].val, r[1].val
+        if project_name not in tree:
+            tree[project_name] = (project_id, {})
+        if tree[project_name][0] == project_id and r[2] is not None and r[3].val not in tree[project_name][1]:
+            tree[project_name][1][r[3].val] = r[2].val
+
+    # Missing projects
+    new_projects = [project_name for project_name in spec if project_name not in tree]
+    if len(new_projects) > 0:
+        new_objects = []
+        for project_name in new_projects:
+            project_obj = omero.model.ProjectI()
+            project_obj.setName(rstring(project_name))
+            new_objects.append(project_obj)
+        saved = conn.getUpdateService().saveAndReturnArray(new_objects, conn.SERVICE_OPTS) # In the same order
+        for obj, project_name in zip(saved, new_projects):
+            tree[project_name] = (obj.getId().getValue(), {})
+
+    # Missing datasets and links
+    new_objects = []
+    new_names = [] # (project name, dataset name) of each new link
+    for project_name, names in spec.items():
+        for name in dict.fromkeys(names):
+            if name in tree[project_name][1]:
+                continue
+            dataset_obj = omero.model.DatasetI()
+            dataset_obj.setName(rstring(name))
+            link = omero.model.ProjectDatasetLinkI()
+            link.setParent(omero.model.ProjectI(tree[project_name][0], False))
+            link.setChild(dataset_obj)
+            new_objects.append(link)
+            new_names.append((project_name, name))
+    if len(new_objects) > 0:
+        saved = conn.getUpdateService().saveAndReturnArray(new_objects, conn.SERVICE_OPTS) # In the same order
+        for obj, (project_name, name) in zip(saved, new_names):
+            tree[project_name][1][name] = obj.getChild().getId().getValue()
+
+    return tree
+
+
+# FUNCTION CALLS
+if __name__ == "__main__":
+    with connect() as conn: # Connection (shared session, closed at exit)
+        provision_tree({"Demo_OMERO": ["2020", "2021", "2022"]}, conn) # Safe to run again, existing objects are reused
 
-print("Program executed in {time} seconds".format(time = time() - start_time))
+    print("Program executed in {time} seconds".format(time = time() - start_time))
 
 
 # LINKS
@@ -10,21 +10,20 @@ Aurélien VALENTIN for the ImHorPhen research team (Angers, France) - July 2023
 
 
 # IMPORT
-import omero, omero.clients, subprocess
+import hashlib, os, sqlite3, subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from Connection import cli_login, connect
 from omero.gateway import BlitzGateway
-from omero.rtypes import rstring
+from omero.rtypes import rlist, rlong, rstring
 from omero_sys_ParametersI import ParametersI
-from os import system, listdir
-from sys import exit
+from os import listdir
+from os.path import realpath
 from time import time
 from tqdm import tqdm
+from yaml import safe_load
 
 start_time = time()
 
-# CONNECTION
-client = omero.client("localhost")
-session = client.createSession("root", "omero_root_password") 
-
 
 # FUNCTIONS
 def import_image(image_path: str, dataset_id: int) -> int:
@@ -47,14 +46,282 @@ def import_image(image_path: str, dataset_id: int) -> int:
     This function uses the CLI (Command Line Interface) since no equivalent with Python was found.
     """
     
-    image_id = int(str(subprocess.check_output("omero import --transfer=ln_s " + image_path + " -d " + dataset_id, shell = True)).split(":")[1].split("\\n")[0])
+    image_id = int(str(subprocess.check_output("omero import --transfer=ln_s " + image_path + " -d " + str(dataset_id), shell = True)).split(":")[1].split("\\n")[0])
     return image_id
 
-def get_ID(name: str, type: str) -> int:
+def open_manifest(manifest_path: str) -> sqlite3.Connection:
+    """Open (or create) the local manifest recording the files already imported.
+
+    Parameters
+    ----------
+    manifest_path: str
+        The path of the SQLite file.
+    
+    Returns
+    -------
+    manifest: sqlite3.Connection
+        The manifest database.
+    """
+
+    manifest = sqlite3.connect(manifest_path)
+    manifest.execute("CREATE TABLE IF NOT EXISTS imports (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, checksum TEXT, image_id INTEGER)")
+    return manifest
+
+def file_signature(image_path: str, checksum: bool = False) -> tuple:
+    """Get what identifies the content of a file without reading it all.
+
+    Parameters
+    ----------
+    image_path: str
+        The path of the file.
+    checksum: bool
+        Add a fast checksum of the first and last MiB of the file to its size and modification time.
+    
+    Returns
+    -------
+    signature: tuple
+        (size, mtime, checksum), checksum being "" if not asked.
+    """
+
+    stat = os.stat(image_path)
+    digest = ""
+    if checksum:
+        h = hashlib.blake2b(digest_size = 16)
+        with open(image_path, "rb") as fpi:
+            h.update(fpi.read(2**20))
+            if stat.st_size > 2**21:
+                fpi.seek(-2**20, os.SEEK_END)
+            h.update(fpi.read(2**20))
+        digest = h.hexdigest()
+    return stat.st_size, stat.st_mtime, digest
+
+def filter_new_files(manifest: sqlite3.Connection, image_paths: list, checksum: bool = False) -> dict:
+    """Keep only the files that are not in the manifest yet, or that changed since they were imported.
+
+    Parameters
+    ----------
+    manifest: sqlite3.Connection
+        The manifest database, see open_manifest.
+    image_paths: list of str
+        The paths of the files.
+    checksum: bool
+        Compare the fast checksums of the files too, see file_signature.
+    
+    Returns
+    -------
+    signatures: dict
+        The signature of each new or changed file, by path.
+    """
+
+    imported = {}
+    for row in manifest.execute("SELECT path, size, mtime, checksum FROM imports"):
+        imported[row[0]] = tuple(row[1:])
+    signatures = {}
+    for image_path in image_paths:
+        signature = file_signature(image_path, checksum)
+        known = imported.get(realpath(image_path))
+        if known is None or known[:2] != signature[:2] or (checksum and known[2] != signature[2]):
+            signatures[image_path] = signature
+    return signatures
+
+def import_batch(image_paths: list, dataset_id: int) -> dict:
+    """Import several images with a single call to the importer, using in-place import.
+
+    Parameters
+    ----------
+    image_paths: list of str
+        The local paths to your images.
+    dataset_id: int
+        The ID of the dataset where your images should be located.
+    
+    Returns
+    -------
+    image_ids: dict
+        The ID of the (first) image of each imported file, by path. Files that failed to import are reported and left out.
+    
+    Note
+    ----
+    The importer goes on after a file that fails ("-c"), so that one corrupt file does not abort the rest of its batch.
+    The IDs are read from the YAML output of the importer, which gives the path of each imported file, and the failures
+    are reported with the last line of the importer log naming the file.
+    """
+
+    output = subprocess.run(["omero", "import", "-c", "--transfer=ln_s", "--output=yaml", "-d", str(dataset_id)] + image_paths, capture_output = True, text = True)
+    paths = {realpath(image_path): image_path for image_path in image_paths}
+    image_ids = {}
+    for fileset in safe_load(output.stdout) or []:
+        if realpath(fileset["path"]) in paths and len(fileset.get("Image", [])) > 0:
+            image_ids[paths[realpath(fileset["path"])]] = fileset["Image"][0]
+    for image_path in image_paths:
+        if image_path not in image_ids:
+            lines = [line.strip() for line in (output.stderr or "").splitlines() if os.path.basename(image_path) in line]
+            print("{path} could not be imported: {reason}".format(path = image_path,
+                  reason = lines[-1] if len(lines) > 0 else "no image in the importer output (exit code {code})".format(code = output.returncode)))
+    return image_ids
+
+def find_imported(conn: BlitzGateway, image_paths: list, dataset_id: int, batch_size: int = 1000) -> dict:
+    """Find the files already imported into a dataset, from the client paths recorded in the filesets of its images.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    image_paths: list of str
+        The local paths to the images.
+    dataset_id: int
+        The ID of the dataset.
+    batch_size: int
+        The maximum number of paths per query.
+    
+    Returns
+    -------
+    image_ids: dict
+        The ID of the (first) image of each file already in the dataset, by path.
+    
+    Note
+    ----
+    This finds the files imported by a run which stopped before recording them in the manifest. The importer records
+    the absolute path of each file without its leading "/", both forms being looked for.
+    """
+
+    client_paths = {}
+    for image_path in image_paths:
+        client_paths[realpath(image_path)] = image_path
+        client_paths[realpath(image_path).lstrip("/")] = image_path
+    names = list(client_paths)
+    image_ids = {}
+    for i in range(0, len(names), batch_size):
+        p = ParametersI()
+        p.add("paths", rlist([rstring(name) for name in names[i:i + batch_size]]))
+        p.add("dataset", rlong(dataset_id))
+        for r in conn.getQueryService().projection(
+                "select fe.clientPath, min(i.id) from Image i join i.fileset fs join fs.usedFiles fe join i.datasetLinks dl"
+                " where dl.parent.id = :dataset and fe.clientPath in (:paths) group by fe.clientPath", p, conn.SERVICE_OPTS):
+            image_ids[client_paths[r[0].val]] = r[1].val
+    return image_ids
+
+def import_images(image_paths: list, dataset_id: int, batch_size: int = 50, workers: int = 4, desc: str = "", manifest = None, checksum: bool = False,
+                  conn: BlitzGateway = None) -> dict:
+    """Import many images using in-place import, with several files per importer call and several importer calls at once.
+
+    Parameters
+    ----------
+    image_paths: list of str
+        The local paths to your images.
+    dataset_id: int
+        The ID of the dataset where your images should be located.
+    batch_size: int
+        The number of files imported by each call to the importer, which pays the JVM and login startup once for all of them.
+    workers: int
+        The maximum number of importers running at the same time.
+    desc: str
+        The description of the progress bar.
+    manifest: sqlite3.Connection
+        Optional manifest (see open_manifest). Files already imported and unchanged are skipped, and each imported file is
+        recorded as soon as its batch is done, so that a run can be resumed after a crash without creating duplicates.
+    checksum: bool
+        Also compare fast checksums to detect changed files, see file_signature.
+    conn: omero.gateway.BlitzGateway object
+        Optional OMERO connection, used with the manifest: the files it does not know but which are already in the dataset
+        (imported by the batches running when a previous run stopped, see find_imported) are recorded instead of being
+        imported again.
+    
+    Returns
+    -------
+    image_ids: dict
+        The ID of the (first) image of each imported file, by path. Files that failed to import are reported (see
+        import_batch) and left out, and skipped files are not included.
+    
+    Note
+    ----
+    To keep importing the new files of a folder as they arrive, see Watch_import.py.
+    """
+
+    if manifest is not None:
+        signatures = filter_new_files(manifest, image_paths, checksum)
+        image_paths = [image_path for image_path in image_paths if image_path in signatures]
+        if conn is not None: # Changed files are imported again, only the unknown ones are looked for
+            unknown = [image_path for image_path in image_paths
+                       if manifest.execute("SELECT 1 FROM imports WHERE path = ?", (realpath(image_path),)).fetchone() is None]
+            found = find_imported(conn, unknown, dataset_id)
+            with manifest:
+                manifest.executemany("INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?, ?)",
+                                     [(realpath(image_path), *signatures[image_path], image_id) for image_path, image_id in found.items()])
+            image_paths = [image_path for image_path in image_paths if image_path not in found]
+
+    batches = [image_paths[i:i + batch_size] for i in range(0, len(image_paths), batch_size)]
+    image_ids = {}
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = [executor.submit(import_batch, batch, dataset_id) for batch in batches]
+        for future in tqdm(as_completed(futures), total = len(batches), desc = desc): # Recorded in the order they finish
+            results = future.result()
+            image_ids.update(results)
+            if manifest is not None:
+                with manifest:
+                    manifest.executemany("INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?, ?)",
+                                         [(realpath(image_path), *signatures[image_path], image_id) for image_path, image_id in results.items()])
+    return image_ids
+
+def get_IDs(conn: BlitzGateway, names: list, type: str, batch_size: int = 1000) -> dict:
+    """Get the IDs of objects based on their names, with one query per batch of names.
+    
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    names: list of str
+        The names of the objects.
+    type: str
+        The type of the objects, e. g. Image, Dataset or Project.
+    batch_size: int
+        The maximum number of names per query.
+    
+    Returns
+    -------
+    object_ids: dict
+        The ID of each name found only once. These IDs are cached on the connection, so such a name is only queried once
+        per session, while missing or ambiguous names are queried again in case they are fixed meanwhile.
+    
+    Note
+    ----
+    Be careful with the use of this function since in OMERO you can use the same name for different objects. Names which
+    are missing or used by several objects are reported and left out of the result.
+    """
+
+    if not hasattr(conn, "id_cache"):
+        conn.id_cache = {} # (type, name): ID, for the session of this connection
+    cache = conn.id_cache
+    q = conn.getQueryService()
+    query_string = ("select i.id, i.name from " + type + " i where i.name in (:names)")
+    missing = [name for name in dict.fromkeys(names) if (type, name) not in cache]
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i + batch_size]
+        p = ParametersI()
+        p.add("names", rlist([rstring(name) for name in batch]))
+        found = {}
+        for r in q.projection(query_string, p):
+            found.setdefault(r[1].val, []).append(r[0].val)
+        for name in batch:
+            if name not in found:
+                print("There is no {type} with the name {name}".format(type = type, name = name))
+            elif len(found[name]) != 1:
+                print("There are more than one {type} with the same name {name}. You should use IDs which are unique.".format(type = type, name = name))
+            else:
+                cache[(type, name)] = found[name][0]
+
+    object_ids = {}
+    for name in names:
+        if (type, name) in cache:
+            object_ids[name] = cache[(type, name)]
+    return object_ids
+
+def get_ID(conn: BlitzGateway, name: str, type: str) -> int:
     """Get the ID of an object based on its name.
     
     Parameters
     ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
     name: str
         The name of the object.
     type: int
@@ -63,42 +330,28 @@ def get_ID(name: str, type: str) -> int:
     Returns
     -------
     object_id: int
-        The ID researched of the object.
+        The ID researched of the object, or None if there is no single object with this name.
     
     Note
     ----
-    Be careful with the use of this function since in OMERO you can use the same name for different objects. This function
-    is coded to detect that but it is not necessary in the example shown.
+    See get_IDs to get several IDs at once.
     """
     
-    q = session.getQueryService()
-    query_string = ("select i from " + type + " i where name = :namedParameter")
-    p = ParametersI()
-    p.add("namedParameter", rstring(name))
-    results = q.findAllByQuery(query_string, p)
-
-    if len(results) == 0:
-        print("There is no {type} with the name {name}".format(type = type, name = name))
-        exit()
-    elif len(results) != 1:
-        print("There are more than one {type} with the same name {name}. You should use IDs which are unique.".format(type = type, name = name))
-        exit()
-    else:
-        object_id = str(results[0].id).split("= ")[-1].split("\n")[0]
-        return(object_id)
+    return get_IDs(conn, [name], type).get(name)
 
 
 # FUNCTION CALLs
-with BlitzGateway("root", "omero_root_password", host = "localhost", secure = True) as conn: # Connection
-    system("omero login -s localhost -u root -w omero_root_password")
-    path = "/home/stagiaire-imhorphen/Documents/Demo_omero/sample/" # Path to the three example folders
-    for year in ["2020", "2021", "2022"]: # Looking in all directories
-        for image in tqdm(listdir(path + year), desc = year): # Looking for all images
-            import_image(path + "/" + year + "/" + image, get_ID(year, "Dataset"))  
-
-client.closeSession() # Disconnection
+if __name__ == "__main__":
+    with connect() as conn: # Connection (shared session, closed at exit)
+        cli_login(conn) # The CLI joins the session instead of logging in again
+        path = "/home/stagiaire-imhorphen/Documents/Demo_omero/sample/" # Path to the three example folders
+        manifest = open_manifest(path + "imports.sqlite") # Files already imported, so that a re-run only imports new or changed files
+        dataset_ids = get_IDs(conn, ["2020", "2021", "2022"], "Dataset") # One query for all datasets
+        for year in dataset_ids: # Looking in all directories
+            import_images([path + year + "/" + image for image in listdir(path + year)], dataset_ids[year], desc = year, manifest = manifest, conn = conn) # Importing all images by batches
+        manifest.close()
 
-print("Program executed in {time} seconds".format(time = time() - start_time))
+    print("Program executed in {time} seconds".format(time = time() - start_time))
 
 
 # LINKS
@@ -10,21 +10,17 @@ Aurélien VALENTIN for the ImHorPhen research team (Angers, France) - July 2023
 
 
 # IMPORT
-import omero, omero.clients
+import omero, omero.clients, omero.grid
+from Connection import connect
 from omero.gateway import BlitzGateway
-from omero.rtypes import rstring
+from omero.rtypes import rlist, rlong, rstring
 from omero_sys_ParametersI import ParametersI
-from time import time
+from time import sleep, time
 from tqdm import tqdm
 
 start_time = time()
 
 
-# CONNECTION
-client = omero.client("localhost")
-session = client.createSession("root", "omero_root_password") 
-
-
 # FUNCTIONS
 def add_key_value_pair(key_value: list, type: str, id: int):
     """Add annotation based on Key:Value pairs such as Year:2020 to a given object.
@@ -47,11 +43,232 @@ def add_key_value_pair(key_value: list, type: str, id: int):
     object.linkAnnotation(map_ann)
     return
 
-def get_ID(name: str, type: str) -> int:
+def find_annotated(conn: BlitzGateway, annotations: list, type: str = "Image") -> set:
+    """Find the objects which already have a client map annotation with exactly the given Key:Value pairs.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    annotations: list of tuples
+        The Key:Value pairs of each object as (key_value, id), see add_key_value_pairs.
+    type: str
+        The type of the objects, e. g. Image, Dataset or Project.
+    
+    Returns
+    -------
+    ids: set of ints
+        The IDs of the objects already annotated with their Key:Value pairs.
+    """
+
+    p = ParametersI()
+    p.add("ns", rstring(omero.constants.metadata.NSCLIENTMAPANNOTATION))
+    p.add("ids", rlist([rlong(id) for key_value, id in annotations]))
+    pairs = {} # (object ID, annotation ID): list of (Key, Value)
+    for r in conn.getQueryService().projection(
+            "select l.parent.id, ann.id, nv.name, nv.value from " + type + "AnnotationLink l join l.child ann join ann.mapValue as nv"
+            " where ann.ns = :ns and l.parent.id in (:ids)", p, conn.SERVICE_OPTS):
+        pairs.setdefault((r[0].val, r[1].val), []).append((r[2].val, r[3].val))
+    existing = set((id, tuple(sorted(values))) for (id, ann), values in pairs.items())
+    return set(id for key_value, id in annotations if (id, tuple(sorted((str(key), str(value)) for key, value in key_value))) in existing)
+
+def add_key_value_pairs(conn: BlitzGateway, annotations: list, type: str = "Image", chunk_size: int = 500, retries: int = 3) -> tuple:
+    """Add Key:Value pair annotations to many objects at once, saving the annotations and their links in chunks.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    annotations: list of tuples
+        The Key:Value pairs to add to each object as (key_value, id), where key_value is a list of [Key, Value] as in
+        add_key_value_pair and id the ID of the object.
+    type: str
+        The type of the objects, e. g. Image, Dataset or Project.
+    chunk_size: int
+        The number of annotations saved per call to the server.
+    retries: int
+        The number of times a failed chunk is tried again before giving up. A failed call may have been committed before
+        the error (e. g. a timeout), so the objects already annotated (see find_annotated) are left out of the next tries.
+    
+    Returns
+    -------
+    saved: int
+        The number of objects annotated.
+    failed_ids: list of ints
+        The IDs of the objects of the chunks that could not be saved.
+    """
+
+    update_service = conn.getUpdateService()
+    saved = 0
+    failed_ids = []
+    for i in tqdm(range(0, len(annotations), chunk_size), desc = "Saving annotations"):
+        chunk = annotations[i:i + chunk_size]
+
+        # Building the annotations and their links in memory
+        links = []
+        for key_value, id in chunk:
+            map_ann = omero.model.MapAnnotationI()
+            map_ann.setNs(rstring(omero.constants.metadata.NSCLIENTMAPANNOTATION))
+            map_ann.setMapValue([omero.model.NamedValue(str(key), str(value)) for key, value in key_value])
+            link = getattr(omero.model, type + "AnnotationLinkI")()
+            link.setParent(getattr(omero.model, type + "I")(id, False))
+            link.setChild(map_ann)
+            links.append(link)
+
+        # Saving the chunk, the annotations being created with their links
+        pending = list(zip(chunk, links))
+        for attempt in range(retries + 1):
+            try:
+                if attempt > 0:
+                    done = find_annotated(conn, [annotation for annotation, link in pending], type)
+                    saved += sum(1 for annotation, link in pending if annotation[1] in done)
+                    pending = [(annotation, link) for annotation, link in pending if annotation[1] not in done]
+                if len(pending) > 0:
+                    update_service.saveArray([link for annotation, link in pending], conn.SERVICE_OPTS)
+                saved += len(pending)
+                break
+            except Exception as e:
+                if attempt == retries:
+                    print("Failed to save the annotations of {n} {type}(s): {error}".format(n = len(pending), type = type, error = e))
+                    failed_ids += [annotation[1] for annotation, link in pending]
+                else:
+                    sleep(2 ** attempt)
+
+    if len(failed_ids) > 0:
+        print("{saved} {type}(s) annotated, {failed} failed.".format(saved = saved, type = type, failed = len(failed_ids)))
+    return saved, failed_ids
+
+def add_metadata_table(conn: BlitzGateway, csv_paths: dict, type: str, id: int, table_name: str = "Metadata", chunk_size: int = 10000, string_size: int = 64) -> int:
+    """Stream the metadata .csv files into a single OMERO.table attached to a dataset or a project, instead of one MapAnnotation per image.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    csv_paths: dict
+        The path of the .csv file of each year, by year. Each file has two header lines, then "image, disease, lighting" rows.
+    type: str
+        The type of the object the table is attached to, i. e. Dataset or Project.
+    id: int
+        The ID of the object.
+    table_name: str
+        The name of the table file.
+    chunk_size: int
+        The number of rows read from the .csv files and written to the table at once.
+    string_size: int
+        The maximum length of the Year, Disease and Lighting values.
+    
+    Returns
+    -------
+    table_id: int
+        The ID of the original file of the table.
+    """
+
+    resources = conn.c.sf.sharedResources()
+    repository_id = resources.repositories().descriptions[0].getId().getValue()
+    table = resources.newTable(repository_id, table_name, conn.SERVICE_OPTS)
+    try:
+        columns = [omero.grid.ImageColumn("Image", "", []),
+                   omero.grid.StringColumn("Year", "", string_size, []),
+                   omero.grid.StringColumn("Disease", "", string_size, []),
+                   omero.grid.StringColumn("Lighting", "", string_size, [])]
+        table.initialize(columns)
+
+        def add_rows(year: str, rows: list):
+            image_ids = get_IDs(conn, [image for image, disease, lighting in rows], "Image")
+            rows = [row for row in rows if row[0] in image_ids]
+            columns[0].values = [image_ids[image] for image, disease, lighting in rows]
+            columns[1].values = [year] * len(rows)
+            columns[2].values = [disease for image, disease, lighting in rows]
+            columns[3].values = [lighting for image, disease, lighting in rows]
+            table.addData(columns)
+
+        for year, csv_path in csv_paths.items():
+            with open(csv_path) as fpi:
+                fpi.readline()
+                fpi.readline()
+                rows = []
+                for line in tqdm(fpi, desc = year):
+                    if line.strip() != "":
+                        rows.append(line.strip().split(", "))
+                    if len(rows) == chunk_size:
+                        add_rows(year, rows)
+                        rows = []
+                if len(rows) > 0:
+                    add_rows(year, rows)
+
+        # Attaching the table to the object
+        file_ann = omero.model.FileAnnotationI()
+        file_ann.setNs(rstring(omero.constants.namespaces.NSBULKANNOTATIONS))
+        file_ann.setFile(omero.model.OriginalFileI(table.getOriginalFile().getId().getValue(), False))
+        link = getattr(omero.model, type + "AnnotationLinkI")()
+        link.setParent(getattr(omero.model, type + "I")(id, False))
+        link.setChild(file_ann)
+        conn.getUpdateService().saveObject(link, conn.SERVICE_OPTS)
+        return table.getOriginalFile().getId().getValue()
+    finally:
+        table.close()
+
+def get_IDs(conn: BlitzGateway, names: list, type: str, batch_size: int = 1000) -> dict:
+    """Get the IDs of objects based on their names, with one query per batch of names.
+    
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    names: list of str
+        The names of the objects.
+    type: str
+        The type of the objects, e. g. Image, Dataset or Project.
+    batch_size: int
+        The maximum number of names per query.
+    
+    Returns
+    -------
+    object_ids: dict
+        The ID of each name found only once. These IDs are cached on the connection, so such a name is only queried once
+        per session, while missing or ambiguous names are queried again in case they are fixed meanwhile.
+    
+    Note
+    ----
+    Be careful with the use of this function since in OMERO you can use the same name for different objects. Names which
+    are missing or used by several objects are reported and left out of the result.
+    """
+
+    if not hasattr(conn, "id_cache"):
+        conn.id_cache = {} # (type, name): ID, for the session of this connection
+    cache = conn.id_cache
+    q = conn.getQueryService()
+    query_string = ("select i.id, i.name from " + type + " i where i.name in (:names)")
+    missing = [name for name in dict.fromkeys(names) if (type, name) not in cache]
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i + batch_size]
+        p = ParametersI()
+        p.add("names", rlist([rstring(name) for name in batch]))
+        found = {}
+        for r in q.projection(query_string, p):
+            found.setdefault(r[1].val, []).append(r[0].val)
+        for name in batch:
+            if name not in found:
+                print("There is no {type} with the name {name}".format(type = type, name = name))
+            elif len(found[name]) != 1:
+                print("There are more than one {type} with the same name {name}. You should use IDs which are unique.".format(type = type, name = name))
+            else:
+                cache[(type, name)] = found[name][0]
+
+    object_ids = {}
+    for name in names:
+        if (type, name) in cache:
+            object_ids[name] = cache[(type, name)]
+    return object_ids
+
+def get_ID(conn: BlitzGateway, name: str, type: str) -> int:
     """Get the ID of an object based on its name.
     
     Parameters
     ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
     name: str
         The name of the object.
     type: int
@@ -60,46 +277,35 @@ def get_ID(name: str, type: str) -> int:
     Returns
     -------
     object_id: int
-        The ID researched of the object.
+        The ID researched of the object, or None if there is no single object with this name.
     
     Note
     ----
-    Be careful with the use of this function since in OMERO you can use the same name for different objects. This function
-    detect that but it is not necessary in the example shown.
+    See get_IDs to get several IDs at once.
     """
     
-    q = session.getQueryService()
-    query_string = ("select i from " + type + " i where name = :namedParameter")
-    p = ParametersI()
-    p.add("namedParameter", rstring(name))
-    results = q.findAllByQuery(query_string, p)
-
-    if len(results) == 0:
-        print("There is no {type} with the name {name}".format(type = type, name = name))
-        exit()
-    elif len(results) != 1:
-        print("There are more than one {type} with the same name {name}. You should use IDs which are unique.".format(type = type, name = name))
-        exit()
-    else:
-        object_id = str(results[0].id).split("= ")[-1].split("\n")[0]
-        return(object_id)
+    return get_IDs(conn, [name], type).get(name)
 
 
 # FUNCTIONS CALL
-with BlitzGateway("root", "omero_root_password", host = "localhost", secure = True) as conn: # Connection
-    path = "/home/stagiaire-imhorphen/Documents/Demo_omero/sample/" # Path to the three examples
-    for year in ["2020", "2021", "2022"]:
-        with open(path + year + ".csv") as fpi:
-            fpi.readline()
-            fpi.readline()
-            for line in tqdm(fpi.readlines(), desc = year):
-                image, disease, lighting = line.strip().split(", ")
-                add_key_value_pair([["Year", year], ["Disease", disease], ["Lighting", lighting]], "Image", get_ID(image, "Image"))
-    # NB : This import may be used only one time for one image. Reapply it will change the MapAnnotation link and could disturb some codes.
-            
-client.closeSession() # Disconnection
-
-print("Program executed in {time} seconds".format(time = time() - start_time))
+if __name__ == "__main__":
+    with connect() as conn: # Connection (shared session, closed at exit)
+        path = "/home/stagiaire-imhorphen/Documents/Demo_omero/sample/" # Path to the three examples
+        table_mode = False # True to store the metadata in one OMERO.table on the project, better suited to large studies
+        if table_mode:
+            add_metadata_table(conn, {year: path + year + ".csv" for year in ["2020", "2021", "2022"]}, "Project", get_ID(conn, "Demo_OMERO", "Project"))
+        else:
+            for year in ["2020", "2021", "2022"]:
+                with open(path + year + ".csv") as fpi:
+                    fpi.readline()
+                    fpi.readline()
+                    rows = [line.strip().split(", ") for line in fpi if line.strip() != ""]
+                    image_ids = get_IDs(conn, [image for image, disease, lighting in rows], "Image") # One query per batch of names
+                    annotations = [([["Year", year], ["Disease", disease], ["Lighting", lighting]], image_ids[image]) for image, disease, lighting in rows if image in image_ids]
+                    add_key_value_pairs(conn, annotations, "Image") # Bulk writing, instead of calling add_key_value_pair for each image
+        # NB : This import may be used only one time for one image. Reapply it will change the MapAnnotation link and could disturb some codes.
+
+    print("Program executed in {time} seconds".format(time = time() - start_time))
 
 
 # LINKS
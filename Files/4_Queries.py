@@ -10,89 +10,447 @@ Aurélien VALENTIN for the ImHorPhen research team (Angers, France) - July 2023
 
 
 # IMPORT
-import omero, omero.clients
+import omero, omero.clients, pickle
+import numpy as np
+from functools import reduce
+from Connection import connect
 from omero.gateway import BlitzGateway
-from omero.rtypes import rstring
-from omero.sys import Parameters
+from omero.rtypes import rint, rlist, rlong, rstring
+from omero.sys import Filter, Parameters
+from os.path import exists
 from time import time
 
 start_time = time()
 
 
-# CONNECTION
-client = omero.client("localhost")
-session = client.createSession("root", "omero_root_password") 
+# FUNCTIONS
+def compile_scope(type: str, id, params) -> str:
+    """Compile the scope of a query on images "i" into an HQL condition.
+
+    Parameters
+    ----------
+    type: str
+        The type of the object, e. g. Image, Dataset or Project. An empty string means every image.
+    id: int or list of ints
+        The ID(s) of the object(s).
+    params: omero.sys.Parameters
+        The parameters of the query, to which the "ids" parameter is added.
+    
+    Returns
+    -------
+    condition: str
+        The HQL condition, or an empty string when there is no scope.
+    """
 
+    if type == "":
+        return ""
+    ids = id if isinstance(id, (list, tuple)) else [id]
+    params.map["ids"] = rlist([rlong(i) for i in ids])
+    if type == "Image":
+        return "i.id in (:ids)"
+    elif type == "Dataset":
+        return "i.id in (SELECT dil.child.id FROM DatasetImageLink dil WHERE dil.parent.id in (:ids))"
+    elif type == "Project":
+        return ("i.id in (SELECT dil.child.id FROM DatasetImageLink dil, ProjectDatasetLink pdl"
+                " WHERE dil.parent.id = pdl.child.id AND pdl.parent.id in (:ids))")
+    raise ValueError("Unknown object type {type}, expected Image, Dataset or Project".format(type = type))
 
-# FUNCTIONS
-def filter_by_kv(conn: BlitzGateway, key_value_list: list, type = "", id = 0) -> list:
-    """Filter a given set of images (from dataset or project) with given key:value pair(s).
+def expand_to_image_ids(conn: BlitzGateway, type: str, id, page_size: int = 10000):
+    """Resolve images, datasets or projects to the IDs of their images, page by page.
 
     Parameters
     ----------
     conn: omero.gateway.BlitzGateway object
         OMERO connection.
-    key_value: list of list(s) of two str
-        The Key:Value pair(s) to add as a list of [Key, Value]. For example: [["Year", "2020"], ["Species", "Arabidopsis thaliana"]].
     type: str
-        The type of the object, e. g. Image, Dataset or Project.
-    id: int
-        The ID of the object.
+        The type of the object(s), e. g. Image, Dataset or Project. An empty string means every image.
+    id: int or list of ints
+        The ID(s) of the object(s).
+    page_size: int
+        The maximum number of image IDs per page.
     
-    Returns
-    -------
+    Yields
+    ------
     img_ids: list of ints
-        The result IDs from the query.
+        The next page of image IDs, sorted and without duplicates.
     
     Note
     ----
-    type and id arguments are optional but if you add one you need to add the other.
+    Each page is one projection over the link tables, starting after the last ID of the previous page (rather than at an
+    offset), so every page costs the same and only one page is in memory at a time.
     """
 
-    # Picking all image IDs
-    img_ids = []
-    if type == "":
-        for img in conn.getObjects("Image"):
-            img_ids.append(img.id)
-    elif type == "Image":
-        img_ids.append(id)
-    elif type == "Dataset":
-        for img in conn.getObject("Dataset", id).listChildren():
-            img_ids.append(img.id)
-    elif type == "Project":
-        for dataset in conn.getObject("Project", id).listChildren():
-            print(dataset)
-            for img in conn.getObject("Dataset", id).listChildren():
-                img_ids.append(img.id)
-    
-    # Processing the query/queries.
     q = conn.getQueryService()
+    last_id = -1
+    while True:
+        params = Parameters()
+        params.map = {"last": rlong(last_id)}
+        params.theFilter = Filter()
+        params.theFilter.limit = rint(page_size)
+        scope = compile_scope(type, id, params)
+        results = q.projection(
+            "SELECT i.id FROM Image i WHERE " + (scope + " AND " if scope != "" else "") + "i.id > :last ORDER BY i.id",
+            params,
+            conn.SERVICE_OPTS
+            )
+        img_ids = [r[0].val for r in results]
+        if len(img_ids) > 0:
+            yield img_ids
+        if len(img_ids) < page_size:
+            return
+        last_id = img_ids[-1]
+
+def compile_kv_query(key_value_list: list, type = "", id = 0) -> tuple:
+    """Compile Key:Value conditions and an optional scope into a single HQL query.
+
+    Parameters
+    ----------
+    key_value_list: list of conditions
+        The conditions that all images must match. A condition is either a [Key, Value] pair, where a Value ending with "*"
+        matches all the values starting with it, or a list starting with an operator: ["NOT", condition],
+        ["AND", condition, ...] or ["OR", condition, ...].
+        For example: [["Year", "2020"], ["OR", ["Disease", "Big"], ["Disease", "Med*"]], ["NOT", ["Lighting", "Low"]]].
+    type: str
+        The type of the object, e. g. Image, Dataset or Project.
+    id: int or list of ints
+        The ID(s) of the object(s).
+    
+    Returns
+    -------
+    query: str
+        The HQL query, returning image IDs.
+    params: omero.sys.Parameters
+        The parameters of the query.
+    """
+
     params = Parameters()
-    for key, value in key_value_list:
-        params.map = {"key": rstring(key),
-                    "value": rstring(value)}
+    params.map = {}
+
+    def compile_condition(condition) -> str:
+        if condition[0] in ("AND", "OR", "NOT") and all(isinstance(c, (list, tuple)) for c in condition[1:]):
+            clauses = [compile_condition(c) for c in condition[1:]]
+            if condition[0] == "NOT":
+                return "NOT (" + " AND ".join(clauses) + ")"
+            return "(" + (" " + condition[0] + " ").join(clauses) + ")"
+        key, value = condition
+        n = len(params.map) // 2
+        params.map["k{n}".format(n = n)] = rstring(key)
+        if value.endswith("*"): # The rest of the value is literal, its wildcards being escaped
+            prefix = value[:-1].replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.map["v{n}".format(n = n)] = rstring(prefix + "%")
+            operator = "like"
+        else:
+            params.map["v{n}".format(n = n)] = rstring(value)
+            operator = "="
+        return ("exists (SELECT al.id FROM ImageAnnotationLink al"
+                " JOIN al.child ann"
+                " JOIN ann.mapValue as nv"
+                " WHERE al.parent.id = i.id"
+                " AND nv.name = :k{n}"
+                " AND nv.value {operator} :v{n}{escape})").format(n = n, operator = operator, escape = " escape '\\'" if operator == "like" else "")
+
+    clauses = [compile_condition(condition) for condition in key_value_list]
+
+    scope = compile_scope(type, id, params)
+    if scope != "":
+        clauses.append(scope)
+
+    query = "SELECT i.id FROM Image i"
+    if len(clauses) > 0:
+        query += " WHERE " + " AND ".join(clauses)
+    return query, params
+
+class KVIndex:
+    """Local inverted index of the map annotations of a scope, mapping each (Key, Value) pair to the sorted array of its image IDs.
+
+    The index is built with one bulk projection over the scope, then refreshed incrementally with the annotations and links
+    updated since the last refresh (i.e. with an event ID higher than the high-water mark) and with the links of the images
+    new to the scope. Deletions make no event, so each refresh also compares the image and link IDs of the scope with the
+    server (two projections of IDs only) and drops the ones that are gone.
+
+    Parameters
+    ----------
+    type: str
+        The type of the object, e. g. Image, Dataset or Project. An empty string means every image.
+    id: int or list of ints
+        The ID(s) of the object(s).
+    path: str
+        Optional file where the index is saved, and loaded from if it exists.
+    """
+
+    def __init__(self, type = "", id = 0, path = ""):
+        self.type = type
+        self.id = id
+        self.path = path
+        self.clear()
+        if path != "" and exists(path):
+            self.load()
+
+    def clear(self):
+        """Empty the index."""
+
+        self.event_id = -1
+        self.links = {} # Annotation link ID: list of (image ID, key, value)
+        self.pairs = {} # (key, value): set of annotation link IDs
+        self.postings = {} # (key, value): sorted numpy array of image IDs
+        self.image_ids = np.empty(0, dtype = np.int64)
+
+    def refresh(self, conn: BlitzGateway, full: bool = False) -> int:
+        """Update the index with the changes made on the server since the last refresh.
+
+        Parameters
+        ----------
+        conn: omero.gateway.BlitzGateway object
+            OMERO connection.
+        full: bool
+            Rebuild the whole index instead of an incremental update.
+        
+        Returns
+        -------
+        changes: int
+            The number of new, updated or removed annotation links.
+        """
+
+        if full:
+            self.clear()
+        q = conn.getQueryService()
+        event_id = q.projection("SELECT max(e.id) FROM Event e", None, conn.SERVICE_OPTS)[0][0].val # Taken first so that no change is missed
+
+        # Images of the scope: all their IDs, since images linked to the scope (or unlinked, deleted) keep their events
+        params = Parameters()
+        params.map = {"event": rlong(self.event_id)}
+        scope = compile_scope(self.type, self.id, params)
+        results = q.projection("SELECT i.id FROM Image i" + (" WHERE " + scope if scope != "" else ""), params, conn.SERVICE_OPTS)
+        image_ids = np.unique(np.array([r[0].val for r in results], dtype = np.int64))
+        new_images = np.setdiff1d(image_ids, self.image_ids, assume_unique = True) if self.event_id >= 0 else np.empty(0, dtype = np.int64)
+        self.image_ids = image_ids
+
+        # Links of the scope: the ones missing from the server were deleted, or their image left the scope
+        results = q.projection("SELECT al.id FROM Image i JOIN i.annotationLinks al" + (" WHERE " + scope if scope != "" else ""), params, conn.SERVICE_OPTS)
+        link_ids = set(r[0].val for r in results)
+        removed = [link_id for link_id in self.links if link_id not in link_ids]
+
+        # New or updated annotations and links, and all the links of the images new to the scope
+        condition = "(ann.details.updateEvent.id > :event OR al.details.updateEvent.id > :event"
+        if len(new_images) > 0:
+            params.map["images"] = rlist([rlong(int(image_id)) for image_id in new_images])
+            condition += " OR i.id in (:images)"
         results = q.projection(
-            "SELECT i.id FROM Image i"
+            "SELECT i.id, al.id, nv.name, nv.value FROM Image i"
             " JOIN i.annotationLinks al"
             " JOIN al.child ann"
             " JOIN ann.mapValue as nv"
-            " WHERE nv.name = :key"
-            " AND nv.value = :value",
+            " WHERE " + (scope + " AND " if scope != "" else "") + condition + ")",
             params,
             conn.SERVICE_OPTS
             )
-        img_id_matches = [r[0].val for r in results]
-        img_ids = list(set(img_ids) & set(img_id_matches))
+        rows = {}
+        for r in results:
+            rows.setdefault(r[1].val, []).append((r[0].val, r[2].val, r[3].val))
+        changed_pairs = set()
+        for link_id in list(rows) + removed:
+            for image_id, key, value in self.links.pop(link_id, []):
+                self.pairs[(key, value)].discard(link_id)
+                changed_pairs.add((key, value))
+        for link_id, link_rows in rows.items():
+            self.links[link_id] = link_rows
+            for image_id, key, value in link_rows:
+                self.pairs.setdefault((key, value), set()).add(link_id)
+                changed_pairs.add((key, value))
+
+        # Postings of the changed pairs
+        for pair in changed_pairs:
+            ids = [image_id for link_id in self.pairs[pair] for image_id, key, value in self.links[link_id] if (key, value) == pair]
+            if len(ids) == 0:
+                del self.pairs[pair]
+                self.postings.pop(pair, None)
+            else:
+                self.postings[pair] = np.unique(np.array(ids, dtype = np.int64))
+
+        self.event_id = event_id
+        return len(rows) + len(removed)
+
+    def lookup(self, key_value_list: list) -> np.ndarray:
+        """Get the images matching Key:Value conditions from the index only.
+
+        Parameters
+        ----------
+        key_value_list: list of conditions
+            The conditions that all images must match, in the format of compile_kv_query.
+        
+        Returns
+        -------
+        img_ids: numpy array of int64
+            The sorted IDs of the matching images.
+        """
+
+        empty = np.empty(0, dtype = np.int64)
+
+        def evaluate(condition) -> np.ndarray:
+            if condition[0] in ("AND", "OR", "NOT") and all(isinstance(c, (list, tuple)) for c in condition[1:]):
+                results = [evaluate(c) for c in condition[1:]]
+                if condition[0] == "OR":
+                    return reduce(np.union1d, results, empty)
+                matches = reduce(lambda a, b: np.intersect1d(a, b, assume_unique = True), results, self.image_ids)
+                if condition[0] == "NOT":
+                    return np.setdiff1d(self.image_ids, matches, assume_unique = True)
+                return matches
+            key, value = condition
+            if value.endswith("*"):
+                return reduce(np.union1d, [ids for (k, v), ids in self.postings.items() if k == key and v.startswith(value[:-1])], empty)
+            return self.postings.get((key, value), empty)
+
+        return evaluate(["AND"] + list(key_value_list))
+
+    def save(self):
+        """Save the index to its file, with its scope."""
+
+        index = {name: value for name, value in self.__dict__.items() if name not in ("type", "id", "path")}
+        with open(self.path, "wb") as fpo:
+            pickle.dump({"scope": (self.type, self.id), "index": index}, fpo, protocol = pickle.HIGHEST_PROTOCOL)
+
+    def load(self):
+        """Load the index from its file, or start from an empty index if the file was saved for another scope."""
+
+        with open(self.path, "rb") as fpi:
+            data = pickle.load(fpi)
+        if isinstance(data, dict) and data.get("scope") == (self.type, self.id):
+            self.__dict__.update(data["index"])
+        else:
+            self.clear()
+
+def compile_table_condition(key_value_list: list) -> str:
+    """Compile Key:Value conditions into the where-clause of an OMERO.table, whose columns are the keys.
+
+    Parameters
+    ----------
+    key_value_list: list of conditions
+        The conditions that all rows must match, in the format of compile_kv_query (prefix matching excepted).
+    
+    Returns
+    -------
+    condition: str
+        The condition, in the PyTables syntax used by the tables service.
+    """
+
+    def compile_condition(condition) -> str:
+        if condition[0] in ("AND", "OR", "NOT") and all(isinstance(c, (list, tuple)) for c in condition[1:]):
+            clauses = [compile_condition(c) for c in condition[1:]]
+            if condition[0] == "NOT":
+                return "~(" + " & ".join(clauses) + ")"
+            return "(" + (" & " if condition[0] == "AND" else " | ").join(clauses) + ")"
+        key, value = condition
+        if value.endswith("*"):
+            raise ValueError("Prefix matching is not supported on tables: {key}={value}".format(key = key, value = value))
+        return "({key}=={value})".format(key = key, value = repr(value.encode())) # String columns hold bytes
+
+    return " & ".join(compile_condition(condition) for condition in key_value_list)
+
+def filter_by_table(conn: BlitzGateway, key_value_list: list, type: str, id: int) -> list:
+    """Filter images with the OMERO.table attached to a dataset or a project (see 3_Metadata_import.add_metadata_table).
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    key_value_list: list of conditions
+        The conditions that all images must match, in the format of compile_kv_query (prefix matching excepted).
+    type: str
+        The type of the object the table is attached to, i. e. Dataset or Project.
+    id: int
+        The ID of the object.
+    
+    Returns
+    -------
+    img_ids: list of ints
+        The result IDs from the query.
+    """
+
+    # Latest table of the object
+    params = Parameters()
+    params.map = {"id": rlong(id), "ns": rstring(omero.constants.namespaces.NSBULKANNOTATIONS)}
+    results = conn.getQueryService().projection(
+        "SELECT ann.file.id FROM " + type + "AnnotationLink al"
+        " JOIN al.child ann"
+        " WHERE al.parent.id = :id"
+        " AND ann.ns = :ns"
+        " ORDER BY ann.id DESC",
+        params,
+        conn.SERVICE_OPTS
+        )
+    if len(results) == 0:
+        raise ValueError("There is no table on the {type} {id}".format(type = type, id = id))
+
+    table = conn.c.sf.sharedResources().openTable(omero.model.OriginalFileI(results[0][0].val, False), conn.SERVICE_OPTS)
+    try:
+        image_column = [column.name for column in table.getHeaders()].index("Image")
+        n_rows = table.getNumberOfRows()
+        condition = compile_table_condition(key_value_list)
+        if condition == "":
+            data = table.read([image_column], 0, n_rows)
+            return list(data.columns[0].values)
+        rows = table.getWhereList(condition, {}, 0, n_rows, 1)
+        if len(rows) == 0:
+            return []
+        data = table.readCoordinates(rows)
+        return list(data.columns[image_column].values)
+    finally:
+        table.close()
+
+def filter_by_kv(conn: BlitzGateway, key_value_list: list, type = "", id = 0, index = None, use_table: bool = False) -> list:
+    """Filter a given set of images (from dataset or project) with given key:value pair(s).
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    key_value: list of list(s) of two str
+        The Key:Value pair(s) to add as a list of [Key, Value]. For example: [["Year", "2020"], ["Species", "Arabidopsis thaliana"]].
+        AND/OR/NOT and prefix conditions are also accepted, see compile_kv_query.
+    type: str
+        The type of the object, e. g. Image, Dataset or Project.
+    id: int or list of ints
+        The ID(s) of the object(s).
+    index: KVIndex
+        Optional local index to answer from, without any query. Its own scope is used instead of type and id.
+    use_table: bool
+        Answer from the OMERO.table attached to the object given by type and id, instead of the map annotations.
+    
+    Returns
+    -------
+    img_ids: list of ints
+        The result IDs from the query.
+    
+    Note
+    ----
+    type and id arguments are optional but if you add one you need to add the other.
+    The whole filter is sent as one query, so there is a single round trip whatever the number of pairs.
+    """
+
+    if index is not None:
+        return index.lookup(key_value_list).tolist()
+    if use_table:
+        return filter_by_table(conn, key_value_list, type, id)
+    query, params = compile_kv_query(key_value_list, type, id)
+    results = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+    img_ids = [r[0].val for r in results]
     return img_ids
 
 
 # FUNCTION CALL
-with BlitzGateway("root", "omero_root_password", host = "localhost", secure = True) as conn: # Connection
-    result = filter_by_kv(conn, [["Disease", "Big"], ["Lighting", "Medium"]], "Dataset", 49)
-    print(result)
-client.closeSession() # Disconnection
+if __name__ == "__main__":
+    with connect() as conn: # Connection (shared session, closed at exit)
+        result = filter_by_kv(conn, [["Disease", "Big"], ["Lighting", "Medium"]], "Dataset", 49)
+        print(result)
+
+        # Same query from a local index, which is worth it when many queries are made on the same scope
+        index = KVIndex("Dataset", 49, "kv_index.pkl")
+        index.refresh(conn)
+        index.save()
+        result = filter_by_kv(conn, [["Disease", "Big"], ["Lighting", "Medium"]], index = index)
+        print(result)
 
-print("Program executed in {time} seconds".format(time = time() - start_time))
+    print("Program executed in {time} seconds".format(time = time() - start_time))
 
 
 # LINKS
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the walkthrough functions
+
+This script runs project creation, image import, metadata import, K:V queries and thresholding against the in-memory
+server of Fake_gateway.py, at several numbers of images, and reports for each step the wall-clock time, the number of
+round trips (RPCs), the bytes moved and the network time modelled from the latency and the bandwidth. No OMERO server is
+needed, so it can run in CI to catch regressions.
+
+Usage:
+    python Benchmark.py --scales 10 1000 100000 --latency 0.002 --bandwidth 50e6 --json benchmark.json
+"""
+
+
+# IMPORT
+import argparse, importlib, json, os
+os.environ.setdefault("TQDM_DISABLE", "1") # Before the scripts import tqdm
+from Fake_gateway import FakeGateway, FakeImporter, FakeServer
+from time import perf_counter
+
+
+# FUNCTIONS
+def measure(server: FakeServer, results: list, scale: int, step: str, function, *args, **kwargs):
+    """Run one step and record its statistics.
+
+    Parameters
+    ----------
+    server: FakeServer
+        The in-memory server, whose statistics are reset before the step.
+    results: list of dicts
+        The list where the statistics of the step are appended.
+    scale: int
+        The number of images of the run.
+    step: str
+        The name of the step.
+    function: callable
+        The step, called with the following arguments.
+
+    Returns
+    -------
+    result:
+        The result of the function.
+    """
+
+    server.reset_stats()
+    start = perf_counter()
+    result = function(*args, **kwargs)
+    wall = perf_counter() - start
+    stats = server.reset_stats()
+    results.append({
+        "scale": scale,
+        "step": step,
+        "wall_seconds": round(wall, 4),
+        "rpcs": sum(s["calls"] for s in stats.values()),
+        "bytes": sum(s["bytes"] for s in stats.values()),
+        "network_seconds": round(sum(s["seconds"] for s in stats.values()), 4),
+        "operations": stats
+        })
+    return result
+
+def run(scale: int, args) -> list:
+    """Run every step for a number of images.
+
+    Parameters
+    ----------
+    scale: int
+        The number of images.
+    args: argparse.Namespace
+        The options of the benchmark.
+
+    Returns
+    -------
+    results: list of dicts
+        The statistics of each step, see measure.
+    """
+
+    server = FakeServer(args.latency, args.bandwidth, args.plane_size, args.import_startup, args.wait)
+    conn = FakeGateway(server)
+    scripts = {name: importlib.import_module(name) for name in ["1_Create_project_and_datasets", "2_Image_import", "3_Metadata_import", "4_Queries", "Threshold_script"]}
+    scripts["2_Image_import"].subprocess = FakeImporter(server)
+    results = []
+    years = ["2020", "2021", "2022"]
+
+    # Project and datasets
+    def create_tree():
+        return scripts["1_Create_project_and_datasets"].provision_tree({"Benchmark": years}, conn)["Benchmark"]
+    project_id, dataset_ids = measure(server, results, scale, "create", create_tree)
+    if measure(server, results, scale, "create_again", create_tree) != (project_id, dataset_ids):
+        raise RuntimeError("Provisioning the same tree again did not give the same project and datasets")
+
+    # Import
+    names = {year: ["{year}_{i:06d}.jpg".format(year = year, i = i) for i in range(scale // len(years) + (k < scale % len(years)))] for k, year in enumerate(years)}
+    def import_all():
+        for year in years:
+            scripts["2_Image_import"].import_images([os.path.join(args.path, name) for name in names[year]], dataset_ids[year], args.batch_size, args.workers)
+    measure(server, results, scale, "import", import_all)
+
+    # Metadata
+    def import_metadata():
+        annotations = []
+        for year in years:
+            image_ids = scripts["3_Metadata_import"].get_IDs(conn, names[year], "Image")
+            for i, name in enumerate(names[year]):
+                annotations.append(([["Year", year], ["Disease", ["Small", "Medium", "Big"][i % 3]], ["Lighting", ["Low", "Medium"][i % 2]]], image_ids[name]))
+        scripts["3_Metadata_import"].add_key_value_pairs(conn, annotations, "Image")
+    measure(server, results, scale, "metadata", import_metadata)
+
+    # K:V queries
+    filters = [[["Disease", "Big"]], [["Disease", "Big"], ["Lighting", "Medium"]], [["OR", ["Year", "2020"], ["Year", "2022"]]],
+               [["Disease", "Med*"]], [["Disease", "M_d*"]], [["Lighting", "%ow*"]]] # Literal "_" and "%" in the prefixes: nothing matches
+    def query():
+        return [len(scripts["4_Queries"].filter_by_kv(conn, key_value_list, "Project", project_id)) for key_value_list in filters]
+    counts = measure(server, results, scale, "query", query)
+    def query_index():
+        index = scripts["4_Queries"].KVIndex("Project", project_id)
+        index.refresh(conn)
+        return [len(scripts["4_Queries"].filter_by_kv(conn, key_value_list, index = index)) for key_value_list in filters]
+    if measure(server, results, scale, "query_index", query_index) != counts:
+        raise RuntimeError("The K:V index and the queries do not give the same images")
+
+    # Thresholding
+    image_ids = scripts["4_Queries"].filter_by_kv(conn, [["Year", "2020"]], "Project", project_id)[:args.threshold_images]
+    def threshold():
+        parent_dataset = conn.getObject("Dataset", dataset_ids["2020"])
+        for image_id in image_ids:
+            scripts["Threshold_script"].process_image(conn, image_id, "Threshold_{id}".format(id = image_id), parent_dataset, [(0, 128), (64, 192), (128, 255)])
+    measure(server, results, scale, "threshold", threshold)
+    return results
+
+
+# FUNCTION CALL
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Offline benchmark of the walkthrough functions against an in-memory OMERO server.")
+    parser.add_argument("--scales", type = int, nargs = "+", default = [10, 100, 1000], help = "numbers of images, e. g. 10 1000 100000")
+    parser.add_argument("--latency", type = float, default = 0.001, help = "seconds per RPC")
+    parser.add_argument("--bandwidth", type = float, default = 100e6, help = "bytes per second")
+    parser.add_argument("--plane-size", type = int, default = 64, help = "width and height of the imported RGB images")
+    parser.add_argument("--import-startup", type = float, default = 2.0, help = "seconds per call to the importer")
+    parser.add_argument("--batch-size", type = int, default = 50, help = "files per call to the importer")
+    parser.add_argument("--workers", type = int, default = 4, help = "importers running at the same time")
+    parser.add_argument("--threshold-images", type = int, default = 100, help = "maximum number of images thresholded")
+    parser.add_argument("--path", default = "Dataset", help = "folder of the (fake) imported files")
+    parser.add_argument("--wait", action = "store_true", help = "really wait for the modelled network time")
+    parser.add_argument("--json", default = "", help = "file where the results are saved")
+    args = parser.parse_args()
+
+    results = []
+    print("{:>7} {:<12} {:>10} {:>8} {:>12} {:>11}".format("images", "step", "wall (s)", "RPCs", "bytes", "network (s)"))
+    for scale in args.scales:
+        for r in run(scale, args):
+            print("{scale:>7} {step:<12} {wall_seconds:>10.3f} {rpcs:>8} {bytes:>12} {network_seconds:>11.3f}".format(**r))
+            results.append(r)
+    if args.json != "":
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent = 1)
+
+
+# LINKS
+# The OMERO API whose calls are counted: https://omero.readthedocs.io/en/stable/developers/Python.html
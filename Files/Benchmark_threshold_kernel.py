@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the RGB threshold kernel of Threshold_script.py
+
+This script compares the original two-fetch planeGen with the path the script runs (read_image, then the fused threshold_mask
+in threshold_image) on synthetic arrays, without any OMERO server. It reports the time, the peak memory and the bytes read
+from the (fake) pixels service for each image size.
+
+Usage: python Benchmark_threshold_kernel.py [repeats]
+"""
+
+
+# IMPORT
+import numpy as np
+import tracemalloc
+from sys import argv
+from time import perf_counter
+from Threshold_script import BUFFERS, read_image, threshold_image
+
+
+# SYNTHETIC IMAGE
+class SyntheticImage:
+    """Stand-in for omero.gateway._ImageWrapper exposing its sizes and getPrimaryPixels().getPlanes() on random RGB planes."""
+
+    def __init__(self, size_x: int, size_y: int, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.planes = [rng.integers(0, 256, (size_y, size_x), dtype = np.uint8) for c in range(3)]
+        self.bytes_read = 0
+
+    def getSizeZ(self) -> int:
+        return 1
+
+    def getSizeC(self) -> int:
+        return 3
+
+    def getSizeT(self) -> int:
+        return 1
+
+    def getChannelLabels(self) -> list:
+        return ["Red", "Green", "Blue"]
+
+    def getPrimaryPixels(self):
+        return self
+
+    def getPlanes(self, zctList: list):
+        for z, c, t in zctList:
+            self.bytes_read += self.planes[c].nbytes
+            yield self.planes[c].copy() # As with OMERO, each fetch creates a new array
+
+
+# FUNCTIONS
+def legacy_planeGen(image, thr_values: list, zctList: list):
+    """The original planeGen of Threshold_script.py, kept as the benchmark baseline."""
+
+    planes = image.getPrimaryPixels().getPlanes(zctList)
+    i = 0
+    for p in planes:
+        range = np.logical_and(thr_values[i][0] < p[:,:], p[:,:] < thr_values[i][1])
+        if i == 0: red_range = range
+        elif i == 1: green_range = range
+        else: blue_range = range
+        i += 1
+    valid_range = np.logical_and(red_range, green_range, blue_range)
+
+    planes = image.getPrimaryPixels().getPlanes(zctList)
+    for p in planes:
+        p[valid_range] = 255
+        p[np.logical_not(valid_range)] = 0
+        yield p
+
+def legacy(image, thr_values: list):
+    """Threshold an image with legacy_planeGen."""
+
+    for p in legacy_planeGen(image, thr_values, [(0, c, 0) for c in range(3)]):
+        pass
+
+def fused(image, thr_values: list):
+    """Threshold an image as the script does, the mask being given back to the buffer pool as the writers do."""
+
+    state = threshold_image(read_image(image, False), thr_values)
+    BUFFERS.give(state["mask"])
+
+def run(process, size: int, repeats: int) -> tuple:
+    """Time a thresholding function on a size x size synthetic image.
+
+    Returns
+    -------
+    (best time in seconds, peak memory in bytes, bytes read per run)
+    """
+
+    thr_values = [(103, 255), (115, 255), (60, 255)]
+    best = float("inf")
+    for r in range(repeats):
+        image = SyntheticImage(size, size)
+        start = perf_counter()
+        process(image, thr_values)
+        best = min(best, perf_counter() - start)
+
+    image = SyntheticImage(size, size)
+    BUFFERS.free.clear() # The buffers of the mask count in the peak
+    tracemalloc.start()
+    process(image, thr_values)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, image.bytes_read
+
+
+# BENCHMARK
+if __name__ == "__main__":
+    repeats = int(argv[1]) if len(argv) > 1 else 5
+    print("{:>6} | {:>22} | {:>22} | {:>22}".format("size", "time (ms) legacy/fused", "peak (MB) legacy/fused", "read (MB) legacy/fused"))
+    for size in [512, 2048, 8192]:
+        old = run(legacy, size, repeats)
+        new = run(fused, size, repeats)
+        print("{:>6} | {:>10.1f} / {:<9.1f} | {:>10.1f} / {:<9.1f} | {:>10.1f} / {:<9.1f}".format(
+            size, old[0] * 1e3, new[0] * 1e3, old[1] / 2**20, new[1] / 2**20, old[2] / 2**20, new[2] / 2**20))
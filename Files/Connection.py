@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Shared OMERO connection for the walkthrough scripts
+
+The scripts get their sessions from here instead of opening their own client at import time. The sessions are pooled,
+kept alive and closed at exit, and the CLI joins one of them by its key instead of logging in again.
+
+Usage:
+    from Connection import connect
+    with connect() as conn:
+        ...
+
+The server and the credentials can be changed with the OMERO_HOST, OMERO_PORT, OMERO_USER and OMERO_PASSWORD environment
+variables. Setting OMERO_METRICS to a file name traces the calls made through these sessions and saves the metrics to
+this file at exit (see Metrics.py).
+"""
+
+
+# IMPORT
+import atexit, omero, omero.clients, subprocess
+from contextlib import contextmanager
+from Metrics import Metrics
+from omero.gateway import BlitzGateway
+from os import environ
+from queue import Empty, LifoQueue
+from threading import Lock
+
+
+# SETTINGS
+HOST = environ.get("OMERO_HOST", "localhost")
+PORT = int(environ.get("OMERO_PORT", "4064"))
+USERNAME = environ.get("OMERO_USER", "root")
+PASSWORD = environ.get("OMERO_PASSWORD", "omero_root_password")
+KEEPALIVE = 60 # Seconds between two keepalive pings of an idle session
+METRICS = environ.get("OMERO_METRICS", "") # File where the metrics of the OMERO calls are saved at exit (.json or .prom), none if empty
+
+
+# SESSION POOL
+class SessionPool:
+    """Thread-safe pool of reusable OMERO sessions.
+
+    Parameters
+    ----------
+    host: str
+        The OMERO server.
+    port: int
+        The port of the server.
+    username: str
+        The user name.
+    password: str
+        The password.
+    size: int
+        The maximum number of sessions open at the same time. When they are all checked out, callers wait for one.
+    keepalive: int
+        The number of seconds between two keepalive pings of each session.
+    """
+
+    def __init__(self, host: str = HOST, port: int = PORT, username: str = USERNAME, password: str = PASSWORD, size: int = 4, keepalive: int = KEEPALIVE):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.keepalive = keepalive
+        self.idle = LifoQueue() # The most recently used session is the most likely to be alive
+        self.connections = []
+        self.lock = Lock()
+
+    def new_connection(self) -> BlitzGateway:
+        """Open a new session.
+
+        Returns
+        -------
+        conn: omero.gateway.BlitzGateway object
+            OMERO connection.
+        """
+
+        client = omero.client(self.host, self.port)
+        client.createSession(self.username, self.password)
+        client.enableKeepAlive(self.keepalive)
+        return metrics.instrument(BlitzGateway(client_obj = client))
+
+    def checkout(self) -> BlitzGateway:
+        """Take a session from the pool, opening a new one if none is idle and the pool is not full.
+
+        Returns
+        -------
+        conn: omero.gateway.BlitzGateway object
+            OMERO connection, to give back with checkin.
+        """
+
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except Empty:
+                with self.lock:
+                    if len(self.connections) < self.size:
+                        conn = self.new_connection()
+                        self.connections.append(conn)
+                        return conn
+                conn = self.idle.get()
+            if conn.keepAlive():
+                return conn
+            # Expired session: replacing it
+            with self.lock:
+                self.connections.remove(conn)
+
+    def checkin(self, conn: BlitzGateway):
+        """Give a session back to the pool.
+
+        Parameters
+        ----------
+        conn: omero.gateway.BlitzGateway object
+            OMERO connection from checkout.
+        """
+
+        self.idle.put(conn)
+
+    @contextmanager
+    def connect(self):
+        """Context manager version of checkout/checkin."""
+
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def close(self):
+        """Close all the sessions of the pool."""
+
+        with self.lock:
+            for conn in self.connections:
+                try:
+                    conn.c.closeSession()
+                except Exception:
+                    pass
+            self.connections = []
+            self.idle = LifoQueue()
+
+
+# SHARED POOL
+metrics = Metrics(enabled = METRICS != "")
+pool = SessionPool()
+atexit.register(pool.close)
+if metrics.enabled:
+    atexit.register(metrics.save, METRICS)
+
+def connect():
+    """Get a session of the shared pool, to use as "with connect() as conn:"."""
+
+    return pool.connect()
+
+def cli_login(conn: BlitzGateway):
+    """Make the CLI (e.g. "omero import") use an existing session by joining it with its key, instead of logging in again.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection whose session is joined.
+    """
+
+    subprocess.run(["omero", "login", "-s", pool.host, "-p", str(pool.port), "-k", conn.c.getSessionId()], check = True)
+
+
+# LINKS
+# Sessions and keepalive: https://omero.readthedocs.io/en/stable/developers/Python.html#connecting-to-omero
+# Joining a session from the CLI: https://omero.readthedocs.io/en/stable/users/cli/sessions.html
@@ -0,0 +1,673 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In-memory stand-in for an OMERO server and its BlitzGateway
+
+This module lets the walkthrough functions run without any server in order to measure them (see Benchmark.py). It holds
+projects, datasets, images, map annotations and pixel planes in memory, answers the HQL queries written by the
+walkthrough functions and counts the round trips (RPCs) and bytes of each operation. A latency and a bandwidth model the
+network time of each RPC, either added to the report only or really waited.
+
+It needs omero-py (omero.model and omero.rtypes are used as they are) but no server.
+"""
+
+
+# IMPORT
+import numpy as np
+import omero, omero.clients, re, subprocess, yaml
+from omero.gateway import ServiceOptsDict
+from omero.rtypes import rlong, rstring, unwrap
+from os.path import basename, realpath
+from threading import RLock
+from types import SimpleNamespace
+from time import sleep
+
+
+# SERVER
+class FakeServer:
+    """In-memory OMERO server.
+
+    Parameters
+    ----------
+    latency: float
+        Seconds added to each RPC.
+    bandwidth: float
+        Bytes per second, used to add the transfer time of each RPC.
+    plane_size: int
+        Width and height of the (random RGB) images created by the imports.
+    import_startup: float
+        Seconds added to each call to the importer (JVM start and login).
+    wait: bool
+        Really wait for the modelled network time instead of only reporting it.
+    """
+
+    def __init__(self, latency: float = 0.001, bandwidth: float = 100e6, plane_size: int = 64, import_startup: float = 2.0, wait: bool = False):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.plane_size = plane_size
+        self.import_startup = import_startup
+        self.wait = wait
+        self.lock = RLock()
+        self.last_id = 0
+        self.event = 0
+        self.objects = {"Project": {}, "Dataset": {}, "Image": {}} # Type: {ID: name}
+        self.image_sizes = {} # Image ID: (sizeX, sizeY, sizeZ, sizeC, sizeT)
+        self.image_events = {} # Image ID: creation event
+        self.project_datasets = {} # Project ID: set of dataset IDs
+        self.dataset_images = {} # Dataset ID: set of image IDs
+        self.annotations = {} # Annotation ID: {"pairs": [(key, value)], "ns": str, "event": int}
+        self.links = {} # Image annotation link ID: (image ID, annotation ID, event)
+        self.image_links = {} # Image ID: list of image annotation link IDs
+        self.other_links = [] # (type, parent ID, annotation ID) of the annotation links of the other objects
+        self.client_paths = {} # Image ID: path of its imported file, without the leading "/"
+        self.channel_names = {} # Image ID: list of channel names
+        self.logical_channels = {} # Logical channel ID: (image ID, channel index)
+        self.rois = {} # ROI ID: (image ID, list of the bytes of its mask shapes)
+        self.stats = {}
+
+    # Statistics
+    def rpc(self, operation: str, nbytes: int = 0, calls: int = 1, seconds: float = 0.0):
+        """Record round trip(s) to the server.
+
+        Parameters
+        ----------
+        operation: str
+            The name of the operation, e. g. "query.projection".
+        nbytes: int
+            The bytes sent and received.
+        calls: int
+            The number of round trips.
+        seconds: float
+            Extra server-side time.
+        """
+
+        seconds += calls * self.latency + nbytes / self.bandwidth
+        with self.lock:
+            stats = self.stats.setdefault(operation, {"calls": 0, "bytes": 0, "seconds": 0.0})
+            stats["calls"] += calls
+            stats["bytes"] += nbytes
+            stats["seconds"] += seconds
+        if self.wait:
+            sleep(seconds)
+
+    def reset_stats(self) -> dict:
+        """Empty the statistics and return them."""
+
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    # Objects
+    def new_id(self) -> int:
+        with self.lock:
+            self.last_id += 1
+            return self.last_id
+
+    def new_event(self) -> int:
+        with self.lock:
+            self.event += 1
+            return self.event
+
+    def add_image(self, name: str, dataset_id: int = None, sizes: tuple = None) -> int:
+        """Create an image, with random RGB planes of plane_size pixels by default."""
+
+        with self.lock:
+            image_id = self.new_id()
+            self.objects["Image"][image_id] = name
+            self.image_sizes[image_id] = sizes or (self.plane_size, self.plane_size, 1, 3, 1)
+            self.image_events[image_id] = self.new_event()
+            self.image_links[image_id] = []
+            if dataset_id is not None:
+                self.dataset_images.setdefault(dataset_id, set()).add(image_id)
+        return image_id
+
+    def plane(self, image_id: int, z: int, c: int, t: int) -> np.ndarray:
+        """The pixels of a plane, generated again at each read to keep the memory low."""
+
+        sizeX, sizeY = self.image_sizes[image_id][:2]
+        return np.random.default_rng((image_id, z, c, t)).integers(0, 256, (sizeY, sizeX), dtype = np.uint8)
+
+    def reference(self, obj) -> int:
+        """The ID of a model object, saving it first if it is new."""
+
+        if obj.getId() is None:
+            self.save(obj)
+        return obj.getId().getValue()
+
+    def save(self, obj):
+        """Save an omero.model object (without counting any RPC) and return it with its ID."""
+
+        kind = type(obj).__name__[:-1] # E.g. "ProjectI" -> "Project"
+        with self.lock:
+            event = self.new_event()
+            if kind in self.objects:
+                if obj.getId() is None:
+                    obj.setId(rlong(self.new_id()))
+                    if kind == "Image":
+                        self.image_sizes[obj.getId().getValue()] = (0, 0, 0, 0, 0)
+                        self.image_events[obj.getId().getValue()] = event
+                        self.image_links[obj.getId().getValue()] = []
+                if obj.isLoaded() and obj.getName() is not None:
+                    self.objects[kind][obj.getId().getValue()] = obj.getName().getValue()
+            elif kind == "LogicalChannel":
+                image_id, c = self.logical_channels[obj.getId().getValue()]
+                self.channel_names[image_id][c] = unwrap(obj.getName())
+            elif kind == "Roi":
+                obj.setId(rlong(self.new_id()))
+                self.rois[obj.getId().getValue()] = (self.reference(obj.getImage()), [shape.getBytes() for shape in obj.copyShapes()])
+            elif kind.endswith("Annotation"):
+                if obj.getId() is None:
+                    obj.setId(rlong(self.new_id()))
+                pairs = [(nv.name, nv.value) for nv in obj.getMapValue()] if kind == "MapAnnotation" else []
+                self.annotations[obj.getId().getValue()] = {"pairs": pairs, "ns": unwrap(obj.getNs()), "event": event}
+            elif kind.endswith("Link"):
+                parent_id = self.reference(obj.getParent())
+                child_id = self.reference(obj.getChild())
+                obj.setId(rlong(self.new_id()))
+                if kind == "ProjectDatasetLink":
+                    self.project_datasets.setdefault(parent_id, set()).add(child_id)
+                elif kind == "DatasetImageLink":
+                    self.dataset_images.setdefault(parent_id, set()).add(child_id)
+                elif kind == "ImageAnnotationLink":
+                    self.links[obj.getId().getValue()] = (parent_id, child_id, event)
+                    self.image_links.setdefault(parent_id, []).append(obj.getId().getValue())
+                else:
+                    self.other_links.append((kind[:-len("AnnotationLink")], parent_id, child_id))
+            else:
+                raise NotImplementedError("The fake server cannot save {kind} objects".format(kind = kind))
+        return obj
+
+    # Scopes
+    def project_images(self, ids) -> set:
+        return set(i for p in ids for d in self.project_datasets.get(p, ()) for i in self.dataset_images.get(d, ()))
+
+    def datasets_images(self, ids) -> set:
+        return set(i for d in ids for i in self.dataset_images.get(d, ()))
+
+    def has_pair(self, image_id: int, key: str, value: str, operator: str) -> bool:
+        for link_id in self.image_links.get(image_id, ()):
+            for k, v in self.annotations[self.links[link_id][1]]["pairs"]:
+                if k == key and (v == value if operator == "=" else like(v, value)):
+                    return True
+        return False
+
+
+# QUERY SERVICE
+def like(value: str, pattern: str) -> bool:
+    """The HQL like operator, "\\" escaping the next character of the pattern."""
+
+    regex = ""
+    escaped = False
+    for c in pattern:
+        if escaped:
+            regex += re.escape(c)
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        else:
+            regex += {"%": ".*", "_": "."}.get(c, re.escape(c))
+    return re.fullmatch(regex, value, re.DOTALL) is not None
+
+# HQL written by the walkthrough functions (see compile_kv_query and compile_scope in 4_Queries.py), translated to Python
+HQL_TRANSLATIONS = [
+    (r"exists \(SELECT al\.id FROM ImageAnnotationLink al JOIN al\.child ann JOIN ann\.mapValue as nv WHERE al\.parent\.id = i\.id"
+     r" AND nv\.name = :(\w+) AND nv\.value (=|like) :(\w+)(?: escape '\\')?\)", r"server.has_pair(i, p['\1'], p['\3'], '\2')"),
+    (r"i\.id in \(SELECT dil\.child\.id FROM DatasetImageLink dil, ProjectDatasetLink pdl WHERE dil\.parent\.id = pdl\.child\.id"
+     r" AND pdl\.parent\.id in \(:(\w+)\)\)", r"(i in scope('Project', '\1'))"),
+    (r"i\.id in \(SELECT dil\.child\.id FROM DatasetImageLink dil WHERE dil\.parent\.id in \(:(\w+)\)\)", r"(i in scope('Dataset', '\1'))"),
+    (r"i\.id in \(:(\w+)\)", r"(i in p['\1'])"),
+    (r"i\.id > :(\w+)", r"(i > p['\1'])"),
+    (r"i\.details\.creationEvent\.id > :(\w+)", r"(server.image_events[i] > p['\1'])"),
+    (r"ann\.details\.updateEvent\.id > :(\w+)", r"(server.annotations[server.links[link][1]]['event'] > p['\1'])"),
+    (r"al\.details\.updateEvent\.id > :(\w+)", r"(server.links[link][2] > p['\1'])"),
+    (r"ann\.ns = :(\w+)", r"(server.annotations[server.links[link][1]]['ns'] == p['\1'])"),
+    (r"\bAND\b", "and"),
+    (r"\bOR\b", "or"),
+    (r"\bNOT\b", "not"),
+]
+
+class FakeQueryService:
+    """Stand-in for the query service, answering the queries of the walkthrough functions."""
+
+    def __init__(self, server: FakeServer):
+        self.server = server
+
+    def projection(self, query: str, params, ctx = None) -> list:
+        p = {}
+        if params is not None and params.map is not None:
+            for name, value in params.map.items():
+                value = unwrap(value)
+                p[name] = set(value) if isinstance(value, list) else value
+        limit = None
+        if params is not None and getattr(params, "theFilter", None) is not None and params.theFilter.limit is not None:
+            limit = unwrap(params.theFilter.limit)
+
+        rows = self.answer(query, p, limit)
+        nbytes = len(query) + sum(len(str(v)) for v in p.values()) + sum(8 if isinstance(v, int) else len(str(v or "")) for row in rows for v in row)
+        self.server.rpc("query.projection", nbytes)
+        return [[None if v is None else rlong(v) if isinstance(v, int) else rstring(v) for v in row] for row in rows]
+
+    def findByQuery(self, query: str, params, ctx = None):
+        self.server.rpc("query.findByQuery", len(query))
+        match = re.fullmatch(r"from PixelsType as p where p\.value='(\w+)'", query)
+        if match:
+            return omero.model.PixelsTypeI(["uint8", "uint16", "float"].index(match.group(1)) + 1, False)
+        raise NotImplementedError("The fake query service cannot answer: " + query)
+
+    def findAllByQuery(self, query: str, params, ctx = None) -> list:
+        self.server.rpc("query.findAllByQuery", len(query))
+        if query == "SELECT a FROM MapAnnotation a WHERE a.id in (:ids)":
+            annotations = []
+            for id in sorted(unwrap(params.map["ids"])):
+                if id in self.server.annotations:
+                    map_ann = omero.model.MapAnnotationI(id, True)
+                    map_ann.setNs(rstring(self.server.annotations[id]["ns"]))
+                    map_ann.setMapValue([omero.model.NamedValue(k, v) for k, v in self.server.annotations[id]["pairs"]])
+                    annotations.append(map_ann)
+            return annotations
+        raise NotImplementedError("The fake query service cannot answer: " + query)
+
+    def answer(self, query: str, p: dict, limit: int) -> list:
+        server = self.server
+        with server.lock:
+            match = re.fullmatch(r"select i\.id, i\.name from (\w+) i where i\.name in \(:names\)", query)
+            if match:
+                return [[id, name] for id, name in server.objects[match.group(1)].items() if name in p["names"]]
+            if query == "SELECT max(e.id) FROM Event e":
+                return [[server.event]]
+            if query == ("select p.id, p.name, d.id, d.name from Project p left outer join p.datasetLinks l left outer join l.child d"
+                         " where p.name in (:names) and p.details.owner.id = :owner order by p.id"): # A single owner
+                rows = []
+                for id, name in sorted(server.objects["Project"].items()):
+                    if name in p["names"]:
+                        datasets = sorted(server.project_datasets.get(id, ()))
+                        rows += [[id, name, d, server.objects["Dataset"][d]] for d in datasets] or [[id, name, None, None]]
+                return rows
+            if query == ("select fe.clientPath, min(i.id) from Image i join i.fileset fs join fs.usedFiles fe join i.datasetLinks dl"
+                         " where dl.parent.id = :dataset and fe.clientPath in (:paths) group by fe.clientPath"):
+                rows = {}
+                for i in sorted(server.dataset_images.get(p["dataset"], ())):
+                    if server.client_paths.get(i) in p["paths"]:
+                        rows.setdefault(server.client_paths[i], i)
+                return [[path, i] for path, i in rows.items()]
+            if query == ("select l.parent.id, ann.id, nv.name, nv.value from ImageAnnotationLink l join l.child ann join ann.mapValue as nv"
+                         " where ann.ns = :ns and l.parent.id in (:ids)"):
+                return [[i, ann, k, v] for link, (i, ann, event) in server.links.items() if i in p["ids"] and server.annotations[ann]["ns"] == p["ns"]
+                        for k, v in server.annotations[ann]["pairs"]]
+            if query == "SELECT p.image.id, p.details.updateEvent.id FROM Pixels p WHERE p.image.id in (:ids)":
+                return [[i, server.image_events[i]] for i in sorted(p["ids"]) if i in server.image_events] # Pixels are only written when their image is created
+            match = re.fullmatch(r"SELECT o\.id FROM (\w+) o WHERE o\.id in \(:ids\)", query)
+            if match:
+                table = {"Roi": server.rois, "FileAnnotation": server.annotations}.get(match.group(1)) or server.objects[match.group(1)]
+                return [[i] for i in sorted(p["ids"]) if i in table]
+
+            match = re.fullmatch(r"SELECT i\.id FROM Image i(?: WHERE (.*?))?( ORDER BY i\.id)?", query)
+            if match:
+                condition = self.translate(match.group(1))
+                namespace = self.namespace(p)
+                rows = [[i] for i in sorted(server.objects["Image"]) if eval(condition, namespace, {"i": i})]
+                return rows[:limit] if limit is not None else rows
+
+            match = re.fullmatch(r"SELECT al\.id FROM Image i JOIN i\.annotationLinks al(?: WHERE (.*))?", query)
+            if match:
+                condition = self.translate(match.group(1))
+                namespace = self.namespace(p)
+                return [[link] for link, (i, ann, event) in server.links.items() if i in server.objects["Image"] and eval(condition, namespace, {"i": i, "link": link})]
+
+            match = re.fullmatch(r"SELECT i\.id, (al|ann)\.id, nv\.name, nv\.value FROM Image i JOIN i\.annotationLinks al JOIN al\.child ann"
+                                 r" JOIN ann\.mapValue as nv WHERE (.*)", query)
+            if match:
+                condition = self.translate(match.group(2))
+                namespace = self.namespace(p)
+                rows = []
+                for link, (i, ann, event) in server.links.items():
+                    if eval(condition, namespace, {"i": i, "link": link}):
+                        rows += [[i, link if match.group(1) == "al" else ann, k, v] for k, v in server.annotations[ann]["pairs"]]
+                return rows
+        raise NotImplementedError("The fake query service cannot answer: " + query)
+
+    def translate(self, condition: str):
+        if condition is None:
+            return compile("True", "<hql>", "eval")
+        for pattern, replacement in HQL_TRANSLATIONS:
+            condition = re.sub(pattern, replacement, condition)
+        return compile(condition, "<hql>", "eval")
+
+    def namespace(self, p: dict) -> dict:
+        scopes = {}
+        def scope(type, name):
+            if (type, name) not in scopes:
+                scopes[(type, name)] = self.server.project_images(p[name]) if type == "Project" else self.server.datasets_images(p[name])
+            return scopes[(type, name)]
+        return {"server": self.server, "p": p, "scope": scope}
+
+
+# UPDATE SERVICE
+def object_bytes(obj) -> int:
+    """Rough size of a model object on the wire."""
+
+    nbytes = 64
+    if hasattr(obj, "getMapValue") and obj.getMapValue() is not None:
+        nbytes += sum(len(nv.name) + len(nv.value) for nv in obj.getMapValue())
+    if hasattr(obj, "getChild") and obj.getChild() is not None and obj.getChild().getId() is None:
+        nbytes += object_bytes(obj.getChild())
+    if hasattr(obj, "copyShapes"):
+        nbytes += sum(64 + len(shape.getBytes() or b"") for shape in obj.copyShapes())
+    return nbytes
+
+class FakeUpdateService:
+    """Stand-in for the update service."""
+
+    def __init__(self, server: FakeServer):
+        self.server = server
+
+    def saveObject(self, obj, ctx = None):
+        self.saveAndReturnObject(obj, ctx)
+
+    def saveAndReturnObject(self, obj, ctx = None):
+        self.server.rpc("update.save", object_bytes(obj))
+        return self.server.save(obj)
+
+    def saveArray(self, objs: list, ctx = None):
+        self.saveAndReturnArray(objs, ctx)
+
+    def saveAndReturnArray(self, objs: list, ctx = None) -> list:
+        # The server saves each object of the array as its own graph: a new object referred to by several of them would be
+        # created several times, which the fake server would hide by saving it once
+        new = {}
+        for i, obj in enumerate(objs):
+            for ref in (obj, getattr(obj, "getParent", lambda: None)(), getattr(obj, "getChild", lambda: None)()):
+                if ref is not None and ref.getId() is None and new.setdefault(id(ref), i) != i:
+                    raise ValueError("The same new {kind} is in several objects of the array".format(kind = type(ref).__name__[:-1]))
+        self.server.rpc("update.saveArray", sum(object_bytes(obj) for obj in objs))
+        return [self.server.save(obj) for obj in objs]
+
+
+# PIXELS SERVICES
+class FakePixelsService:
+    """Stand-in for the pixels service."""
+
+    def __init__(self, server: FakeServer):
+        self.server = server
+
+    def createImage(self, sizeX: int, sizeY: int, sizeZ: int, sizeT: int, channels: list, pixelsType, name: str, description: str, ctx = None):
+        self.server.rpc("pixels.createImage")
+        return rlong(self.server.add_image(name, sizes = (sizeX, sizeY, sizeZ, len(channels), sizeT)))
+
+    def copyAndResizeImage(self, image_id: int, sizeX, sizeY, sizeZ, sizeT, channels: list, name: str, copyStats: bool, ctx = None):
+        self.server.rpc("pixels.copyAndResizeImage")
+        sizes = (unwrap(sizeX), unwrap(sizeY), unwrap(sizeZ), len(channels), unwrap(sizeT))
+        return rlong(self.server.add_image(name or self.server.objects["Image"][image_id], sizes = sizes))
+
+    def setChannelGlobalMinMax(self, pixels_id: int, c: int, min: float, max: float, ctx = None):
+        self.server.rpc("pixels.setChannelGlobalMinMax")
+
+class FakeRawPixelsStore:
+    """Stand-in for a raw pixels store, the pixels ID being the image ID. Written pixels are counted but not kept.
+
+    Images larger than PYRAMID_SIZE have a pyramid, whose levels halve the full size down to PYRAMID_SIZE. As in OMERO, the
+    resolution descriptions go from the full size down and the resolution levels from the smallest up.
+    """
+
+    PYRAMID_SIZE = 1024
+
+    def __init__(self, server: FakeServer):
+        self.server = server
+        self.image_id = None
+        self.step = 1
+
+    def setPixelsId(self, pixels_id: int, bypassOriginalFile: bool, ctx = None):
+        self.server.rpc("rawPixelsStore.setPixelsId")
+        self.image_id = pixels_id
+        self.step = 1
+
+    def getResolutionDescriptions(self, ctx = None) -> list:
+        self.server.rpc("rawPixelsStore.getResolutionDescriptions")
+        sizeX, sizeY = self.server.image_sizes[self.image_id][:2]
+        descriptions = [SimpleNamespace(sizeX = sizeX, sizeY = sizeY)]
+        while max(sizeX, sizeY) > self.PYRAMID_SIZE:
+            sizeX, sizeY = -(-sizeX // 2), -(-sizeY // 2)
+            descriptions.append(SimpleNamespace(sizeX = sizeX, sizeY = sizeY))
+        return descriptions
+
+    def getResolutionLevels(self, ctx = None) -> int:
+        return len(self.getResolutionDescriptions())
+
+    def setResolutionLevel(self, level: int, ctx = None):
+        self.step = 2 ** (self.getResolutionLevels() - 1 - level)
+
+    def getPlane(self, z: int, c: int, t: int, ctx = None) -> bytes:
+        plane = self.server.plane(self.image_id, z, c, t)[::self.step, ::self.step].tobytes()
+        self.server.rpc("rawPixelsStore.getPlane", len(plane))
+        return plane
+
+    def getTile(self, z: int, c: int, t: int, x: int, y: int, width: int, height: int, ctx = None) -> bytes:
+        tile = self.server.plane(self.image_id, z, c, t)[y:y + height, x:x + width].tobytes()
+        self.server.rpc("rawPixelsStore.getTile", len(tile))
+        return tile
+
+    def setPlane(self, buffer: bytes, z: int, c: int, t: int, ctx = None):
+        self.server.rpc("rawPixelsStore.setPlane", len(buffer))
+
+    def setTile(self, buffer: bytes, z: int, c: int, t: int, x: int, y: int, width: int, height: int, ctx = None):
+        self.server.rpc("rawPixelsStore.setTile", len(buffer))
+
+    def close(self, ctx = None):
+        self.server.rpc("rawPixelsStore.close")
+
+
+# WRAPPERS
+class FakeObjectWrapper:
+    """Stand-in for the BlitzObjectWrapper of a project or a dataset."""
+
+    def __init__(self, conn, type: str, id: int):
+        self._conn = conn
+        self.type = type
+        self.id = id
+
+    def getId(self) -> int:
+        return self.id
+
+    def getName(self) -> str:
+        return self._conn.server.objects[self.type][self.id]
+
+    def getParent(self):
+        server = self._conn.server
+        server.rpc("gateway.getParent")
+        parent_type, children = ("Dataset", server.dataset_images) if self.type == "Image" else ("Project", server.project_datasets)
+        for parent_id, child_ids in children.items():
+            if self.id in child_ids:
+                return FakeObjectWrapper(self._conn, parent_type, parent_id)
+        return None
+
+class FakeMapAnnotationWrapper:
+    """Stand-in for the MapAnnotationWrapper of a saved annotation."""
+
+    def __init__(self, pairs: list):
+        self.pairs = pairs
+
+    def getMapValue(self) -> list:
+        return [omero.model.NamedValue(k, v) for k, v in self.pairs]
+
+class FakePixelsWrapper:
+    """Stand-in for the PixelsWrapper of an image, reading planes and tiles plane by plane as the real one."""
+
+    def __init__(self, conn, image_id: int):
+        self._conn = conn
+        self.image_id = image_id
+
+    def getId(self) -> int:
+        return self.image_id
+
+    def get_numpy_type(self):
+        return np.uint8
+
+    def getPlanes(self, zctList: list):
+        return self.getTiles([(z, c, t, None) for z, c, t in zctList])
+
+    def getTiles(self, zctTileList: list):
+        server = self._conn.server
+        server.rpc("rawPixelsStore.open", calls = 2)
+        for z, c, t, tile in zctTileList:
+            plane = server.plane(self.image_id, z, c, t)
+            if tile is not None:
+                x, y, width, height = tile
+                plane = plane[y:y + height, x:x + width].copy()
+            server.rpc("rawPixelsStore.getPlane", plane.nbytes)
+            yield plane
+        server.rpc("rawPixelsStore.close")
+
+class FakeImageWrapper(FakeObjectWrapper):
+    """Stand-in for the ImageWrapper."""
+
+    def __init__(self, conn, id: int):
+        super().__init__(conn, "Image", id)
+        self._obj = omero.model.ImageI(id, True)
+        self._obj.setName(rstring(self.getName()))
+
+    def getSizeX(self) -> int:
+        return self._conn.server.image_sizes[self.id][0]
+
+    def getSizeY(self) -> int:
+        return self._conn.server.image_sizes[self.id][1]
+
+    def getSizeZ(self) -> int:
+        return self._conn.server.image_sizes[self.id][2]
+
+    def getSizeC(self) -> int:
+        return self._conn.server.image_sizes[self.id][3]
+
+    def getSizeT(self) -> int:
+        return self._conn.server.image_sizes[self.id][4]
+
+    def getPixelsId(self) -> int:
+        return self.id
+
+    def getPixelsType(self) -> str:
+        return "uint8"
+
+    def getChannelLabels(self) -> list:
+        self._conn.server.rpc("query.projection")
+        return self._conn.server.channel_names.setdefault(self.id, [str(c) for c in range(self.getSizeC())])
+
+    def getChannels(self, noRE: bool = False) -> list:
+        server = self._conn.server
+        server.rpc("query.findAllByQuery")
+        channels = []
+        for c, name in enumerate(self.getChannelLabels()):
+            logical_channel = omero.model.LogicalChannelI(server.new_id(), True)
+            logical_channel.setName(rstring(name))
+            server.logical_channels[logical_channel.getId().getValue()] = (self.id, c)
+            channels.append(SimpleNamespace(getLogicalChannel = lambda logical_channel = logical_channel: SimpleNamespace(_obj = logical_channel)))
+        return channels
+
+    def getPrimaryPixels(self) -> FakePixelsWrapper:
+        return FakePixelsWrapper(self._conn, self.id)
+
+    def getAnnotation(self, ns: str = None) -> FakeMapAnnotationWrapper:
+        server = self._conn.server
+        server.rpc("gateway.getAnnotation")
+        for link_id in server.image_links.get(self.id, ()):
+            annotation = server.annotations[server.links[link_id][1]]
+            if ns is None or annotation["ns"] == ns:
+                return FakeMapAnnotationWrapper(annotation["pairs"])
+        return None
+
+    def linkAnnotation(self, ann):
+        server = self._conn.server
+        server.rpc("gateway.linkAnnotation", calls = 2) # Existing link check, then save
+        link = omero.model.ImageAnnotationLinkI()
+        link.setParent(omero.model.ImageI(self.id, False))
+        link.setChild(ann._obj)
+        server.save(link)
+
+
+# GATEWAY
+class FakeGateway:
+    """Stand-in for omero.gateway.BlitzGateway, connected to a FakeServer."""
+
+    def __init__(self, server: FakeServer):
+        self.server = server
+        self.SERVICE_OPTS = ServiceOptsDict()
+        self.c = SimpleNamespace(sf = self) # For conn.c.sf.createRawPixelsStore()
+
+    def getQueryService(self) -> FakeQueryService:
+        return FakeQueryService(self.server)
+
+    def getUpdateService(self) -> FakeUpdateService:
+        return FakeUpdateService(self.server)
+
+    def getPixelsService(self) -> FakePixelsService:
+        return FakePixelsService(self.server)
+
+    def createRawPixelsStore(self) -> FakeRawPixelsStore:
+        return FakeRawPixelsStore(self.server)
+
+    def getUserId(self) -> int:
+        return 0
+
+    def keepAlive(self) -> bool:
+        self.server.rpc("gateway.keepAlive")
+        return True
+
+    def createFileAnnfromLocalFile(self, localPath: str, origFilePathAndName: str = None, mimetype: str = None, ns: str = None, desc: str = None):
+        with open(localPath, "rb") as f:
+            self.server.rpc("gateway.createFileAnnfromLocalFile", len(f.read()), calls = 4) # Original file, upload, annotation
+        ann = omero.model.FileAnnotationI()
+        ann.setNs(rstring(ns))
+        return SimpleNamespace(_obj = self.server.save(ann), getId = lambda: ann.getId().getValue())
+
+    def getObject(self, type: str, id: int):
+        self.server.rpc("gateway.getObject")
+        if int(id) not in self.server.objects[type]:
+            return None
+        return FakeImageWrapper(self, int(id)) if type == "Image" else FakeObjectWrapper(self, type, int(id))
+
+    def createImageFromNumpySeq(self, zctPlanes, imageName: str, sizeZ: int = 1, sizeC: int = 1, sizeT: int = 1, description = None,
+                                dataset = None, sourceImageId = None, channelList = None) -> FakeImageWrapper:
+        server = self.server
+        server.rpc("pixels.createImage", calls = 4) # Image copy, reload, rename and pixels store
+        image_id = None
+        for z in range(sizeZ):
+            for c in range(sizeC):
+                for t in range(sizeT):
+                    plane = next(zctPlanes)
+                    if image_id is None:
+                        image_id = server.add_image(imageName, sizes = (plane.shape[1], plane.shape[0], sizeZ, sizeC, sizeT))
+                    server.rpc("rawPixelsStore.setPlane", plane.nbytes)
+        server.rpc("pixels.setChannelGlobalMinMax", calls = sizeC + 1) # Then the store is closed
+        if dataset is not None:
+            server.rpc("update.save")
+            server.dataset_images.setdefault(dataset.getId(), set()).add(image_id)
+        return FakeImageWrapper(self, image_id)
+
+
+# IMPORTER
+class FakeImporter:
+    """Stand-in for the subprocess module, running "omero import" against a FakeServer.
+
+    Each call to the importer costs import_startup seconds plus one RPC per file.
+    """
+
+    def __init__(self, server: FakeServer):
+        self.server = server
+
+    def import_files(self, files: list, dataset_id: int) -> list:
+        self.server.rpc("cli.import.startup", seconds = self.server.import_startup)
+        self.server.rpc("cli.import.file", calls = len(files))
+        image_ids = [self.server.add_image(basename(f), dataset_id) for f in files]
+        for f, image_id in zip(files, image_ids):
+            self.server.client_paths[image_id] = realpath(f).lstrip("/") # As the importer records them
+        return image_ids
+
+    def run(self, args: list, **kwargs) -> subprocess.CompletedProcess:
+        dataset_id = int(args[args.index("-d") + 1])
+        files = args[args.index("-d") + 2:]
+        image_ids = self.import_files(files, dataset_id)
+        output = yaml.dump([{"path": f, "Fileset": i, "Image": [i]} for f, i in zip(files, image_ids)], Dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper))
+        return subprocess.CompletedProcess(args, 0, output, "")
+
+    def check_output(self, command: str, shell: bool = False) -> bytes:
+        args = command.split()
+        image_id = self.import_files([args[3]], int(args[5]))[0]
+        return "Image:{id}\n".format(id = image_id).encode()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Opt-in tracing of the OMERO calls and numpy kernels of the walkthrough scripts
+
+A Metrics object wraps the query, update and pixels services of a connection and records, for each operation, the
+number of calls, the bytes of pixel data moved and a histogram of the latencies. The results are saved as JSON, or as
+Prometheus text when the file name ends with ".prom".
+
+Usage:
+    metrics = Metrics(enabled = True)
+    conn = metrics.instrument(conn)
+    with metrics.measure("numpy.threshold_mask", nbytes):
+        ...
+    metrics.save("metrics.json")
+
+The scripts sharing Connection.py are traced by setting the OMERO_METRICS environment variable to the output file. When
+metrics are disabled, instrument returns the connection untouched and measure a shared empty context manager, so the
+cost is one method call per measured block.
+"""
+
+
+# IMPORT
+import json
+import numpy as np
+from bisect import bisect_left
+from contextlib import nullcontext
+from threading import Lock
+from time import perf_counter
+
+
+# SETTINGS
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # Upper bounds of the latency histograms, in seconds
+NULL_TIMER = nullcontext()
+
+
+# METRICS
+def payload_size(value) -> int:
+    """The bytes of pixel data in an argument or a result of a call, 0 for anything else."""
+
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (memoryview, np.ndarray)):
+        return value.nbytes
+    return 0
+
+class Timer:
+    """Context manager recording the duration of a block as one call of an operation."""
+
+    def __init__(self, metrics, operation: str, nbytes: int = 0):
+        self.metrics = metrics
+        self.operation = operation
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.operation, perf_counter() - self.start, self.nbytes, exc_info[0] is not None)
+        return False
+
+class TracedService:
+    """Proxy of an OMERO service recording each method call as the "prefix.method" operation."""
+
+    def __init__(self, service, prefix: str, metrics):
+        self._service = service
+        self._prefix = prefix
+        self._metrics = metrics
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._service, name)
+        if not callable(attr):
+            return attr
+        return self._metrics.trace(attr, self._prefix + "." + name)
+
+class Metrics:
+    """Thread-safe record of call counts, latencies and bytes per operation.
+
+    Parameters
+    ----------
+    enabled: bool
+        Record anything at all. Disabled metrics leave the connections untouched.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.lock = Lock()
+        self.operations = {} # Operation: {"calls", "errors", "seconds", "max_seconds", "bytes", "buckets"}
+
+    def record(self, operation: str, seconds: float, nbytes: int = 0, error: bool = False):
+        """Record one call of an operation.
+
+        Parameters
+        ----------
+        operation: str
+            The name of the operation, e. g. "query.projection" or "numpy.threshold_mask".
+        seconds: float
+            The duration of the call.
+        nbytes: int
+            The bytes of pixel data moved or processed by the call.
+        error: bool
+            The call raised an exception.
+        """
+
+        with self.lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = {"calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0, "buckets": [0] * (len(BUCKETS) + 1)}
+            stats["calls"] += 1
+            stats["errors"] += error
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["bytes"] += nbytes
+            stats["buckets"][bisect_left(BUCKETS, seconds)] += 1
+
+    def measure(self, operation: str, nbytes: int = 0):
+        """Context manager recording a block as one call of an operation, e. g. a numpy kernel."""
+
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, operation, nbytes)
+
+    def trace(self, function, operation: str):
+        """Wrap a function so that each call is recorded, with the bytes of its pixel arguments and result."""
+
+        def traced(*args, **kwargs):
+            start = perf_counter()
+            error = True
+            try:
+                result = function(*args, **kwargs)
+                error = False
+            finally:
+                nbytes = sum(payload_size(arg) for arg in args) + (0 if error else payload_size(result))
+                self.record(operation, perf_counter() - start, nbytes, error)
+            return result
+        return traced
+
+    def wrap(self, service, prefix: str):
+        """Trace the method calls of a service as "prefix.method" operations, if the metrics are enabled."""
+
+        if not self.enabled:
+            return service
+        return TracedService(service, prefix, self)
+
+    def instrument(self, conn):
+        """Trace the services of a connection, and its gateway calls that move pixels.
+
+        Parameters
+        ----------
+        conn: omero.gateway.BlitzGateway object
+            OMERO connection.
+
+        Returns
+        -------
+        conn: omero.gateway.BlitzGateway object
+            The same connection, traced if the metrics are enabled.
+
+        Note
+        ----
+        Gateway calls are recorded as a whole ("gateway.getObject", ...) as well as the service calls they make, and
+        "gateway.createImageFromNumpySeq" includes the time spent in the plane generator.
+        """
+
+        if not self.enabled:
+            return conn
+        for getter_name, prefix in [("getQueryService", "query"), ("getUpdateService", "update"), ("getPixelsService", "pixels"), ("createRawPixelsStore", "rawPixelsStore")]:
+            getter = getattr(conn, getter_name)
+            setattr(conn, getter_name, lambda getter = getter, prefix = prefix: self.wrap(getter(), prefix))
+        for name in ["getObject", "createImageFromNumpySeq"]:
+            setattr(conn, name, self.trace(getattr(conn, name), "gateway." + name))
+        return conn
+
+    def to_json(self) -> dict:
+        """The statistics of each operation, with the histogram buckets labelled by their upper bound."""
+
+        with self.lock:
+            return {operation: dict(stats, buckets = dict(zip([str(b) for b in BUCKETS] + ["+Inf"], stats["buckets"])))
+                    for operation, stats in self.operations.items()}
+
+    def to_prometheus(self) -> str:
+        """The statistics in the Prometheus text exposition format."""
+
+        lines = ["# TYPE omero_operation_seconds histogram"]
+        operations = self.to_json()
+        for operation, stats in operations.items():
+            cumulative = 0
+            for le, count in stats["buckets"].items():
+                cumulative += count
+                lines.append('omero_operation_seconds_bucket{{operation="{op}",le="{le}"}} {n}'.format(op = operation, le = le, n = cumulative))
+            lines.append('omero_operation_seconds_sum{{operation="{op}"}} {s}'.format(op = operation, s = stats["seconds"]))
+            lines.append('omero_operation_seconds_count{{operation="{op}"}} {n}'.format(op = operation, n = stats["calls"]))
+        for name in ["errors", "bytes"]:
+            lines.append("# TYPE omero_operation_{name}_total counter".format(name = name))
+            for operation, stats in operations.items():
+                lines.append('omero_operation_{name}_total{{operation="{op}"}} {n}'.format(name = name, op = operation, n = stats[name]))
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """A few lines for humans, the slowest operations first."""
+
+        operations = self.to_json()
+        lines = []
+        for operation, stats in sorted(operations.items(), key = lambda item: -item[1]["seconds"]):
+            lines.append("{op}: {calls} calls, {s:.3f} s (max {max:.3f} s), {mb:.1f} MB{err}".format(
+                op = operation, calls = stats["calls"], s = stats["seconds"], max = stats["max_seconds"], mb = stats["bytes"] / 1e6,
+                err = ", {n} errors".format(n = stats["errors"]) if stats["errors"] > 0 else ""))
+        return "\n".join(lines)
+
+    def save(self, path: str):
+        """Save the statistics as Prometheus text if the path ends with ".prom", as JSON otherwise."""
+
+        with open(path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_json(), f, indent = 1)
+
+
+# LINKS
+# Prometheus text format: https://prometheus.io/docs/instrumenting/exposition_formats/
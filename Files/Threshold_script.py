@@ -9,222 +9,2266 @@ Aurélien VALENTIN for the ImHorPhen research team (Angers, France) - July 2023
 """
 
 # IMPORT
-import omero, omero.scripts as scripts
+import ast, csv, hashlib, json, multiprocessing, omero, omero.grid, omero.scripts as scripts, os, re, tempfile
 import numpy as np
 from omero.gateway import BlitzGateway
-from omero.rtypes import rstring
-from omero.sys import Parameters
-from time import time
-
-start_time = time()
-
-
-# DEFINE THE SCRIPT PARAMTERS
-client = scripts.client(
-    "Threshold2.py",
-    """Threshold RGB images on a query.""",
-    scripts.Bool("Process on a given object", optional = False, grouping = "01", default = True),
-    scripts.String("Object type", optional = False, grouping = "01.1", default = "Image", values = [rstring("Image"), rstring("Dataset"), rstring("Project")]),
-    scripts.Long("Object ID", optional = False, grouping = "01.1"),
-    scripts.Bool("Process on a query", optional = False, grouping = "02", default = True),
-    scripts.Map("Key:Value pair(s)", optional = True, grouping = "02.1"),
-    scripts.Bool("RGB channel threshold values", optional = True, grouping = "03", default = True), # A simple text should be better but it doesn't seem to be possible...
-    scripts.Int("Red min", optional = False, grouping = "03.1", default = 103, min = 0, max = 255),
-    scripts.Int("Red max", optional = False, grouping = "03.2", default = 255, min = 0, max = 255),
-    scripts.Int("Green min", optional = False, grouping = "03.3", default = 115, min = 0, max = 255),
-    scripts.Int("Green max", optional = False, grouping = "03.4", default = 255, min = 0, max = 255),
-    scripts.Int("Blue min", optional = False, grouping = "03.5", default = 60, min = 0, max = 255),
-    scripts.Int("Blue max", optional = False, grouping = "03.6", default = 255, min = 0, max = 255),
-    scripts.Bool("Thresholded images", optional = True, grouping = "04", default = True), # Once again, just a string would be nice.
-    scripts.String('Image names ("[f]" will add the file name)', optional = False, grouping = "04.1", default = "[f]_thresholded"),
-    scripts.String("Format", optional = False, grouping = "04.2", values = [rstring("jpeg"), rstring("png"), rstring("tif")], default = "png"),
-    scripts.Bool("Output in another dataset", optional = False, grouping = "05", default = True),
-    scripts.String("Dataset ID for an existing dataset OR Dataset name to create a new dataset", optional = True, grouping = "05.1"),
-    scripts.Bool("Copy past Key:Value pair(s)", optional = True, grouping = "06", default = True),
-    authors = ["Aurélien VALENTIN for the ImHorPhen research team (Angers, France)"]
-    )
-
-# Get the parameters
-inputs = client.getInputs(unwrap=True)
-thr_values = [(inputs["Red min"], inputs["Red max"]), (inputs["Green min"], inputs["Green max"]), (inputs["Blue min"], inputs["Blue max"])]
-
-# Connection
-conn = BlitzGateway(client_obj = client)
+from omero.rtypes import rdouble, rint, rlist, rlong, robject, rstring, unwrap
+from omero.sys import Filter, Parameters
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from itertools import product, repeat
+from queue import Queue
+from threading import Lock, Thread, local
+from time import perf_counter, time
+
+
+# METRICS
+# Copy of Metrics.py without the file outputs (an OMERO.script is uploaded as a single file)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # Upper bounds of the latency histograms, in seconds
+NULL_TIMER = nullcontext()
+
+def payload_size(value) -> int:
+    """The bytes of pixel data in an argument or a result of a call, 0 for anything else."""
+
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (memoryview, np.ndarray)):
+        return value.nbytes
+    return 0
+
+class Timer:
+    """Context manager recording the duration of a block as one call of an operation."""
+
+    def __init__(self, metrics, operation: str, nbytes: int = 0):
+        self.metrics = metrics
+        self.operation = operation
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.operation, perf_counter() - self.start, self.nbytes, exc_info[0] is not None)
+        return False
+
+class TracedService:
+    """Proxy of an OMERO service recording each method call as the "prefix.method" operation."""
+
+    def __init__(self, service, prefix: str, metrics):
+        self._service = service
+        self._prefix = prefix
+        self._metrics = metrics
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._service, name)
+        if not callable(attr):
+            return attr
+        return self._metrics.trace(attr, self._prefix + "." + name)
+
+class Metrics:
+    """Thread-safe record of call counts, latencies and bytes per operation.
+
+    Parameters
+    ----------
+    enabled: bool
+        Record anything at all. Disabled metrics leave the connections untouched.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.lock = Lock()
+        self.operations = {} # Operation: {"calls", "errors", "seconds", "max_seconds", "bytes", "buckets"}
+
+    def record(self, operation: str, seconds: float, nbytes: int = 0, error: bool = False):
+        """Record one call of an operation.
+
+        Parameters
+        ----------
+        operation: str
+            The name of the operation, e. g. "query.projection" or "numpy.threshold_mask".
+        seconds: float
+            The duration of the call.
+        nbytes: int
+            The bytes of pixel data moved or processed by the call.
+        error: bool
+            The call raised an exception.
+        """
+
+        with self.lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = {"calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0, "buckets": [0] * (len(BUCKETS) + 1)}
+            stats["calls"] += 1
+            stats["errors"] += error
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["bytes"] += nbytes
+            stats["buckets"][bisect_left(BUCKETS, seconds)] += 1
+
+    def measure(self, operation: str, nbytes: int = 0):
+        """Context manager recording a block as one call of an operation, e. g. a numpy kernel."""
+
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, operation, nbytes)
+
+    def trace(self, function, operation: str):
+        """Wrap a function so that each call is recorded, with the bytes of its pixel arguments and result."""
+
+        def traced(*args, **kwargs):
+            start = perf_counter()
+            error = True
+            try:
+                result = function(*args, **kwargs)
+                error = False
+            finally:
+                nbytes = sum(payload_size(arg) for arg in args) + (0 if error else payload_size(result))
+                self.record(operation, perf_counter() - start, nbytes, error)
+            return result
+        return traced
+
+    def wrap(self, service, prefix: str):
+        """Trace the method calls of a service as "prefix.method" operations, if the metrics are enabled."""
+
+        if not self.enabled:
+            return service
+        return TracedService(service, prefix, self)
+
+    def instrument(self, conn):
+        """Trace the services of a connection, and its gateway calls that move pixels.
+
+        Parameters
+        ----------
+        conn: omero.gateway.BlitzGateway object
+            OMERO connection.
+
+        Returns
+        -------
+        conn: omero.gateway.BlitzGateway object
+            The same connection, traced if the metrics are enabled.
+
+        Note
+        ----
+        Gateway calls are recorded as a whole ("gateway.getObject", ...) as well as the service calls they make, and
+        "gateway.createImageFromNumpySeq" includes the time spent in the plane generator.
+        """
+
+        if not self.enabled:
+            return conn
+        for getter_name, prefix in [("getQueryService", "query"), ("getUpdateService", "update"), ("getPixelsService", "pixels"), ("createRawPixelsStore", "rawPixelsStore")]:
+            getter = getattr(conn, getter_name)
+            setattr(conn, getter_name, lambda getter = getter, prefix = prefix: self.wrap(getter(), prefix))
+        for name in ["getObject", "createImageFromNumpySeq"]:
+            setattr(conn, name, self.trace(getattr(conn, name), "gateway." + name))
+        return conn
+
+    def to_json(self) -> dict:
+        """The statistics of each operation, with the histogram buckets labelled by their upper bound."""
+
+        with self.lock:
+            return {operation: dict(stats, buckets = dict(zip([str(b) for b in BUCKETS] + ["+Inf"], stats["buckets"])))
+                    for operation, stats in self.operations.items()}
+
+    def summary(self) -> str:
+        """A few lines for humans, the slowest operations first."""
+
+        operations = self.to_json()
+        lines = []
+        for operation, stats in sorted(operations.items(), key = lambda item: -item[1]["seconds"]):
+            lines.append("{op}: {calls} calls, {s:.3f} s (max {max:.3f} s), {mb:.1f} MB{err}".format(
+                op = operation, calls = stats["calls"], s = stats["seconds"], max = stats["max_seconds"], mb = stats["bytes"] / 1e6,
+                err = ", {n} errors".format(n = stats["errors"]) if stats["errors"] > 0 else ""))
+        return "\n".join(lines)
+
+METRICS = Metrics() # Enabled by the "Metrics" parameter
+
+
+# BUFFERS
+class BufferPool:
+    """Thread-safe pool of reusable uint8 buffers, by shape, so that the masks of similar images share their memory."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.free = {} # Shape: list of free buffers
+
+    def take(self, shape: tuple) -> np.ndarray:
+        """Get a free buffer of this shape, allocating it only if there is none."""
+
+        with self.lock:
+            buffers = self.free.get(shape)
+            if buffers:
+                return buffers.pop()
+        return np.empty(shape, dtype = np.uint8)
+
+    def give(self, buffer: np.ndarray):
+        """Give a buffer back, once nothing uses it anymore."""
+
+        with self.lock:
+            self.free.setdefault(buffer.shape, []).append(buffer)
+
+BUFFERS = BufferPool()
+PIXELS_TYPES = {} # Pixels type value: ID, which is the same for every session
+NUMPY_TYPES = {"bit": np.bool_, "int8": np.int8, "uint8": np.uint8, "int16": np.int16, "uint16": np.uint16, "int32": np.int32, "uint32": np.uint32,
+               "float": np.float32, "double": np.float64} # Pixels type value: numpy type of the raw (big-endian) planes, bits being packed, see raw_array
+
+
+# PIXEL CACHE
+class PixelCache:
+    """Thread-safe on-disk cache of the planes of images, as memory-mapped arrays reused from one run to the next.
+
+    Parameters
+    ----------
+    folder: str
+        The folder of the cache, created if needed.
+    max_bytes: int
+        The size cap of the cache. The least recently used images are evicted beyond it.
+
+    Note
+    ----
+    Each image is one .npy file holding its (C, Z * T, Y, X) stack (see read_stack), named after its pixels ID and the last
+    update event of its pixels, so that pixels changed on the server are read again. Hits are memory-mapped read only:
+    their planes are views on the page cache of the file, without any download nor copy. The last use of a file is
+    kept as its modification time, so the LRU order survives the runs.
+
+    The cache is keyed by image rather than by plane since the script always reads whole stacks: one update event query,
+    one file and one eviction per image. In exchange, the tiled processing does not use it, and an image larger than the
+    cap is read from the server each time.
+    """
+
+    TEMP_AGE = 3600 # Seconds after which a .tmp file was left by a run which stopped while downloading
+
+    def __init__(self, folder: str, max_bytes: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.files = {} # Pixels ID: [file name, bytes, last use]
+        self.loading = {} # Pixels ID: lock held while the image is downloaded, for the other threads to wait for it
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok = True)
+        for name in os.listdir(folder):
+            match = re.fullmatch(r"(\d+)_(\d+)\.npy", name)
+            try:
+                info = os.stat(os.path.join(folder, name))
+            except FileNotFoundError: # Evicted or renamed by another run meanwhile
+                continue
+            if match is not None:
+                self.files[int(match.group(1))] = [name, info.st_size, info.st_mtime]
+            elif name.endswith(".tmp") and time() - info.st_mtime > self.TEMP_AGE: # Newer ones may be written by another run
+                try:
+                    os.remove(os.path.join(folder, name))
+                except FileNotFoundError:
+                    pass
+        self.evict() # The cap may be lower than in the last run
+
+    def remove(self, pixels_id: int):
+        """Forget an image and delete its file (the arrays already mapped stay valid)."""
+
+        name = self.files.pop(pixels_id)[0]
+        try:
+            os.remove(os.path.join(self.folder, name))
+        except FileNotFoundError:
+            pass
+
+    def evict(self, keep: int = None):
+        """Delete the least recently used files until the cache fits in max_bytes, except the one of the pixels keep."""
+
+        total = sum(entry[1] for entry in self.files.values())
+        for pixels_id in sorted(self.files, key = lambda p: self.files[p][2]):
+            if total <= self.max_bytes:
+                break
+            if pixels_id != keep:
+                total -= self.files[pixels_id][1]
+                self.remove(pixels_id)
+
+    def stack(self, conn: BlitzGateway, image) -> np.ndarray:
+        """The stack of an image (see read_stack), from the cache if its pixels did not change, from the server otherwise.
+
+        Parameters
+        ----------
+        conn: omero.gateway.BlitzGateway object
+            OMERO connection.
+        image: omero.gateway._ImageWrapper
+            The image.
+        
+        Returns
+        -------
+        stack: numpy 4D array
+            The stack, memory-mapped read only, or in memory if the image alone is larger than the cap.
+        
+        Note
+        ----
+        Concurrent misses on the same image download it once: the other threads wait for the file, then map it.
+        """
+
+        pixels_id = image.getPixelsId()
+        params = Parameters()
+        params.map = {"ids": rlist([rlong(image.getId())])}
+        event = conn.getQueryService().projection("SELECT p.image.id, p.details.updateEvent.id FROM Pixels p WHERE p.image.id in (:ids)",
+                                                  params, conn.SERVICE_OPTS)[0][1].val
+        name = "{pixels}_{event}.npy".format(pixels = pixels_id, event = event)
+        path = os.path.join(self.folder, name)
+        stack = self.lookup(pixels_id, name, path)
+        if stack is not None:
+            return stack
+
+        nbytes = image.getSizeX() * image.getSizeY() * image.getSizeZ() * image.getSizeC() * image.getSizeT() * np.dtype(NUMPY_TYPES[image.getPixelsType()]).itemsize
+        if nbytes > self.max_bytes:
+            with self.lock:
+                self.misses += 1
+            return read_stack(image)
+        with self.lock:
+            loading = self.loading.setdefault(pixels_id, Lock())
+        with loading:
+            try:
+                stack = self.lookup(pixels_id, name, path) # Downloaded by another thread meanwhile
+                if stack is not None:
+                    return stack
+                with self.lock:
+                    self.misses += 1
+                fd, temp_path = tempfile.mkstemp(suffix = ".tmp", dir = self.folder)
+                os.close(fd)
+                try:
+                    stack = read_stack(image, lambda shape, dtype: np.lib.format.open_memmap(temp_path, mode = "w+", dtype = dtype, shape = shape))
+                    stack.flush()
+                    del stack
+                    os.replace(temp_path, path) # Complete files only, for the other runs
+                except BaseException:
+                    os.remove(temp_path)
+                    raise
+                with self.lock:
+                    self.files[pixels_id] = [name, os.path.getsize(path), time()]
+                    self.evict(keep = pixels_id)
+            finally:
+                with self.lock:
+                    self.loading.pop(pixels_id, None)
+        return np.load(path, mmap_mode = "r")
+
+    def lookup(self, pixels_id: int, name: str, path: str) -> np.ndarray:
+        """The stack of an image mapped from its file if it is cached with the same pixels, None otherwise."""
+
+        with self.lock:
+            entry = self.files.get(pixels_id)
+            if entry is not None and entry[0] != name: # Pixels changed since they were cached
+                self.remove(pixels_id)
+                entry = None
+            if entry is not None:
+                entry[2] = time()
+        if entry is not None:
+            try:
+                with METRICS.measure("pixelCache.hit", entry[1]):
+                    os.utime(path)
+                    stack = np.load(path, mmap_mode = "r")
+                with self.lock:
+                    self.hits += 1
+                return stack
+            except (OSError, ValueError): # Deleted or damaged meanwhile, e. g. by another run
+                with self.lock:
+                    if pixels_id in self.files:
+                        self.remove(pixels_id)
+        return None
+
+
+# RESULT CACHE
+SCRIPT_VERSION = "2.1" # Part of the cache keys: change it when the results of the same inputs change
+CACHE_NS = "ImHorPhen/threshold_cache" # Namespace of the map annotations linking the original images to their results
+RESULT_TYPES = {"Images": "Image", "Mask ROIs": "Roi", "RLE annotations": "FileAnnotation"} # Output mode: type of the results
+MEASURE_NS = "ImHorPhen/threshold_measurements" # Namespace of the file annotations of the measurement tables
+
+
+# PREVIEW
+PREVIEW_SHEET_SIZE = 100 # Maximum number of images on the contact sheet of a preview, in the order of processing
+
+
+# KERNELS
+# A kernel is a vectorized numpy function registered under a name. It is called as kernel(batch, **params), batch being a
+# (C, B, Y, X) array of B planes of C channels (one per (z, t)), and returns a (C', B, Y, X) or a (B, Y, X) array.
+KERNELS = {} # Name: kernel
+KERNEL_POOLS = {} # Number of processes: ProcessPoolExecutor, shut down by run_script
+
+def kernel(name: str):
+    """Register a function as the kernel name, to use it in the pipelines of apply_kernels."""
+
+    def register(function):
+        KERNELS[name] = function
+        return function
+    return register
+
+@kernel("threshold")
+def threshold_kernel(batch: np.ndarray, ranges: list) -> np.ndarray:
+    """255 where every channel is in its (min, max) range, both excluded, 0 elsewhere."""
+
+    return threshold_mask(list(batch), ranges)
+
+@kernel("normalize")
+def normalize_kernel(batch: np.ndarray) -> np.ndarray:
+    """Stretch each channel of each plane from its minimum and maximum to 0 and 255."""
+
+    low = batch.min(axis = (-2, -1), keepdims = True).astype(np.float32)
+    high = batch.max(axis = (-2, -1), keepdims = True).astype(np.float32)
+    scale = np.divide(255, high - low, out = np.zeros_like(high), where = high > low)
+    return ((batch - low) * scale).astype(np.uint8)
+
+@kernel("channel_math")
+def channel_math_kernel(batch: np.ndarray, weights: list, offset: float = 0.0) -> np.ndarray:
+    """A weighted sum of the channels, e. g. weights = [-1, 2, -1] for the excess green 2G - R - B."""
+
+    return np.tensordot(np.asarray(weights, dtype = np.float32), batch.astype(np.float32), axes = 1) + offset
+
+def morphology(batch: np.ndarray, iterations: int, erode: bool) -> np.ndarray:
+    """Binary erosion or dilation of each plane by a 3x3 square, the pixels outside the plane being background."""
+
+    mask = batch != 0
+    for i in range(iterations):
+        padded = np.pad(mask, [(0, 0)] * (mask.ndim - 2) + [(1, 1), (1, 1)])
+        height, width = mask.shape[-2:]
+        combine = np.logical_and if erode else np.logical_or
+        mask = padded[..., 1:height + 1, 1:width + 1].copy()
+        for dy, dx in product(range(3), repeat = 2):
+            combine(mask, padded[..., dy:dy + height, dx:dx + width], out = mask)
+    return mask.astype(np.uint8) * np.uint8(255)
+
+@kernel("erode")
+def erode_kernel(batch: np.ndarray, iterations: int = 1) -> np.ndarray:
+    return morphology(batch, iterations, True)
+
+@kernel("dilate")
+def dilate_kernel(batch: np.ndarray, iterations: int = 1) -> np.ndarray:
+    return morphology(batch, iterations, False)
+
+@kernel("open")
+def open_kernel(batch: np.ndarray, iterations: int = 1) -> np.ndarray:
+    """Erosion then dilation, removing the specks smaller than the square."""
+
+    return morphology(morphology(batch, iterations, True), iterations, False)
+
+@kernel("close")
+def close_kernel(batch: np.ndarray, iterations: int = 1) -> np.ndarray:
+    """Dilation then erosion, filling the holes smaller than the square."""
+
+    return morphology(morphology(batch, iterations, False), iterations, True)
 
 
 # FUNCTIONS
-def planeGen(image, thr_values: list, zctList: list):
-    """Create a processed image generator.
+def threshold_mask(planes: list, thr_values: list, mask = None, buffer = None) -> np.ndarray:
+    """Compute the RGB threshold mask of a set of channel planes in one fused pass.
+
+    Parameters
+    ----------
+    planes: list of numpy 2D arrays
+        One plane per channel, in the same order as thr_values.
+    thr_values: list of tuples of two ints
+        (min, max) values of each channel. A pixel is kept when min < value < max on every channel.
+    mask: numpy 2D array of uint8, optional
+        Preallocated output buffer with the shape of the planes.
+    buffer: numpy 2D array of uint8, optional
+        Preallocated scratch buffer with the shape of the planes.
+
+    Returns
+    -------
+    mask: numpy 2D array of uint8
+        255 where the pixel is in every range, 0 elsewhere.
+    """
+
+    shape = planes[0].shape
+    if mask is None:
+        mask = np.empty(shape, dtype = np.uint8)
+    if buffer is None:
+        buffer = np.empty(shape, dtype = np.uint8)
+
+    mask.fill(255)
+    for p, (low, high) in zip(planes, thr_values):
+        np.greater(p, low, out = buffer)
+        np.multiply(mask, buffer, out = mask)
+        np.less(p, high, out = buffer)
+        np.multiply(mask, buffer, out = mask)
+    return mask
+
+def threshold_image(state: dict, thr_values: list, pipeline: list = None, processes: int = 1, measure: bool = False) -> dict:
+    """Threshold an image read by read_image into a pooled uint8 mask, without widening it to the type of the planes.
+
+    Parameters
+    ----------
+    state: dict
+        The image read by read_image.
+    thr_values: list of tuples of two ints
+        RGB threshold values mandatory for the example process.
+    pipeline: list of tuples
+        Optional kernels computing the mask instead of the RGB threshold, see parse_kernels.
+    processes: int
+        The number of processes running the kernels of the pipeline, see run_kernels.
+    measure: bool
+        Also measure the mask before the planes are freed, see measure_mask.
+    
+    Returns
+    -------
+    state: dict
+        The same state, whose planes are replaced by the mask ("mask", a buffer of BUFFERS given back by the writers, with
+        one plane per (z, t) as the planes) and, if measure is True, by its statistics ("stats").
+    """
+
+    planes = state["planes"]
+    mask = BUFFERS.take(planes[0].shape)
+    # Here you can add any code you want.
+    if pipeline is None:
+        buffer = BUFFERS.take(planes[0].shape)
+        with METRICS.measure("numpy.threshold_mask", planes[0].nbytes * len(planes)):
+            threshold_mask(planes, thr_values, mask, buffer) # Every (z, t) at once
+        BUFFERS.give(buffer)
+    else:
+        with METRICS.measure("numpy.kernels", planes[0].nbytes * len(planes)):
+            run_kernels(state["stack"], pipeline, processes, mask)
+    if measure:
+        with METRICS.measure("numpy.measure_mask", planes[0].nbytes * len(planes)):
+            state["stats"] = measure_mask(state["stack"], mask)
+    state["planes"] = state["stack"] = None # Freed before the upload
+    state["mask"] = mask
+    return state
+
+def measure_mask(stack: np.ndarray, mask: np.ndarray) -> dict:
+    """Measure the pixels kept by a mask.
+
+    Parameters
+    ----------
+    stack: numpy 4D array
+        The (C, Z * T, Y, X) planes of the image, see read_image.
+    mask: numpy 3D array of uint8
+        The (Z * T, Y, X) mask, 0 outside and anything else inside.
+    
+    Returns
+    -------
+    stats: dict
+        The number of pixels kept ("pixels"), their fraction of all the pixels ("fraction") and the mean of each channel
+        inside the mask ("means", NaN if no pixel is kept), over every (z, t).
+    """
+
+    kept = mask != 0
+    pixels = int(np.count_nonzero(kept))
+    means = [float(np.sum(channel, where = kept, dtype = np.float64)) / pixels if pixels > 0 else float("nan") for channel in stack]
+    return {"pixels": pixels, "fraction": pixels / kept.size, "means": means}
+
+def parse_kernels(text: str, thr_values: list = None) -> list:
+    """Parse a pipeline of kernels written as "name(param = value, ...)", separated by ";".
+
+    Parameters
+    ----------
+    text: str
+        The pipeline, e. g. "threshold; open(iterations = 2)" or "channel_math(weights = [-1, 2, -1]);
+        threshold(ranges = [(20, 510)])". The values are Python literals.
+    thr_values: list of tuples of two ints
+        The ranges of the "threshold" kernels written without any.
+    
+    Returns
+    -------
+    pipeline: list of tuples
+        The (name, params) of each kernel, params being a dict.
+    """
+
+    pipeline = []
+    for step in text.split(";"):
+        if step.strip() == "":
+            continue
+        match = re.fullmatch(r"\s*(\w+)\s*(?:\((.*)\))?\s*", step, re.DOTALL)
+        if match is None or match.group(1) not in KERNELS:
+            raise ValueError("Unknown kernel {step}, expected one of {names}".format(step = step.strip(), names = ", ".join(KERNELS)))
+        call = ast.parse("f({args})".format(args = match.group(2) or ""), mode = "eval").body
+        params = {keyword.arg: ast.literal_eval(keyword.value) for keyword in call.keywords}
+        if match.group(1) == "threshold" and "ranges" not in params:
+            params["ranges"] = thr_values
+        pipeline.append((match.group(1), params))
+    return pipeline
+
+def apply_kernels(batch: np.ndarray, pipeline: list) -> np.ndarray:
+    """Apply a pipeline of kernels to a (C, B, Y, X) batch of planes, see KERNELS.
+
+    Returns
+    -------
+    result: numpy 3D array
+        The (B, Y, X) result of the last kernel.
+    """
+
+    for name, params in pipeline:
+        if batch.ndim == 3:
+            batch = batch[np.newaxis]
+        batch = KERNELS[name](batch, **params)
+    if batch.ndim == 4:
+        if batch.shape[0] != 1:
+            raise ValueError("The last kernel must give one channel, not {n}".format(n = batch.shape[0]))
+        batch = batch[0]
+    return batch
+
+def run_kernels(stack: np.ndarray, pipeline: list, processes: int = 1, mask: np.ndarray = None) -> np.ndarray:
+    """Apply a pipeline of kernels to every (z, t) of an image, spread over several processes.
+
+    Parameters
+    ----------
+    stack: numpy 4D array
+        The (C, Z * T, Y, X) planes of the image, see read_image.
+    pipeline: list of tuples
+        The kernels, see parse_kernels.
+    processes: int
+        The number of processes. The (z, t) are split into one batch per process, each kernel running on a whole batch.
+    mask: numpy 3D array of uint8
+        The (Z * T, Y, X) array where the result is written, created if None.
+    
+    Returns
+    -------
+    mask: numpy 3D array of uint8
+        The result of the pipeline: nonzero values above 255 are 255, booleans are 0 or 255.
+    """
+
+    if mask is None:
+        mask = np.empty(stack.shape[1:], dtype = np.uint8)
+    n = stack.shape[1]
+    if processes <= 1 or n == 1:
+        results = [(0, apply_kernels(stack, pipeline))]
+    else:
+        if processes not in KERNEL_POOLS:
+            # Not forked: the workers would inherit the locks held by the other threads (connections, buffer pool, metrics)
+            context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+            KERNEL_POOLS[processes] = ProcessPoolExecutor(max_workers = processes, mp_context = context)
+        starts = list(range(0, n, -(-n // processes)))
+        results = zip(starts, KERNEL_POOLS[processes].map(apply_kernels, [stack[:, i:i + -(-n // processes)] for i in starts], repeat(pipeline)))
+    for i, result in results:
+        if result.dtype == bool:
+            result = result.view(np.uint8) * np.uint8(255)
+        np.clip(result, 0, 255, out = mask[i:i + len(result)], casting = "unsafe")
+    return mask
+
+def parse_threshold_sets(text: str) -> list:
+    """Parse threshold sets written as "Rmin-Rmax, Gmin-Gmax, Bmin-Bmax", separated by ";".
+
+    Parameters
+    ----------
+    text: str
+        The threshold sets. A channel can have several ranges separated by "|", which makes a grid of all the
+        combinations: "90-255|110-255, 115-255, 40-255|60-255" gives 4 sets.
+    
+    Returns
+    -------
+    thr_sets: list of lists of tuples of two ints
+        The threshold values of each set, in the format of thr_values.
+    """
+
+    thr_sets = []
+    for grid in text.split(";"):
+        if grid.strip() != "":
+            channels = [[tuple(int(v) for v in r.split("-")) for r in channel.split("|")] for channel in grid.split(",")]
+            thr_sets += [list(thr_values) for thr_values in product(*channels)]
+    return thr_sets
+
+def threshold_label(thr_values: list) -> str:
+    """A short name for a threshold set, e. g. "R103-255_G115-255_B60-255"."""
+
+    return "_".join("{c}{low}-{high}".format(c = c, low = low, high = high) for c, (low, high) in zip("RGB", thr_values))
+
+def threshold_bits(planes: list, thr_sets: list) -> np.ndarray:
+    """Compute the masks of up to 64 threshold sets at once, as one bit per set in an unsigned integer array.
+
+    Parameters
+    ----------
+    planes: list of numpy 2D arrays
+        One plane per channel.
+    thr_sets: list of lists of tuples of two ints
+        Up to 64 threshold sets, in the format of thr_values.
+    
+    Returns
+    -------
+    bits: numpy 2D array of uint8, uint16, uint32 or uint64
+        The bit s of a pixel is set when the pixel is in every range of the set s. The type is the smallest one with a
+        bit per set.
+    
+    Note
+    ----
+    For 8 and 16 bits unsigned planes, each channel is turned into bits with one lookup in a table of the bits of every
+    value, so the cost does not depend on the number of sets.
+    """
+
+    dtype = next(t for t in (np.uint8, np.uint16, np.uint32, np.uint64) if np.iinfo(t).bits >= len(thr_sets))
+    bits = np.empty(planes[0].shape, dtype = dtype)
+    channel_bits = np.empty(planes[0].shape, dtype = dtype)
+    for c, p in enumerate(planes[:len(thr_sets[0])]):
+        if p.dtype in (np.uint8, np.uint16):
+            table = np.zeros(np.iinfo(p.dtype).max + 1, dtype = dtype)
+            for s, thr_values in enumerate(thr_sets):
+                low, high = thr_values[c]
+                table[max(low + 1, 0):max(high, 0)] |= dtype(1 << s)
+            np.take(table, p, out = channel_bits)
+        else:
+            channel_bits.fill(0)
+            for s, thr_values in enumerate(thr_sets):
+                low, high = thr_values[c]
+                channel_bits |= ((p > low) & (p < high)).astype(dtype) << dtype(s)
+        if c == 0:
+            bits[...] = channel_bits
+        else:
+            np.bitwise_and(bits, channel_bits, out = bits)
+    return bits
+
+BIT_TABLE = ((np.arange(1 << 16)[:, None] >> np.arange(16)) & 1).astype(np.int64) # Bits of every 16 bits value
+
+def bit_counts(bits: np.ndarray, n_sets: int) -> np.ndarray:
+    """Count the pixels of each set of threshold_bits, with one histogram per 16 sets."""
+
+    counts = []
+    for shift in range(0, n_sets, 16):
+        codes = bits if bits.dtype.itemsize <= 2 else ((bits >> bits.dtype.type(shift)) & bits.dtype.type(0xFFFF)).astype(np.uint16)
+        counts.append(BIT_TABLE[:1 << np.iinfo(codes.dtype).bits].T @ np.bincount(codes.ravel(), minlength = 1 << np.iinfo(codes.dtype).bits))
+    return np.concatenate(counts)[:n_sets]
+
+def sweep_image(state: dict, thr_sets: list) -> dict:
+    """Threshold an image read by read_image with many threshold sets, its planes being read only once.
+
+    Parameters
+    ----------
+    state: dict
+        The image read by read_image.
+    thr_sets: list of lists of tuples of two ints
+        The threshold sets, in the format of thr_values.
+    
+    Returns
+    -------
+    state: dict
+        The same state, whose planes are replaced by the bits of the sets ("bits", a list of arrays for each group of 64
+        sets, see threshold_bits) and by the number of pixels of each set ("counts").
+    """
+
+    planes = state["planes"]
+    with METRICS.measure("numpy.threshold_bits", planes[0].nbytes * len(planes)):
+        state["bits"] = [threshold_bits(planes, thr_sets[i:i + 64]) for i in range(0, len(thr_sets), 64)]
+        state["counts"] = np.concatenate([bit_counts(bits, len(thr_sets[64 * i:64 * i + 64])) for i, bits in enumerate(state["bits"])])
+    state["pixels"] = planes[0].size
+    state["planes"] = state["stack"] = None
+    return state
+
+def sweep_mask(state: dict, s: int) -> np.ndarray:
+    """The uint8 mask of the set s of an image thresholded by sweep_image, in a buffer of BUFFERS."""
+
+    bits = state["bits"][s // 64]
+    mask = BUFFERS.take(bits.shape)
+    np.multiply((bits >> bits.dtype.type(s % 64)) & bits.dtype.type(1), 255, out = mask, casting = "unsafe")
+    return mask
+
+def tileGen(image, thr_values: list, tile_size: int, pipeline: list = None):
+    """Create a generator of thresholded tiles, reading only one tile per channel at a time.
+
+    Parameters
+    ----------
+    image:  omero.gateway._ImageWrapper
+        Original image to process.
+    thr_values: list of tuples of two ints
+        RGB threshold values mandatory for the example process.
+    tile_size: int
+        Width and height of the tiles (the tiles on the right and bottom edges may be smaller).
+    pipeline: list of tuples
+        Optional kernels computing the mask instead of the RGB threshold, see parse_kernels. The morphology kernels see
+        the edges of the tiles as background.
+    
+    Yields
+    ------
+    (z, t, tile, mask): tuple
+        The plane indexes, the tile as (x, y, width, height) and its uint8 mask (a view on a reused buffer).
+    """
+
+    sizeX = image.getSizeX()
+    sizeY = image.getSizeY()
+    sizeC = image.getSizeC()
+    tiles = []
+    for y in range(0, sizeY, tile_size):
+        for x in range(0, sizeX, tile_size):
+            tiles.append((x, y, min(tile_size, sizeX - x), min(tile_size, sizeY - y)))
+    ztTileList = []
+    for z in range(image.getSizeZ()):
+        for t in range(image.getSizeT()):
+            for tile in tiles:
+                ztTileList.append((z, t, tile))
+
+    zctTileList = [(z, c, t, tile) for z, t, tile in ztTileList for c in range(sizeC)]
+    mask = np.empty((min(tile_size, sizeY), min(tile_size, sizeX)), dtype = np.uint8)
+    buffer = np.empty(mask.shape, dtype = np.uint8)
+    channel_tiles = []
+    i = 0
+    for p in image.getPrimaryPixels().getTiles(zctTileList):
+        channel_tiles.append(p)
+        if len(channel_tiles) == sizeC:
+            z, t, tile = ztTileList[i]
+            height, width = p.shape
+            if pipeline is None:
+                with METRICS.measure("numpy.threshold_mask", p.nbytes * sizeC):
+                    tile_mask = threshold_mask(channel_tiles, thr_values, mask[:height, :width], buffer[:height, :width])
+            else:
+                with METRICS.measure("numpy.kernels", p.nbytes * sizeC):
+                    tile_mask = run_kernels(np.stack(channel_tiles)[:, np.newaxis], pipeline, 1, mask[np.newaxis, :height, :width])[0]
+            yield z, t, tile, tile_mask
+            channel_tiles = []
+            i += 1
+
+def create_image_uint8(conn: BlitzGateway, image_name: str, sizeX: int, sizeY: int, sizeZ: int, sizeC: int, sizeT: int, channel_names: list = None):
+    """Create an empty image with uint8 pixels, whatever the pixels type of the original image.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    image_name: str
+        The name of the new image.
+    sizeX, sizeY, sizeZ, sizeC, sizeT: int
+        The dimensions of the new image.
+    channel_names: list of str
+        Optional names of the channels, e. g. the labels of the channels of the original image.
+    
+    Returns
+    -------
+    image: omero.gateway._ImageWrapper
+        The new image, whose pixels are to be written with a raw pixels store.
+    """
+
+    if "uint8" not in PIXELS_TYPES:
+        PIXELS_TYPES["uint8"] = conn.getQueryService().findByQuery("from PixelsType as p where p.value='uint8'", None, conn.SERVICE_OPTS).getId().getValue()
+    image_id = conn.getPixelsService().createImage(
+        sizeX, sizeY, sizeZ, sizeT, list(range(sizeC)), omero.model.PixelsTypeI(PIXELS_TYPES["uint8"], False), image_name, None,
+        conn.SERVICE_OPTS).getValue()
+    image = conn.getObject("Image", image_id)
+    if channel_names:
+        logical_channels = []
+        for channel, name in zip(image.getChannels(noRE = True), channel_names):
+            logical_channel = channel.getLogicalChannel()._obj
+            logical_channel.setName(rstring(name))
+            logical_channels.append(logical_channel)
+        conn.getUpdateService().saveArray(logical_channels, conn.SERVICE_OPTS)
+    return image
+
+def create_image_tiled(conn: BlitzGateway, image_or, image_name: str, thr_values: list, tile_size: int, pipeline: list = None):
+    """Create the thresholded image tile by tile, so that the memory used depends on the tile size and not on the image size.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    image_or: omero.gateway._ImageWrapper
+        Original image to process.
+    image_name: str
+        The name of the processed image.
+    thr_values: list of tuples of two ints
+        RGB threshold values.
+    tile_size: int
+        Width and height of the tiles.
+    pipeline: list of tuples
+        Optional kernels computing the mask instead of the RGB threshold, see parse_kernels.
+    
+    Returns
+    -------
+    image: omero.gateway._ImageWrapper
+        The processed image.
+    """
+
+    sizeC = image_or.getSizeC()
+    image = create_image_uint8(conn, image_name, image_or.getSizeX(), image_or.getSizeY(), image_or.getSizeZ(), sizeC, image_or.getSizeT(), image_or.getChannelLabels())
+
+    # Stream the tiles into the new pixels
+    pixels_id = image.getPixelsId()
+    max_value = 0
+    raw_pixels_store = METRICS.wrap(conn.c.sf.createRawPixelsStore(), "rawPixelsStore") # Not the one of the connection, which reads the tiles
+    try:
+        raw_pixels_store.setPixelsId(pixels_id, True, conn.SERVICE_OPTS)
+        for z, t, (x, y, width, height), mask in tileGen(image_or, thr_values, tile_size, pipeline):
+            buffer = mask.tobytes() # uint8, so no conversion nor byte swapping
+            for c in range(sizeC):
+                raw_pixels_store.setTile(buffer, z, c, t, x, y, width, height, conn.SERVICE_OPTS)
+            max_value = max(max_value, int(mask.max()))
+    finally:
+        raw_pixels_store.close(conn.SERVICE_OPTS)
+
+    for c in range(sizeC):
+        conn.getPixelsService().setChannelGlobalMinMax(pixels_id, c, 0.0, float(max_value), conn.SERVICE_OPTS)
+    return image
+
+def read_stack(image_or, allocate = np.empty) -> np.ndarray:
+    """Read the planes of an image into one array, the plane (z, c, t) being stack[c, z * sizeT + t].
+
+    Parameters
+    ----------
+    image_or: omero.gateway._ImageWrapper
+        Original image to process.
+    allocate: function
+        Creates the array from its shape and dtype, e. g. as a memory-mapped file (see PixelCache).
+    
+    Returns
+    -------
+    stack: numpy 4D array
+        The (C, Z * T, Y, X) planes.
+    """
+
+    sizeZ = image_or.getSizeZ()
+    sizeC = image_or.getSizeC()
+    sizeT = image_or.getSizeT()
+    zctList = []
+    for z in range(sizeZ):
+        for c in range(sizeC):
+            for t in range(sizeT):
+                zctList.append((z,c,t))
+    stack = None
+    for (z, c, t), p in zip(zctList, image_or.getPrimaryPixels().getPlanes(zctList)):
+        if stack is None:
+            stack = allocate((sizeC, sizeZ * sizeT) + p.shape, p.dtype)
+        stack[c, z * sizeT + t] = p
+    return stack
+
+def read_kv(image_or) -> list:
+    """The Key:Value pairs of an image, from its client map annotation (the one edited in OMERO.web).
+
+    Parameters
+    ----------
+    image_or: omero.gateway._ImageWrapper
+        Original image.
+    
+    Returns
+    -------
+    kv: list of lists of two strings
+        The [key, value] pairs, empty if the image has no client map annotation.
+    """
+
+    map_ann = image_or.getAnnotation(ns = omero.constants.metadata.NSCLIENTMAPANNOTATION)
+    if map_ann is None:
+        return []
+    return [[anno.name, anno.value] for anno in map_ann.getMapValue()]
+
+def read_image(image_or, copy_kv: bool = True, pixel_cache: PixelCache = None) -> dict:
+    """Read everything needed from an image to process it, i.e. its planes and its Key:Value pairs.
+
+    Parameters
+    ----------
+    image_or: omero.gateway._ImageWrapper
+        Original image to process.
+    copy_kv: bool
+        Also read the Key:Value pairs, to copy them to the processed image.
+    pixel_cache: PixelCache
+        Optional local cache of the planes, read only views on it being returned.
+    
+    Returns
+    -------
+    state: dict
+        The original image ("image"), its sizes ("sizeZ", "sizeC", "sizeT"), its channel labels ("channels"), its planes
+        ("stack", see read_stack, and "planes", the list of its channels) and its Key:Value pairs ("kv", None if copy_kv
+        is False).
+    """
+
+    kv = read_kv(image_or) if copy_kv == True else None
+    stack = read_stack(image_or) if pixel_cache is None else pixel_cache.stack(image_or._conn, image_or)
+    return {"image": image_or, "sizeZ": image_or.getSizeZ(), "sizeC": image_or.getSizeC(), "sizeT": image_or.getSizeT(),
+            "channels": image_or.getChannelLabels(), "stack": stack, "planes": list(stack), "kv": kv}
+
+def write_image(conn: BlitzGateway, state: dict, image_name: str, parent_dataset):
+    """Create the processed uint8 image from the mask, with the channel labels and Key:Value pairs of the original one.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    state: dict
+        The image read by read_image and thresholded by threshold_image.
+    image_name: str
+        The name of the processed image.
+    parent_dataset: omero.gateway._DatasetWrapper
+        Parent dataset.
+    
+    Returns
+    -------
+    image_id: int
+        The ID of the processed image.
+    
+    Note
+    ----
+    Every channel of a (z, t) holds the same mask, so its bytes are made once and written as they are through a raw pixels
+    store (uint8 pixels need no conversion nor byte swapping), then the mask buffer is given back to BUFFERS.
+    """
+
+    mask = state["mask"]
+    sizeY, sizeX = mask.shape[-2:]
+    image = create_image_uint8(conn, image_name, sizeX, sizeY, state["sizeZ"], state["sizeC"], state["sizeT"], state["channels"])
+    pixels_id = image.getPixelsId()
+    min_value, max_value = float(mask.min()), float(mask.max())
+
+    raw_pixels_store = METRICS.wrap(conn.c.sf.createRawPixelsStore(), "rawPixelsStore")
+    try:
+        raw_pixels_store.setPixelsId(pixels_id, True, conn.SERVICE_OPTS)
+        for z in range(state["sizeZ"]):
+            for t in range(state["sizeT"]):
+                data = mask[z * state["sizeT"] + t].tobytes()
+                for c in range(state["sizeC"]):
+                    raw_pixels_store.setPlane(data, z, c, t, conn.SERVICE_OPTS)
+    finally:
+        raw_pixels_store.close(conn.SERVICE_OPTS)
+        BUFFERS.give(mask)
+        state["mask"] = None
+    for c in range(state["sizeC"]):
+        conn.getPixelsService().setChannelGlobalMinMax(pixels_id, c, min_value, max_value, conn.SERVICE_OPTS)
+    link_image(conn, image, state["kv"], parent_dataset)
+    return image.getId()
+
+def link_image(conn: BlitzGateway, image, kv: list, parent_dataset):
+    """Add Key:Value pairs to a processed image and link it to its dataset.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    image: omero.gateway._ImageWrapper
+        The processed image.
+    kv: list of [Key, Value]
+        The Key:Value pairs of the original image, or None not to add any.
+    parent_dataset: omero.gateway._DatasetWrapper
+        Parent dataset.
+    """
+
+    # Copy K:V pairs
+    if kv is not None:
+        map_ann = omero.gateway.MapAnnotationWrapper(conn)
+        map_ann.setNs(omero.constants.metadata.NSCLIENTMAPANNOTATION)
+        map_ann.setValue(kv)
+        map_ann.save()
+        image.linkAnnotation(map_ann)
+
+    # Link image to dataset
+    link = omero.model.DatasetImageLinkI()
+    link.parent = omero.model.DatasetI(parent_dataset.getId(), False)
+    link.child = omero.model.ImageI(image.getId(), False)
+    conn.getUpdateService().saveAndReturnObject(link)
+
+def mask_rle(mask: np.ndarray) -> np.ndarray:
+    """Run-length encode a mask, row by row.
+
+    Parameters
+    ----------
+    mask: numpy array
+        The mask, 0 outside and anything else inside.
+    
+    Returns
+    -------
+    counts: numpy 1D array of uint32
+        The lengths of the runs of the flattened mask (in the C order), alternating between outside and inside and starting with outside
+        (the first run is 0 long when the first pixel is inside).
+    """
+
+    flat = mask.ravel() != 0
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.astype(np.uint32)
+
+def write_mask_roi(conn: BlitzGateway, state: dict, image_name: str, parent_dataset = None):
+    """Save the mask as a mask ROI on the original image, one bit per pixel and cropped to the thresholded pixels.
 
     Parameters
     ----------
-    image:  omero.gateway._ImageWrapper
-        Original image to process.start_time = time()
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    state: dict
+        The image read by read_image and thresholded by threshold_image.
+    image_name: str
+        The name of the ROI.
+    parent_dataset: omero.gateway._DatasetWrapper
+        Not used, the ROI belongs to the original image.
+    
+    Returns
+    -------
+    roi_id: int
+        The ID of the ROI, None if no ROI was saved.
+    
+    Note
+    ----
+    The ROI has one mask shape per (z, t) with kept pixels. The shape of an image without Z nor T stacks has no Z nor T,
+    so it is shown on every plane. No ROI is saved when no pixel is kept.
+    """
+
+    mask = state["mask"]
+    roi_id = None
+    roi = omero.model.RoiI()
+    roi.setName(rstring(image_name))
+    roi.setImage(omero.model.ImageI(state["image"].getId(), False))
+    for i, plane in enumerate(mask):
+        rows = np.flatnonzero(plane.any(axis = 1))
+        cols = np.flatnonzero(plane.any(axis = 0))
+        if len(rows) == 0:
+            continue
+        crop = plane[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        shape = omero.model.MaskI()
+        shape.setX(rdouble(float(cols[0])))
+        shape.setY(rdouble(float(rows[0])))
+        shape.setWidth(rdouble(float(crop.shape[1])))
+        shape.setHeight(rdouble(float(crop.shape[0])))
+        shape.setBytes(np.packbits(crop != 0).tobytes())
+        shape.setTextValue(rstring(image_name))
+        if len(mask) > 1:
+            shape.setTheZ(rint(i // state["sizeT"]))
+            shape.setTheT(rint(i % state["sizeT"]))
+        roi.addShape(shape)
+    if len(roi.copyShapes()) > 0:
+        roi_id = conn.getUpdateService().saveAndReturnObject(roi, conn.SERVICE_OPTS).getId().getValue()
+    BUFFERS.give(mask)
+    state["mask"] = None
+    return roi_id
+
+def write_mask_rle(conn: BlitzGateway, state: dict, image_name: str, parent_dataset = None):
+    """Attach the run-length encoded mask (see mask_rle) to the original image as a JSON file annotation.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    state: dict
+        The image read by read_image and thresholded by threshold_image.
+    image_name: str
+        The name of the file, to which ".rle.json" is added.
+    parent_dataset: omero.gateway._DatasetWrapper
+        Not used, the file belongs to the original image.
+    
+    Returns
+    -------
+    file_ann_id: int
+        The ID of the file annotation.
+
+    Note
+    ----
+    The size of the mask is [sizeY, sizeX], or [sizeZ, sizeT, sizeY, sizeX] for an image with a Z or a T stack.
+    """
+
+    mask = state["mask"]
+    size = list(mask.shape[1:]) if len(mask) == 1 else [state["sizeZ"], state["sizeT"]] + list(mask.shape[1:])
+    rle = {"size": size, "order": "C", "counts": mask_rle(mask).tolist(), "pixels": int(np.count_nonzero(mask))}
+    BUFFERS.give(mask)
+    state["mask"] = None
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, image_name + ".rle.json")
+        with open(path, "w") as f:
+            json.dump(rle, f, separators = (",", ":"))
+        file_ann = conn.createFileAnnfromLocalFile(path, mimetype = "application/json", ns = "ImHorPhen/threshold_rle")
+    link = omero.model.ImageAnnotationLinkI() # Through conn: state["image"] may belong to the connection of another thread
+    link.setParent(omero.model.ImageI(state["image"].getId(), False))
+    link.setChild(omero.model.FileAnnotationI(file_ann.getId(), False))
+    conn.getUpdateService().saveObject(link, conn.SERVICE_OPTS)
+    return file_ann.getId()
+
+MASK_OUTPUTS = {"Images": write_image, "Mask ROIs": write_mask_roi, "RLE annotations": write_mask_rle} # Output mode: function writing a thresholded image
+
+def output_container(conn: BlitzGateway, object_type: str, object_id: int, img_id: int) -> tuple:
+    """The dataset or project to which the outputs of a whole run are attached.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    object_type: str
+        The type of the processed object, e. g. Image, Dataset or Project.
+    object_id: int
+        The ID of the processed object.
+    img_id: int
+        The ID of one of the processed images, whose dataset is used when the processed object is an image.
+    
+    Returns
+    -------
+    (type, id): tuple
+        "Dataset" or "Project" and the ID, or (None, None) if the image is in no dataset.
+    """
+
+    if object_type in ("Dataset", "Project"):
+        return object_type, object_id
+    dataset = conn.getObject("Image", img_id).getParent()
+    if dataset is None:
+        return None, None
+    return "Dataset", dataset.getId()
+
+def link_annotation(conn: BlitzGateway, type: str, id: int, annotation):
+    """Link an annotation to an object, in one call which also saves the annotation if it is new.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    type: str
+        The type of the object, e. g. Dataset or Project. If None, the annotation is only saved.
+    id: int
+        The ID of the object.
+    annotation: omero.model.Annotation
+        The annotation, new or an unloaded reference.
+    
+    Returns
+    -------
+    annotation: omero.model.Annotation
+        The saved annotation.
+    """
+
+    if type is None:
+        return conn.getUpdateService().saveAndReturnObject(annotation, conn.SERVICE_OPTS)
+    link = getattr(omero.model, type + "AnnotationLinkI")()
+    link.setParent(getattr(omero.model, type + "I")(id, False))
+    link.setChild(annotation)
+    return conn.getUpdateService().saveAndReturnObject(link, conn.SERVICE_OPTS).getChild()
+
+def write_measurements(conn: BlitzGateway, rows: dict, target_type: str, target_id: int, table_name: str):
+    """Save the measurements of many images as one OMERO.table attached to a dataset or a project.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    rows: dict
+        The (name, channel labels, stats) of each image, by image ID, stats being given by measure_mask.
+    target_type: str
+        "Dataset" or "Project", see output_container.
+    target_id: int
+        The ID of the dataset or project.
+    table_name: str
+        The name of the table file.
+    
+    Returns
+    -------
+    file_ann: omero.model.FileAnnotationI
+        The file annotation of the table.
+    
+    Note
+    ----
+    The table has one row per image, written with a single addData. The mean columns are named by the channel labels
+    when all the images have the same, by the channel indexes otherwise (NaN for the channels an image does not have).
+    """
+
+    img_ids = sorted(rows)
+    labels = rows[img_ids[0]][1]
+    if any(rows[img][1] != labels for img in img_ids):
+        labels = ["channel {c}".format(c = c) for c in range(max(len(rows[img][2]["means"]) for img in img_ids))]
+    columns = [omero.grid.ImageColumn("Image", "", img_ids),
+               omero.grid.StringColumn("Image name", "", max(1, max(len(rows[img][0].encode()) for img in img_ids)), [rows[img][0] for img in img_ids]), # A size of 0 is rejected
+               omero.grid.LongColumn("Pixels", "Pixels kept", [rows[img][2]["pixels"] for img in img_ids]),
+               omero.grid.DoubleColumn("Area fraction", "Fraction of the pixels kept", [rows[img][2]["fraction"] for img in img_ids])]
+    for c, label in enumerate(labels):
+        means = [rows[img][2]["means"][c] if c < len(rows[img][2]["means"]) else float("nan") for img in img_ids]
+        columns.append(omero.grid.DoubleColumn("Mean {label}".format(label = label), "Mean inside the mask", means))
+
+    resources = conn.c.sf.sharedResources()
+    repository_id = resources.repositories().descriptions[0].getId().getValue()
+    table = resources.newTable(repository_id, table_name, conn.SERVICE_OPTS)
+    try:
+        table.initialize(columns)
+        table.addData(columns)
+        original_file = table.getOriginalFile()
+    finally:
+        table.close()
+
+    file_ann = omero.model.FileAnnotationI()
+    file_ann.setFile(omero.model.OriginalFileI(original_file.getId().getValue(), False))
+    file_ann.setNs(rstring(MEASURE_NS))
+    return link_annotation(conn, target_type, target_id, file_ann)
+
+def raw_array(buffer: bytes, pixels_type: str, sizeY: int, sizeX: int) -> np.ndarray:
+    """Convert a plane or a tile of the raw pixels store into an array, unpacking the bits of the bit images."""
+
+    if pixels_type == "bit":
+        return np.unpackbits(np.frombuffer(buffer, dtype = np.uint8))[:sizeY * sizeX].reshape(sizeY, sizeX)
+    return np.frombuffer(buffer, dtype = np.dtype(NUMPY_TYPES[pixels_type]).newbyteorder(">")).reshape(sizeY, sizeX)
+
+def read_preview(conn: BlitzGateway, image, size: int) -> list:
+    """Read the middle plane of an image at low resolution, from the smallest pyramid level that is large enough if the
+    image has a pyramid, then by taking one pixel every few rows and columns. Without a pyramid, only these rows are
+    read, one tile each, instead of the full resolution plane.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    image: omero.gateway._ImageWrapper
+        The image.
+    size: int
+        The maximum width and height of the planes.
+    
+    Returns
+    -------
+    planes: list of numpy 2D arrays
+        The planes of the channels, at the middle Z and the first T.
+    """
+
+    sizeX = image.getSizeX()
+    sizeY = image.getSizeY()
+    pixels_type = image.getPixelsType()
+    z = image.getSizeZ() // 2
+    raw_pixels_store = METRICS.wrap(conn.c.sf.createRawPixelsStore(), "rawPixelsStore")
+    try:
+        raw_pixels_store.setPixelsId(image.getPixelsId(), False, conn.SERVICE_OPTS)
+        levels = raw_pixels_store.getResolutionLevels(conn.SERVICE_OPTS)
+        if levels > 1:
+            # The resolution descriptions go from the full size down, the resolution levels from the smallest up
+            descriptions = raw_pixels_store.getResolutionDescriptions(conn.SERVICE_OPTS)
+            i = max([0] + [i for i, d in enumerate(descriptions) if max(d.sizeX, d.sizeY) >= size])
+            raw_pixels_store.setResolutionLevel(levels - 1 - i, conn.SERVICE_OPTS)
+            sizeX, sizeY = descriptions[i].sizeX, descriptions[i].sizeY
+        step = -(-max(sizeX, sizeY) // size)
+        if levels > 1 or step == 1:
+            planes = [raw_array(raw_pixels_store.getPlane(z, c, 0, conn.SERVICE_OPTS), pixels_type, sizeY, sizeX)[::step, ::step]
+                      for c in range(image.getSizeC())]
+        else:
+            planes = [np.stack([raw_array(raw_pixels_store.getTile(z, c, 0, 0, y, sizeX, 1, conn.SERVICE_OPTS), pixels_type, 1, sizeX)[0, ::step]
+                                for y in range(0, sizeY, step)])
+                      for c in range(image.getSizeC())]
+    finally:
+        raw_pixels_store.close(conn.SERVICE_OPTS)
+    return planes
+
+def preview_image(conn: BlitzGateway, image_id: int, thr_values: list, size: int = 256, cell_size: int = 128, pipeline: list = None) -> tuple:
+    """Threshold an image at low resolution, see read_preview.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    image_id: int
+        The ID of the image.
     thr_values: list of tuples of two ints
-        RGB threshold values mandatory for the example process.
-    zctList: list
-        Not really used here, to get planes from stacks.
+        RGB threshold values.
+    size: int
+        The maximum width and height of the thresholded planes.
+    cell_size: int
+        The maximum width and height of the cell of the image in a contact sheet.
+    pipeline: list of tuples
+        Optional kernels computing the mask instead of the RGB threshold, see parse_kernels.
+    
+    Returns
+    -------
+    (name, coverage, cell): tuple
+        The name of the image, the fraction of its pixels kept and its cell: a (3, Y, X) uint8 array of the image, darker
+        where the pixels are not kept.
     """
 
-    planes = image.getPrimaryPixels().getPlanes(zctList)
-    i = 0
-    for p in planes:
-        # Here you can add any code you want.
-        range = np.logical_and(thr_values[i][0] < p[:,:], p[:,:] < thr_values[i][1])
-        if i == 0: red_range = range
-        elif i == 1: green_range = range
-        else: blue_range = range
-        i += 1
-    valid_range = np.logical_and(red_range, green_range, blue_range)
-
-    planes = image.getPrimaryPixels().getPlanes(zctList)
-    for p in planes:
-        p[valid_range] = 255
-        p[np.logical_not(valid_range)] = 0
-        yield p
-
-def process_image(image_id: int, image_name: str, parent_dataset):
+    image = conn.getObject("Image", image_id)
+    planes = read_preview(conn, image, size)
+    if pipeline is None:
+        with METRICS.measure("numpy.threshold_mask", planes[0].nbytes * len(planes)):
+            mask = threshold_mask(planes, thr_values)
+    else:
+        with METRICS.measure("numpy.kernels", planes[0].nbytes * len(planes)):
+            mask = run_kernels(np.stack(planes)[:, np.newaxis], pipeline)[0]
+    coverage = np.count_nonzero(mask) / mask.size
+
+    step = -(-max(mask.shape) // cell_size)
+    kept = mask[::step, ::step] != 0
+    cell = []
+    for p in (planes * 3)[:3]: # Grey images are shown in the three colours
+        p = p[::step, ::step].astype(np.float32)
+        low, high = p.min(), p.max()
+        p = (p - low) * (255 / (high - low)) if high > low else np.zeros_like(p)
+        cell.append(np.where(kept, p, p / 4).astype(np.uint8))
+    return image.getName(), coverage, np.stack(cell)
+
+def write_contact_sheet(conn: BlitzGateway, cells: list, image_name: str, parent_dataset = None, cell_size: int = 128):
+    """Create an RGB image of the cells of preview_image, on a grid.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    cells: list of numpy 3D arrays
+        The cells, in the reading order of the grid.
+    image_name: str
+        The name of the contact sheet.
+    parent_dataset: int
+        The ID of the dataset of the contact sheet, in no dataset if None.
+    cell_size: int
+        The width and height of the cells of the grid.
+    
+    Returns
+    -------
+    image: omero.gateway._ImageWrapper
+        The contact sheet.
+    """
+
+    columns = int(np.ceil(np.sqrt(len(cells))))
+    rows = -(-len(cells) // columns)
+    sheet = np.zeros((3, rows * cell_size, columns * cell_size), dtype = np.uint8)
+    for i, cell in enumerate(cells):
+        y, x = (i // columns) * cell_size, (i % columns) * cell_size
+        sheet[:, y:y + cell.shape[1], x:x + cell.shape[2]] = cell
+    image = create_image_uint8(conn, image_name, sheet.shape[2], sheet.shape[1], 1, 3, 1, ["Red", "Green", "Blue"])
+    raw_pixels_store = METRICS.wrap(conn.c.sf.createRawPixelsStore(), "rawPixelsStore")
+    try:
+        raw_pixels_store.setPixelsId(image.getPixelsId(), True, conn.SERVICE_OPTS)
+        for c in range(3):
+            raw_pixels_store.setPlane(sheet[c].tobytes(), 0, c, 0, conn.SERVICE_OPTS)
+    finally:
+        raw_pixels_store.close(conn.SERVICE_OPTS)
+    for c in range(3):
+        conn.getPixelsService().setChannelGlobalMinMax(image.getPixelsId(), c, 0.0, 255.0, conn.SERVICE_OPTS)
+    if parent_dataset is not None:
+        link = omero.model.DatasetImageLinkI()
+        link.setParent(omero.model.DatasetI(parent_dataset, False))
+        link.setChild(omero.model.ImageI(image.getId(), False))
+        conn.getUpdateService().saveObject(link, conn.SERVICE_OPTS)
+    return image
+
+def process_image(conn: BlitzGateway, image_id: int, image_name: str, parent_dataset, thr_values: list, copy_kv: bool = True, tile_size: int = 0, output: str = "Images",
+                  pipeline: list = None, processes: int = 1, pixel_cache: PixelCache = None):
     """Get an image with its info and adding info to the processed image.
 
     Parameters
     ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
     image_id: int
         The ID of the image to process.
     image_name: str
         The name of the image processed according to the user input.
-    parent_dataset: omero.gateway._ImageWrapper
+    parent_dataset: omero.gateway._DatasetWrapper
         Parent dataset.
+    thr_values: list of tuples of two ints
+        RGB threshold values.
+    copy_kv: bool
+        Copy the Key:Value pairs of the original image to the processed one.
+    tile_size: int
+        If not 0, process the image tile by tile with tiles of this size instead of loading full planes (only for the
+        "Images" output).
+    output: str
+        How the mask is saved, a key of MASK_OUTPUTS: a new image, a mask ROI or a run-length encoded file annotation on
+        the original image.
+    pipeline: list of tuples
+        Optional kernels computing the mask instead of the RGB threshold, see parse_kernels.
+    processes: int
+        The number of processes running the kernels, see run_kernels (not for the tiles).
+    pixel_cache: PixelCache
+        Optional local cache of the planes (not for the tiles).
+    
+    Returns
+    -------
+    result_id: int
+        The ID of the result (see MASK_OUTPUTS), None if there is none.
+    
+    Note
+    ----
+    The read, threshold and write steps are also available separately (read_image, threshold_image and write_image) to
+    overlap them between images, see pipeline_images.
     """
 
-    # Getting original image info
     image_or = conn.getObject("Image", image_id)
-    sizeZ = image_or.getSizeZ()
-    sizeC = image_or.getSizeC()
-    sizeT = image_or.getSizeT()
-    clist = range(sizeC)
-    zctList = []
-    for z in range(sizeZ):
-        for c in clist:
-            for t in range(sizeT):
-                zctList.append((z,c,t))
+    if tile_size > 0 and output == "Images":
+        image = create_image_tiled(conn, image_or, image_name, thr_values, tile_size, pipeline)
+        kv = read_kv(image_or) if copy_kv == True else None
+        link_image(conn, image, kv, parent_dataset)
+        return image.getId()
+    state = read_image(image_or, copy_kv == True and output == "Images", pixel_cache)
+    threshold_image(state, thr_values, pipeline, processes)
+    return MASK_OUTPUTS[output](conn, state, image_name, parent_dataset)
 
-    # Create the processed image
-    image = conn.createImageFromNumpySeq(
-        planeGen(image_or, thr_values, zctList), image_name, sizeZ = sizeZ, sizeC = sizeC, sizeT = sizeT,
-        sourceImageId = image_id, channelList = clist)
+def report_progress(done: int, total: int, img: int, errors: dict):
+    """Print one line for each image processed, with its error message if it failed."""
+
+    print("[{done}/{total}] Image {img}: {status}".format(done = done, total = total, img = img, status = errors.get(img, "done")))
+
+def report_results(results: dict, errors: dict, result_type: str = None, skipped: dict = None) -> str:
+    """One line per image, in the order of their IDs, for the "Images processed" output of the script.
+
+    Parameters
+    ----------
+    results: dict
+        The result of each image processed, by image ID: its ID, or None if there is none (e. g. an empty mask ROI).
+    errors: dict
+        The error message of each failed image, by image ID.
+    result_type: str
+        The type of the results, e. g. Image or Roi (see RESULT_TYPES), None if they have no ID (e. g. measurements).
+    skipped: dict
+        The result of each image skipped since it was already processed, by image ID.
     
-    # Copy K:V pairs
-    if inputs["Copy past Key:Value pair(s)"] == True:
-        KV_pairs = []
-        for anno in image_or.getAnnotation().getMapValue():
-            KV_pairs.append([anno.name, anno.value])
-        map_ann = omero.gateway.MapAnnotationWrapper(conn)
-        map_ann.setNs(omero.constants.metadata.NSCLIENTMAPANNOTATION)
-        map_ann.setValue(KV_pairs)
-        map_ann.save()
-        image.linkAnnotation(map_ann)
+    Returns
+    -------
+    lines: str
+        "image ID: result type and ID", "done", "no result" or "failed: error message" for each image.
+    """
 
-    # Link image to dataset
-    link = omero.model.DatasetImageLinkI()
-    link.parent = omero.model.DatasetI(parent_dataset.getId(), False)
-    link.child = omero.model.ImageI(image.getId(), False)
-    conn.getUpdateService().saveAndReturnObject(link)
+    skipped = skipped or {}
+    lines = []
+    for img in sorted(set(results) | set(errors) | set(skipped)):
+        if img in errors:
+            status = "failed: " + errors[img]
+        else:
+            result = results[img] if img in results else skipped[img]
+            if result_type is None:
+                status = "done"
+            elif result is None:
+                status = "no result"
+            else:
+                status = "{type} {id}".format(type = result_type, id = result)
+            if img in skipped:
+                status += " (already processed)"
+        lines.append("{img}: {status}".format(img = img, status = status))
+    return "\n".join(lines)
+
+def process_images(client, conn: BlitzGateway, function, img_id_list: list, workers: int = 1) -> dict:
+    """Apply a processing function to a list of images, sequentially or with several workers.
+
+    Parameters
+    ----------
+    client: omero.scripts.client object
+        The script client, whose session is joined by each worker.
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection, used when there is only one worker.
+    function: callable
+        Function called as function(conn, image_id) for each image.
+    img_id_list: list of ints
+        The IDs of the images to process.
+    workers: int
+        Number of images processed at the same time. Each worker opens its own session joined from the script session key,
+        since a BlitzGateway must not be shared between threads.
+    
+    Returns
+    -------
+    results: dict
+        What the function returned for each image processed, by image ID.
+    errors: dict
+        The error message of each failed image, by image ID.
+    """
+
+    results = {}
+    errors = {}
+    total = len(img_id_list)
+    if workers <= 1:
+        for done, img in enumerate(img_id_list, 1):
+            try:
+                results[img] = function(conn, img)
+            except Exception as e:
+                errors[img] = str(e)
+            report_progress(done, total, img, errors)
+        return results, errors
+
+    worker_data = local()
+    worker_clients = []
+    lock = Lock()
+
+    def work(img):
+        if not hasattr(worker_data, "conn"):
+            worker_client = omero.client(pmap = client.getPropertyMap())
+            worker_client.joinSession(client.getSessionId())
+            worker_data.conn = METRICS.instrument(BlitzGateway(client_obj = worker_client))
+            with lock:
+                worker_clients.append(worker_client)
+        return function(worker_data.conn, img)
+
+    try:
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            futures = {executor.submit(work, img): img for img in img_id_list}
+            for done, future in enumerate(as_completed(futures), 1):
+                img = futures[future]
+                if future.exception() is not None:
+                    errors[img] = str(future.exception())
+                else:
+                    results[img] = future.result()
+                report_progress(done, total, img, errors)
+    finally:
+        for worker_client in worker_clients:
+            worker_client.closeSession()
+    return results, errors
+
+def pipeline_images(client, conn: BlitzGateway, read, compute, write, img_id_list: list, depth: int = 1) -> dict:
+    """Process images in three overlapping stages, so that the next image is read and the previous one written while the
+    current one is computed.
+
+    Parameters
+    ----------
+    client: omero.scripts.client object
+        The script client, whose session is joined by the reading thread.
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection, used to write.
+    read: callable
+        Called as read(conn, image_id) in its own thread, returns the state of the image.
+    compute: callable
+        Called as compute(state) in its own thread, returns the new state.
+    write: callable
+        Called as write(conn, state) in the calling thread.
+    img_id_list: list of ints
+        The IDs of the images to process.
+    depth: int
+        The number of images waiting between two stages. The queues block when they are full, so at most 2 * depth + 3
+        images are in memory at once.
+    
+    Returns
+    -------
+    results: dict
+        What write returned for each image processed, by image ID.
+    errors: dict
+        The error message of each failed image, by image ID.
+    
+    Note
+    ----
+    The time per image gets close to the slowest stage instead of the sum of the three. The reading thread uses its own
+    connection, joined from the script session (a BlitzGateway must not be shared between threads).
+    """
+
+    to_compute = Queue(maxsize = depth)
+    to_write = Queue(maxsize = depth)
+    read_client = omero.client(pmap = client.getPropertyMap())
+    read_client.joinSession(client.getSessionId())
+    read_conn = METRICS.instrument(BlitzGateway(client_obj = read_client))
+
+    def read_stage():
+        for img in img_id_list:
+            try:
+                to_compute.put((img, read(read_conn, img), None))
+            except Exception as e:
+                to_compute.put((img, None, e))
+        to_compute.put(None)
+
+    def compute_stage():
+        while True:
+            item = to_compute.get()
+            if item is None:
+                break
+            img, state, error = item
+            if error is None:
+                try:
+                    state = compute(state)
+                except Exception as e:
+                    state, error = None, e
+            to_write.put((img, state, error))
+        to_write.put(None)
+
+    results = {}
+    errors = {}
+    total = len(img_id_list)
+    threads = [Thread(target = read_stage, daemon = True), Thread(target = compute_stage, daemon = True)]
+    try:
+        for thread in threads:
+            thread.start()
+        done = 0
+        while True:
+            item = to_write.get()
+            if item is None:
+                break
+            img, state, error = item
+            if error is None:
+                try:
+                    results[img] = write(conn, state)
+                except Exception as e:
+                    error = e
+            if error is not None:
+                errors[img] = str(error)
+            done += 1
+            report_progress(done, total, img, errors)
+    finally:
+        read_client.closeSession()
+    return results, errors
+
+def compile_scope(type: str, id, params) -> str:
+    """Compile the scope of a query on images "i" into an HQL condition.
+
+    Parameters
+    ----------
+    type: str
+        The type of the object, e. g. Image, Dataset or Project. An empty string means every image.
+    id: int or list of ints
+        The ID(s) of the object(s).
+    params: omero.sys.Parameters
+        The parameters of the query, to which the "ids" parameter is added.
+    
+    Returns
+    -------
+    condition: str
+        The HQL condition, or an empty string when there is no scope.
+    """
 
-    return
+    if type == "":
+        return ""
+    ids = id if isinstance(id, (list, tuple)) else [id]
+    params.map["ids"] = rlist([rlong(i) for i in ids])
+    if type == "Image":
+        return "i.id in (:ids)"
+    elif type == "Dataset":
+        return "i.id in (SELECT dil.child.id FROM DatasetImageLink dil WHERE dil.parent.id in (:ids))"
+    elif type == "Project":
+        return ("i.id in (SELECT dil.child.id FROM DatasetImageLink dil, ProjectDatasetLink pdl"
+                " WHERE dil.parent.id = pdl.child.id AND pdl.parent.id in (:ids))")
+    raise ValueError("Unknown object type {type}, expected Image, Dataset or Project".format(type = type))
 
-def filter_by_kv(conn, img_ids: list, key: str, value: str) -> list:
-    """Filter a given list of imags with a given key:value pair.
+def expand_to_image_ids(conn: BlitzGateway, type: str, id, page_size: int = 10000):
+    """Resolve images, datasets or projects to the IDs of their images, page by page.
 
     Parameters
     ----------
-    cconn: omero.gateway.BlitzGateway object
+    conn: omero.gateway.BlitzGateway object
         OMERO connection.
-    img_ids: list
-        The list of all image IDs to query.
-    key: str
-        Key to query.
-    value: str
-        Value to query.
+    type: str
+        The type of the object(s), e. g. Image, Dataset or Project. An empty string means every image.
+    id: int or list of ints
+        The ID(s) of the object(s).
+    page_size: int
+        The maximum number of image IDs per page.
+    
+    Yields
+    ------
+    img_ids: list of ints
+        The next page of image IDs, sorted and without duplicates.
+    
+    Note
+    ----
+    Each page is one projection over the link tables, starting after the last ID of the previous page (rather than at an
+    offset), so every page costs the same and only one page is in memory at a time.
+    """
+
+    q = conn.getQueryService()
+    last_id = -1
+    while True:
+        params = Parameters()
+        params.map = {"last": rlong(last_id)}
+        params.theFilter = Filter()
+        params.theFilter.limit = rint(page_size)
+        scope = compile_scope(type, id, params)
+        results = q.projection(
+            "SELECT i.id FROM Image i WHERE " + (scope + " AND " if scope != "" else "") + "i.id > :last ORDER BY i.id",
+            params,
+            conn.SERVICE_OPTS
+            )
+        img_ids = [r[0].val for r in results]
+        if len(img_ids) > 0:
+            yield img_ids
+        if len(img_ids) < page_size:
+            return
+        last_id = img_ids[-1]
+
+def compile_kv_query(key_value_list: list, type = "", id = 0) -> tuple:
+    """Compile Key:Value conditions and an optional scope into a single HQL query.
+
+    Parameters
+    ----------
+    key_value_list: list of conditions
+        The conditions that all images must match. A condition is either a [Key, Value] pair, where a Value ending with "*"
+        matches all the values starting with it, or a list starting with an operator: ["NOT", condition],
+        ["AND", condition, ...] or ["OR", condition, ...].
+        For example: [["Year", "2020"], ["OR", ["Disease", "Big"], ["Disease", "Med*"]], ["NOT", ["Lighting", "Low"]]].
+    type: str
+        The type of the object, e. g. Image, Dataset or Project.
+    id: int or list of ints
+        The ID(s) of the object(s).
+    
+    Returns
+    -------
+    query: str
+        The HQL query, returning image IDs.
+    params: omero.sys.Parameters
+        The parameters of the query.
+    """
+
+    params = Parameters()
+    params.map = {}
+
+    def compile_condition(condition) -> str:
+        if condition[0] in ("AND", "OR", "NOT") and all(isinstance(c, (list, tuple)) for c in condition[1:]):
+            clauses = [compile_condition(c) for c in condition[1:]]
+            if condition[0] == "NOT":
+                return "NOT (" + " AND ".join(clauses) + ")"
+            return "(" + (" " + condition[0] + " ").join(clauses) + ")"
+        key, value = condition
+        n = len(params.map) // 2
+        params.map["k{n}".format(n = n)] = rstring(key)
+        if value.endswith("*"): # The rest of the value is literal, its wildcards being escaped
+            prefix = value[:-1].replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.map["v{n}".format(n = n)] = rstring(prefix + "%")
+            operator = "like"
+        else:
+            params.map["v{n}".format(n = n)] = rstring(value)
+            operator = "="
+        return ("exists (SELECT al.id FROM ImageAnnotationLink al"
+                " JOIN al.child ann"
+                " JOIN ann.mapValue as nv"
+                " WHERE al.parent.id = i.id"
+                " AND nv.name = :k{n}"
+                " AND nv.value {operator} :v{n}{escape})").format(n = n, operator = operator, escape = " escape '\\'" if operator == "like" else "")
+
+    clauses = [compile_condition(condition) for condition in key_value_list]
+
+    scope = compile_scope(type, id, params)
+    if scope != "":
+        clauses.append(scope)
+
+    query = "SELECT i.id FROM Image i"
+    if len(clauses) > 0:
+        query += " WHERE " + " AND ".join(clauses)
+    return query, params
+
+def filter_by_kv(conn: BlitzGateway, key_value_list: list, type = "", id = 0) -> list:
+    """Filter a given set of images (from dataset or project) with given key:value pair(s).
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    key_value: list of list(s) of two str
+        The Key:Value pair(s) to add as a list of [Key, Value]. For example: [["Year", "2020"], ["Species", "Arabidopsis thaliana"]].
+        AND/OR/NOT and prefix conditions are also accepted, see compile_kv_query.
+    type: str
+        The type of the object, e. g. Image, Dataset or Project.
+    id: int or list of ints
+        The ID(s) of the object(s).
     
     Returns
     -------
     img_ids: list of ints
         The result IDs from the query.
+    
+    Note
+    ----
+    type and id arguments are optional but if you add one you need to add the other.
+    The whole filter is sent as one query, so there is a single round trip whatever the number of pairs.
+    """
+
+    query, params = compile_kv_query(key_value_list, type, id)
+    results = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+    img_ids = [r[0].val for r in results]
+    return img_ids
+
+def cache_key(image_id: int, pixels_event: int, thr_values: list, output: str, format: str, pipeline: list = None, name: str = "", copy_kv: bool = False,
+              tile_size: int = 0) -> str:
+    """The key of a result in the cache: a hash of everything that changes it.
+
+    Parameters
+    ----------
+    image_id: int
+        The ID of the original image.
+    pixels_event: int
+        The last update event of its pixels.
+    thr_values: list of tuples of two ints
+        RGB threshold values.
+    output: str
+        The output mode, a key of MASK_OUTPUTS.
+    format: str
+        The format of the processed images.
+    pipeline: list of tuples
+        The kernels computing the mask instead of the RGB threshold, if any.
+    name: str
+        The template of the result names ("[f]" being replaced by the file name).
+    copy_kv: bool
+        Whether the Key:Value pairs are copied to the processed images.
+    tile_size: int
+        The tile size of the processed images, 0 if they are not tiled.
+    
+    Returns
+    -------
+    key: str
+        The SHA-1 of these values and of SCRIPT_VERSION, in hexadecimal.
+    """
+
+    images = output == "Images" # The other outputs have no format, Key:Value pairs or tiles
+    values = [image_id, pixels_event, [list(t) for t in thr_values], output, format if images else "", name, copy_kv == True and images,
+              tile_size if images else 0, SCRIPT_VERSION]
+    if pipeline is not None:
+        values.append(pipeline)
+    return hashlib.sha1(json.dumps(values).encode()).hexdigest()
+
+def cache_lookup(conn: BlitzGateway, img_id_list: list, thr_values: list, output: str, format: str, pipeline: list = None, name: str = "",
+                 copy_kv: bool = False, tile_size: int = 0, page_size: int = 1000) -> tuple:
+    """Find the images whose result is already in the cache.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    img_id_list: list of ints
+        The IDs of the images to process.
+    thr_values: list of tuples of two ints
+        RGB threshold values.
+    output: str
+        The output mode, a key of MASK_OUTPUTS.
+    format: str
+        The format of the processed images.
+    pipeline: list of tuples
+        The kernels computing the mask instead of the RGB threshold, if any.
+    name, copy_kv, tile_size:
+        The other parameters changing the results, see cache_key.
+    page_size: int
+        The maximum number of IDs per query.
+    
+    Returns
+    -------
+    keys: dict
+        The cache key of each image, by image ID.
+    hits: dict
+        The ID of the result of each image found in the cache (None for an empty mask ROI), by image ID.
+    annotations: dict
+        The ID of the cache annotation of each image which has one, by image ID, to update it (see cache_save).
+    
+    Note
+    ----
+    Three queries per page of images: the update events of their pixels, their cache entries and the results that still
+    exist. A result deleted since it was cached is a miss.
     """
 
     q = conn.getQueryService()
-    params = Parameters()
-    params.map = {"key": rstring(key),
-                  "value": rstring(value)}
-    results = q.projection(
-        "SELECT i.id FROM Image i"
-        " JOIN i.annotationLinks al"
-        " JOIN al.child ann"
-        " JOIN ann.mapValue as nv"
-        " WHERE nv.name = :key"
-        " AND nv.value = :value",
-        params,
-        conn.SERVICE_OPTS
+    keys = {}
+    hits = {}
+    annotations = {}
+    for i in range(0, len(img_id_list), page_size):
+        params = Parameters()
+        params.map = {"ids": rlist([rlong(img) for img in img_id_list[i:i + page_size]])}
+        results = q.projection("SELECT p.image.id, p.details.updateEvent.id FROM Pixels p WHERE p.image.id in (:ids)", params, conn.SERVICE_OPTS)
+        for r in results:
+            keys[r[0].val] = cache_key(r[0].val, r[1].val, thr_values, output, format, pipeline, name, copy_kv, tile_size)
+
+        params.map["ns"] = rstring(CACHE_NS)
+        results = q.projection(
+            "SELECT i.id, ann.id, nv.name, nv.value FROM Image i JOIN i.annotationLinks al JOIN al.child ann JOIN ann.mapValue as nv"
+            " WHERE ann.ns = :ns AND i.id in (:ids)",
+            params,
+            conn.SERVICE_OPTS
+            )
+        for r in results:
+            annotations[r[0].val] = max(annotations.get(r[0].val, 0), r[1].val)
+        page_hits = {r[0].val: r[3].val for r in results if keys.get(r[0].val) == r[2].val}
+
+        result_ids = [rlong(int(value)) for value in page_hits.values() if value != ""]
+        existing = set()
+        if len(result_ids) > 0:
+            params = Parameters()
+            params.map = {"ids": rlist(result_ids)}
+            results = q.projection("SELECT o.id FROM {type} o WHERE o.id in (:ids)".format(type = RESULT_TYPES[output]), params, conn.SERVICE_OPTS)
+            existing = set(r[0].val for r in results)
+        for img, value in page_hits.items():
+            if value == "":
+                hits[img] = None
+            elif int(value) in existing:
+                hits[img] = int(value)
+    return keys, hits, annotations
+
+def cache_save(conn: BlitzGateway, entries: list, annotations: dict = None, page_size: int = 1000):
+    """Add results to the cache, as one map annotation per original image, updated in place by the next runs.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    entries: list of tuples
+        The (image ID, cache key, result ID) of each new result, the result ID being None for an empty mask ROI.
+    annotations: dict
+        The ID of the cache annotation of the images which already have one, by image ID (see cache_lookup).
+    page_size: int
+        The maximum number of annotations saved per call.
+    """
+
+    annotations = annotations or {}
+    values = {img: [omero.model.NamedValue(key, "" if result_id is None else str(result_id))] for img, key, result_id in entries}
+    objects = []
+    updated = [annotations[img] for img in values if img in annotations]
+    for i in range(0, len(updated), page_size):
+        params = Parameters()
+        params.map = {"ids": rlist([rlong(ann) for ann in updated[i:i + page_size]])}
+        by_id = {map_ann.getId().getValue(): map_ann for map_ann in
+                 conn.getQueryService().findAllByQuery("SELECT a FROM MapAnnotation a WHERE a.id in (:ids)", params, conn.SERVICE_OPTS)}
+        for img in values:
+            if annotations.get(img) in by_id:
+                by_id[annotations[img]].setMapValue(values[img])
+        objects += list(by_id.values())
+    for img in values:
+        if img not in annotations:
+            map_ann = omero.model.MapAnnotationI()
+            map_ann.setNs(rstring(CACHE_NS))
+            map_ann.setMapValue(values[img])
+            link = omero.model.ImageAnnotationLinkI()
+            link.setParent(omero.model.ImageI(img, False))
+            link.setChild(map_ann)
+            objects.append(link)
+    for i in range(0, len(objects), page_size):
+        conn.getUpdateService().saveArray(objects[i:i + page_size], conn.SERVICE_OPTS)
+
+def relink_images(conn: BlitzGateway, image_ids: list, parent_dataset, page_size: int = 1000):
+    """Link images to a dataset, unless they are already in it.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection.
+    image_ids: list of ints
+        The IDs of the images.
+    parent_dataset: omero.gateway._DatasetWrapper
+        The dataset.
+    page_size: int
+        The maximum number of IDs per query.
+    """
+
+    for i in range(0, len(image_ids), page_size):
+        params = Parameters()
+        params.map = {"images": rlist([rlong(img) for img in image_ids[i:i + page_size]])}
+        scope = compile_scope("Dataset", unwrap(parent_dataset.getId()), params)
+        results = conn.getQueryService().projection("SELECT i.id FROM Image i WHERE i.id in (:images) AND " + scope, params, conn.SERVICE_OPTS)
+        linked = set(r[0].val for r in results)
+        links = []
+        for img in image_ids[i:i + page_size]:
+            if img not in linked:
+                link = omero.model.DatasetImageLinkI()
+                link.setParent(omero.model.DatasetI(parent_dataset.getId(), False))
+                link.setChild(omero.model.ImageI(img, False))
+                links.append(link)
+        if len(links) > 0:
+            conn.getUpdateService().saveArray(links, conn.SERVICE_OPTS)
+
+
+# SCRIPT
+def run_script():
+    """Define the script parameters, then process the images."""
+
+    start_time = time()
+
+    # DEFINE THE SCRIPT PARAMTERS
+    client = scripts.client(
+        "Threshold2.py",
+        """Threshold RGB images on a query.""",
+        scripts.Bool("Process on a given object", optional = False, grouping = "01", default = True),
+        scripts.String("Object type", optional = False, grouping = "01.1", default = "Image", values = [rstring("Image"), rstring("Dataset"), rstring("Project")]),
+        scripts.Long("Object ID", optional = False, grouping = "01.1"),
+        scripts.Bool("Process on a query", optional = False, grouping = "02", default = True),
+        scripts.Map("Key:Value pair(s)", optional = True, grouping = "02.1"),
+        scripts.Bool("RGB channel threshold values", optional = True, grouping = "03", default = True), # A simple text should be better but it doesn't seem to be possible...
+        scripts.Int("Red min", optional = False, grouping = "03.1", default = 103, min = 0, max = 255),
+        scripts.Int("Red max", optional = False, grouping = "03.2", default = 255, min = 0, max = 255),
+        scripts.Int("Green min", optional = False, grouping = "03.3", default = 115, min = 0, max = 255),
+        scripts.Int("Green max", optional = False, grouping = "03.4", default = 255, min = 0, max = 255),
+        scripts.Int("Blue min", optional = False, grouping = "03.5", default = 60, min = 0, max = 255),
+        scripts.Int("Blue max", optional = False, grouping = "03.6", default = 255, min = 0, max = 255),
+        scripts.String("Kernels", optional = False, grouping = "03.7", default = "threshold"), # e. g. "threshold; open(iterations = 2)", see KERNELS
+        scripts.Bool("Thresholded images", optional = True, grouping = "04", default = True), # Once again, just a string would be nice.
+        scripts.String('Image names ("[f]" will add the file name)', optional = False, grouping = "04.1", default = "[f]_thresholded"),
+        scripts.String("Format", optional = False, grouping = "04.2", values = [rstring("jpeg"), rstring("png"), rstring("tif")], default = "png"),
+        scripts.String("Output", optional = False, grouping = "04.3", values = [rstring(output) for output in list(MASK_OUTPUTS) + ["Measurements"]], default = "Images"), # ROIs and RLE annotations are saved on the original images, measurements in one table
+        scripts.Bool("Output in another dataset", optional = False, grouping = "05", default = True),
+        scripts.String("Dataset ID for an existing dataset OR Dataset name to create a new dataset", optional = True, grouping = "05.1"),
+        scripts.Bool("Copy past Key:Value pair(s)", optional = True, grouping = "06", default = True),
+        scripts.Bool("Tiled processing (for images too large for memory)", optional = False, grouping = "07", default = False),
+        scripts.Int("Tile size", optional = False, grouping = "07.1", default = 1024, min = 16),
+        scripts.Int("Parallel workers", optional = False, grouping = "08", default = 1, min = 1, max = 32),
+        scripts.Bool("Pipelined reading, thresholding and writing", optional = False, grouping = "08.1", default = True), # With one worker and without tiles
+        scripts.Int("Kernel processes", optional = False, grouping = "08.2", default = 1, min = 1, max = 32), # Processes sharing the (z, t) of each image
+        scripts.Bool("Metrics", optional = False, grouping = "09", default = False),
+        scripts.Bool("Threshold sweep", optional = False, grouping = "10", default = False), # Instead of the RGB channel threshold values
+        scripts.String("Threshold sets", optional = False, grouping = "10.1", default = "90-255|103-255|120-255, 100-255|115-255, 60-255"), # "Rmin-Rmax, Gmin-Gmax, Bmin-Bmax" separated by ";", "|" for a grid
+        scripts.String("Sweep output", optional = False, grouping = "10.2", values = [rstring("Statistics"), rstring("Images")], default = "Statistics"),
+        scripts.Bool("Skip images already processed", optional = False, grouping = "11", default = False), # Same pixels and parameters, see cache_lookup (not with the threshold sweep)
+        scripts.Bool("Preview", optional = False, grouping = "12", default = False), # Coverage and contact sheet at low resolution, nothing else is saved
+        scripts.Int("Preview size", optional = False, grouping = "12.1", default = 256, min = 16, max = 4096),
+        scripts.Bool("Local pixel cache", optional = False, grouping = "13", default = False), # Planes kept on the disk of the processor for the next runs, not for the tiles
+        scripts.String("Pixel cache folder", optional = False, grouping = "13.1", default = os.path.join(tempfile.gettempdir(), "omero_pixel_cache")),
+        scripts.Int("Pixel cache size (MB)", optional = False, grouping = "13.2", default = 10240, min = 1),
+        version = SCRIPT_VERSION,
+        authors = ["Aurélien VALENTIN for the ImHorPhen research team (Angers, France)"]
         )
-    img_id_matches = [r[0].val for r in results]
-    img_ids = list(set(img_ids) & set(img_id_matches))
-    return img_ids
 
+    # Get the parameters
+    inputs = client.getInputs(unwrap=True)
+    thr_values = [(inputs["Red min"], inputs["Red max"]), (inputs["Green min"], inputs["Green max"]), (inputs["Blue min"], inputs["Blue max"])]
+    tile_size = inputs["Tile size"] if inputs["Tiled processing (for images too large for memory)"] == True else 0
+    output = inputs["Output"]
+    pipeline = None if inputs["Kernels"].strip() == "threshold" else parse_kernels(inputs["Kernels"], thr_values)
+    processes = inputs["Kernel processes"]
+    measure = output == "Measurements" # Statistics of the masks only, nothing is uploaded per image
+    pixel_cache = PixelCache(inputs["Pixel cache folder"], inputs["Pixel cache size (MB)"] * 2**20) if inputs["Local pixel cache"] == True else None
+
+    # Connection
+    METRICS.enabled = inputs["Metrics"]
+    conn = METRICS.instrument(BlitzGateway(client_obj = client))
 
-# CHECKING OPTIONAL PARAMETERS
-# Adapting to the object
-object_type = inputs["Object type"]
-object_id = inputs["Object ID"]
-img_id_list = []
-if  object_type == "Image":
-    img_id_list.append(object_id)
-elif object_type == "Project":
-    project = conn.getObject("Project", object_id)
-    for dataset in project.listChildren():
-        for image in dataset.listChildren():
-            img_id_list.append(image.getId())
-else: # Dataset
-    dataset = conn.getObject("Dataset", object_id)
-    for image in dataset.listChildren():
-        img_id_list.append(image.getId())
-
-# Query
-if inputs["Process on a query"] == True:
     try:
-        key_value = inputs["Key:Value pair(s)"]
-        for key in key_value.keys():
-            img_id_list = filter_by_kv(conn, img_id_list, key, key_value[key])
-    except: pass
-
-# Output dataset
-if inputs["Output in another dataset"] == True:
-    dataset = inputs["Dataset ID for an existing dataset OR Dataset name to create a new dataset"]
-    if dataset.isdigit():
-        parent_dataset = conn.getObject("Dataset", int(dataset))
-    else:
-        # Create dataset
-        parent_dataset = omero.model.DatasetI()
-        parent_dataset.setName(rstring(dataset))
-        parent_dataset = conn.getUpdateService().saveAndReturnObject(parent_dataset)
+        # CHECKING OPTIONAL PARAMETERS
+        # Adapting to the object and to the query
+        object_type = inputs["Object type"]
+        object_id = inputs["Object ID"]
+        key_value = inputs.get("Key:Value pair(s)")
+        if inputs["Process on a query"] == True and key_value:
+            img_id_list = filter_by_kv(conn, [[key, key_value[key]] for key in key_value.keys()], object_type, object_id)
+        else:
+            # All the IDs are kept on purpose (a few dozen bytes each, unlike the images): the progress total, the first image of the
+            # output dataset and of the contact sheet, and the "Images processed" output (one line per image) need them
+            img_id_list = []
+            for page in expand_to_image_ids(conn, object_type, object_id):
+                img_id_list += page
+
+        # Preview: the RGB threshold values applied to a low resolution version of each image
+        if inputs["Preview"] == True:
+            previews = {}
+            preview_lock = Lock()
+
+            def preview(conn, img):
+                result = preview_image(conn, img, thr_values, inputs["Preview size"], pipeline = pipeline)
+                with preview_lock:
+                    previews[img] = result
+
+            results, errors = process_images(client, conn, preview, img_id_list, inputs["Parallel workers"])
+            img_ids = [img for img in img_id_list if img in previews]
+            if len(img_ids) > 0:
+                if object_type == "Dataset":
+                    sheet_dataset = object_id
+                else:
+                    sheet_dataset = conn.getObject("Image", img_ids[0]).getParent()
+                    sheet_dataset = sheet_dataset.getId() if sheet_dataset is not None else None
+                sheet = write_contact_sheet(conn, [previews[img][2] for img in img_ids[:PREVIEW_SHEET_SIZE]], "Threshold preview " + threshold_label(thr_values), sheet_dataset)
+                client.setOutput("Image", robject(sheet._obj))
+                client.setOutput("Preview", rstring("\n".join("{img} {name}: {c:.2%}".format(img = img, name = previews[img][0], c = previews[img][1]) for img in img_ids)))
+            message = "Previewed {img_number} images in {time} seconds ({sheet_number} on the contact sheet).".format(
+                img_number = len(img_ids), time = round(time() - start_time, 2), sheet_number = min(len(img_ids), PREVIEW_SHEET_SIZE))
+            if len(errors) > 0:
+                message += " {err_number} failed.".format(err_number = len(errors))
+                client.setOutput("Failed images", rstring("\n".join("{img}: {err}".format(img = img, err = err) for img, err in errors.items())))
+            client.setOutput("Message", rstring(message))
+            if METRICS.enabled:
+                client.setOutput("Metrics", rstring(METRICS.summary()))
+            return
+
+        # Output dataset
+        def new_dataset(name):
+            # Create dataset
+            dataset = omero.model.DatasetI()
+            dataset.setName(rstring(name))
+            dataset = conn.getUpdateService().saveAndReturnObject(dataset)
+
+            # Link dataset to project
+            link = omero.model.ProjectDatasetLinkI()
+            link.setParent(omero.model.ProjectI(conn.getObject("Image", img_id_list[0]).getParent().getParent().getId(), False)) # Assuming that all images are from the same project.
+            link.setChild(dataset)
+            conn.getUpdateService().saveObject(link)
+            return dataset
+
+        dataset = inputs.get("Dataset ID for an existing dataset OR Dataset name to create a new dataset") or ""
+        sweep = inputs["Threshold sweep"] == True
+        if sweep:
+            thr_sets = parse_threshold_sets(inputs["Threshold sets"])
+            sweep_images = inputs["Sweep output"] == "Images" and not measure
+            sweep_datasets = [new_dataset("{name} {label}".format(name = dataset if dataset != "" and not dataset.isdigit() else "Threshold sweep", label = threshold_label(t)))
+                              for t in thr_sets] if sweep_images and output == "Images" else []
+            sweep_rows = {}
+            sweep_lock = Lock()
+        elif inputs["Output in another dataset"] == True and output == "Images":
+            if dataset.isdigit():
+                parent_dataset = conn.getObject("Dataset", int(dataset))
+            else:
+                parent_dataset = new_dataset(dataset)
+
+        # Result cache: the images already processed with the same pixels and parameters are skipped, their results
+        # being linked to the output dataset
+        cache = inputs["Skip images already processed"] == True and not sweep and not measure
+        measure_rows = {}
+        measure_lock = Lock()
+        cache_entries = []
+        cache_lock = Lock()
+        skipped = 0
+        if cache:
+            cache_keys, hits, cache_annotations = cache_lookup(conn, img_id_list, thr_values, output, inputs["Format"], pipeline,
+                                                               inputs['Image names ("[f]" will add the file name)'], inputs["Copy past Key:Value pair(s)"], tile_size)
+            if output == "Images" and inputs["Output in another dataset"] == True:
+                relink_images(conn, sorted(hits.values()), parent_dataset)
+            img_id_list = [img for img in img_id_list if img not in hits]
+            skipped = len(hits)
+
+        def cache_add(img, result_id):
+            if cache and img in cache_keys:
+                with cache_lock:
+                    cache_entries.append((img, cache_keys[img], result_id))
+
+
+        # PROCESSING IMAGES
+        def output_of(image):
+            if output != "Images":
+                return inputs['Image names ("[f]" will add the file name)'].replace("[f]", image.getName()[:image.getName().rfind(".")]), None
+            dataset = parent_dataset if inputs["Output in another dataset"] == True and not sweep else image.getParent()
+            return inputs['Image names ("[f]" will add the file name)'].replace("[f]", image.getName()[:image.getName().rfind(".")]) + "." + inputs["Format"], dataset
+
+        def process(conn, img):
+            image = conn.getObject("Image", img)
+            image_name, dataset = output_of(image)
+            result_id = process_image(conn, img, image_name, dataset, thr_values, inputs["Copy past Key:Value pair(s)"], tile_size, output, pipeline, processes, pixel_cache)
+            cache_add(img, result_id)
+            return result_id
+
+        def read(conn, img):
+            image = conn.getObject("Image", img)
+            state = read_image(image, inputs["Copy past Key:Value pair(s)"] == True and output == "Images" and (not sweep or sweep_images), pixel_cache)
+            state["name"], state["dataset"] = output_of(image)
+            return state
+
+        def compute(state):
+            if sweep:
+                return sweep_image(state, thr_sets)
+            return threshold_image(state, thr_values, pipeline, processes, measure)
+
+        def write(conn, state):
+            if measure and not sweep:
+                with measure_lock:
+                    measure_rows[state["image"].getId()] = (state["image"].getName(), state["channels"], state["stats"])
+                BUFFERS.give(state["mask"])
+                state["mask"] = None
+                return
+            if not sweep:
+                result_id = MASK_OUTPUTS[output](conn, state, state["name"], state["dataset"])
+                cache_add(state["image"].getId(), result_id)
+                return result_id
+            with sweep_lock:
+                sweep_rows[state["image"].getId()] = (state["image"].getName(), state["counts"] / state["pixels"])
+            if output == "Images":
+                for s, sweep_dataset in enumerate(sweep_datasets):
+                    write_image(conn, dict(state, mask = sweep_mask(state, s)), state["name"], sweep_dataset)
+            elif sweep_images:
+                for s, t in enumerate(thr_sets):
+                    MASK_OUTPUTS[output](conn, dict(state, mask = sweep_mask(state, s)), "{name} {label}".format(name = state["name"], label = threshold_label(t)), None)
+
+        if inputs["Pipelined reading, thresholding and writing"] == True and inputs["Parallel workers"] == 1 and (tile_size == 0 or sweep or output != "Images"):
+            results, errors = pipeline_images(client, conn, read, compute, write, img_id_list)
+        elif sweep or measure: # The sweep and the measurements read whole planes, even with tiled processing
+            results, errors = process_images(client, conn, lambda conn, img: write(conn, compute(read(conn, img))), img_id_list, inputs["Parallel workers"])
+        else:
+            results, errors = process_images(client, conn, process, img_id_list, inputs["Parallel workers"])
+        if cache:
+            cache_save(conn, cache_entries, cache_annotations)
 
-        # Link dataset to project
-        link = omero.model.ProjectDatasetLinkI()
-        link.setParent(omero.model.ProjectI(conn.getObject("Image", img_id_list[0]).getParent().getParent().getId(), False)) # Assuming that all images are from the same project.
-        link.setChild(parent_dataset)
-        conn.getUpdateService().saveObject(link)
+        # Measurements, as one table on the processed dataset or project (the dataset of the first image otherwise)
+        if measure and not sweep and len(measure_rows) > 0:
+            target_type, target_id = output_container(conn, object_type, object_id, min(measure_rows))
+            file_ann = write_measurements(conn, measure_rows, target_type, target_id, "Threshold_measurements_{label}.h5".format(label = threshold_label(thr_values)))
+            client.setOutput("File_Annotation", robject(file_ann))
+            fractions = [stats["fraction"] for name, channels, stats in measure_rows.values()]
+            client.setOutput("Measurements", rstring("{n} images: {mean:.2%} of the pixels kept on average (min {min:.2%}, max {max:.2%})".format(
+                n = len(fractions), mean = np.mean(fractions), min = np.min(fractions), max = np.max(fractions))))
 
+        # Sweep statistics, as a CSV file with the fraction of pixels kept by each set in each image, on the processed
+        # dataset or project
+        if sweep and len(sweep_rows) > 0:
+            with tempfile.TemporaryDirectory() as folder:
+                csv_path = os.path.join(folder, "Threshold_sweep.csv")
+                with open(csv_path, "w", newline = "") as f:
+                    writer = csv.writer(f)
+                    writer.writerow(["Image ID", "Image name"] + [threshold_label(t) for t in thr_sets])
+                    for img, (name, coverage) in sorted(sweep_rows.items()):
+                        writer.writerow([img, name] + ["{:.6f}".format(c) for c in coverage])
+                file_ann = conn.createFileAnnfromLocalFile(csv_path, mimetype = "text/csv", ns = "ImHorPhen/threshold_sweep")
+            target_type, target_id = output_container(conn, object_type, object_id, min(sweep_rows))
+            if target_type is not None:
+                link_annotation(conn, target_type, target_id, omero.model.FileAnnotationI(file_ann.getId(), False))
+            client.setOutput("File_Annotation", robject(file_ann._obj))
+            mean_coverage = np.mean([coverage for name, coverage in sweep_rows.values()], axis = 0)
+            client.setOutput("Sweep", rstring("\n".join("{label}: {c:.2%} of the pixels kept on average".format(label = threshold_label(t), c = c) for t, c in zip(thr_sets, mean_coverage))))
 
-# PROCESSING IMAGES ONE BY ONE
-for img in img_id_list:
-    image = conn.getObject("Image", img)
-    if inputs["Output in another dataset"] == False:
-        parent_dataset = image.getParent()
-    process_image(img, inputs['Image names ("[f]" will add the file name)'].replace("[f]", image.getName()[:image.getName().rfind(".")]) + "." + inputs["Format"], parent_dataset)
+        # ENDING
+        message = "Processed {img_number} images in {time} seconds.".format(img_number = len(img_id_list) - len(errors), time = round(time() - start_time, 2))
+        if len(errors) > 0:
+            message += " {err_number} failed.".format(err_number = len(errors))
+            client.setOutput("Failed images", rstring("\n".join("{img}: {err}".format(img = img, err = err) for img, err in errors.items())))
+        if skipped > 0:
+            message += " {skip_number} already processed were skipped.".format(skip_number = skipped)
+        client.setOutput("Images processed", rstring(report_results(results, errors, None if sweep or measure else RESULT_TYPES[output], hits if cache else None)))
+        if pixel_cache is not None:
+            message += " Pixel cache: {hits} hits, {misses} misses.".format(hits = pixel_cache.hits, misses = pixel_cache.misses)
+        client.setOutput("Message", rstring(message))
+        if METRICS.enabled:
+            client.setOutput("Metrics", rstring(METRICS.summary()))
+    finally:
+        for pool in KERNEL_POOLS.values():
+            pool.shutdown()
+        KERNEL_POOLS.clear()
+        client.closeSession()
 
 
-# ENDING
-client.setOutput("Message", rstring("Processed {img_number} images in {time} seconds.".format(img_number =  len(img_id_list), time = round(time() - start_time, 2))))
-client.closeSession()
+if __name__ == "__main__":
+    run_script()
 
 
 # LINKS
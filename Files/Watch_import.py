@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Continuous import of the images arriving in the sample tree
+
+This script keeps running and imports each new image a few seconds after it is written, instead of crawling the year
+folders again with 2_Image_import.py. Images are written in <root>/<dataset name>/ and their metadata in <root>/<dataset
+name>.csv, as in the example dataset (see 3_Metadata_import.py for the format of the .csv files).
+
+- The tree is watched with inotify on Linux, or by polling only the folders whose modification time changed.
+- A file is imported once its size and modification time have not changed for a few seconds, so files still being copied
+  are left alone.
+- Ready files are grouped into micro-batches per dataset, each batch being one call to the importer, with a bounded number
+  of importers running at the same time.
+- The Key:Value pairs of the .csv files are added as soon as the images are imported, or as soon as their rows are added to
+  the .csv files.
+- Imported and annotated files are recorded in the manifest of 2_Image_import.py, so that a restart only imports the files
+  written in the meantime.
+
+Usage:
+    python Watch_import.py /path/to/sample --batch-size 50 --max-delay 5 --workers 4
+"""
+
+
+# IMPORT
+import argparse, ctypes, ctypes.util, importlib, os, select, struct
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from Connection import cli_login, connect
+from omero.gateway import BlitzGateway
+from os.path import basename, dirname, join, realpath, relpath
+from time import sleep, time
+
+image_import = importlib.import_module("2_Image_import")
+metadata_import = importlib.import_module("3_Metadata_import")
+
+
+# SETTINGS
+IGNORED_SUFFIXES = (".csv", ".sqlite", ".sqlite-journal", ".part", ".tmp", ".crdownload", "~") # Files that are not images, or not complete yet
+IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_Q_OVERFLOW, IN_ISDIR = 0x8, 0x80, 0x100, 0x4000, 0x40000000 # From <sys/inotify.h>
+
+
+# WATCHERS
+class InotifyWatcher:
+    """The files written or moved in a tree, from the inotify API of Linux (called through ctypes, no package needed).
+
+    Parameters
+    ----------
+    root: str
+        The folder watched, with all its subfolders.
+    """
+
+    def __init__(self, root: str):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno = True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify is not available")
+        self.folders = {} # Watch descriptor: folder
+        self.initial = self.add(os.path.normpath(root))
+
+    def add(self, folder: str) -> list:
+        """Watch a folder and its subfolders, and list the files they already have."""
+
+        files = []
+        for path, subfolders, names in os.walk(folder):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+            if wd >= 0:
+                self.folders[wd] = path
+            files += [join(path, name) for name in names]
+        return files
+
+    def changes(self, timeout: float) -> list:
+        """Wait up to timeout seconds for files to be written or moved in the tree, and return their paths."""
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 1 << 16)
+        files = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0"))
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW: # Events were lost: listing the whole tree again
+                root = min(self.folders.values(), key = len)
+                return [join(path, name) for path, subfolders, names in os.walk(root) for name in names]
+            if wd not in self.folders:
+                continue
+            path = join(self.folders[wd], name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    files += self.add(path) # Files may have been written before the folder was watched
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                files.append(path)
+        return files
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """The files added to a tree, found by listing again only the folders whose modification time changed.
+
+    Parameters
+    ----------
+    root: str
+        The folder watched, with all its subfolders.
+    interval: float
+        The number of seconds between two checks.
+    """
+
+    def __init__(self, root: str, interval: float = 1.0):
+        self.interval = interval
+        self.folders = {} # Folder: (modification time in ns, names)
+        self.initial = self.add(os.path.normpath(root))
+
+    def add(self, folder: str) -> list:
+        """Start following a folder and its subfolders, and list the files they already have."""
+
+        files = []
+        for path, subfolders, names in os.walk(folder):
+            self.folders[path] = (os.stat(path).st_mtime_ns, set(subfolders) | set(names))
+            files += [join(path, name) for name in names]
+        return files
+
+    def changes(self, timeout: float) -> list:
+        """Wait up to timeout seconds, then return the paths of the files added since the last call."""
+
+        sleep(min(self.interval, timeout))
+        files = []
+        for folder, (mtime, names) in list(self.folders.items()):
+            try:
+                stat = os.stat(folder)
+            except FileNotFoundError:
+                del self.folders[folder]
+                continue
+            if stat.st_mtime_ns == mtime and time() - mtime / 1e9 > 2: # The same modification time can hide a change made just after it
+                continue
+            entries = {entry.name: entry.is_dir() for entry in os.scandir(folder)}
+            self.folders[folder] = (stat.st_mtime_ns, set(entries))
+            for name, is_dir in entries.items():
+                if name not in names:
+                    files += self.add(join(folder, name)) if is_dir else [join(folder, name)]
+        return files
+
+    def close(self):
+        pass
+
+
+# FUNCTIONS
+def read_metadata(csv_path: str) -> dict:
+    """Read the Key:Value pairs of the images of a .csv file, named after its dataset.
+
+    Parameters
+    ----------
+    csv_path: str
+        The path of the .csv file: two header lines, then "image, disease, lighting" rows.
+    
+    Returns
+    -------
+    metadata: dict
+        The Key:Value pairs of each image, as a list of [Key, Value], by (dataset name, image name).
+    """
+
+    year = basename(csv_path)[:-len(".csv")]
+    metadata = {}
+    with open(csv_path) as fpi:
+        fpi.readline()
+        fpi.readline()
+        for line in fpi:
+            if line.strip() != "":
+                image, disease, lighting = line.strip().split(", ")
+                metadata[(year, image)] = [["Year", year], ["Disease", disease], ["Lighting", lighting]]
+    return metadata
+
+def ingest(conn: BlitzGateway, root: str, manifest_path: str = "", dataset_of = None, batch_size: int = 50, max_delay: float = 5.0,
+           settle: float = 2.0, workers: int = 4, polling: bool = False, checksum: bool = False, run_for: float = None, retries: int = 5):
+    """Import the images written in a tree as they arrive, with their Key:Value pairs.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway object
+        OMERO connection, whose session is also used by the importer (see cli_login).
+    root: str
+        The sample tree: one folder per dataset, and one .csv file of metadata per dataset.
+    manifest_path: str
+        The SQLite file recording the imported files (see open_manifest in 2_Image_import.py), <root>/imports.sqlite if empty.
+    dataset_of: callable
+        Called as dataset_of(folder name), returns the ID of the dataset of the images of this folder, or None to ignore
+        them until the dataset exists. By default, the dataset with the same name.
+    batch_size: int
+        The maximum number of files per call to the importer.
+    max_delay: float
+        The number of seconds after which a batch is imported even if it is not full.
+    settle: float
+        The number of seconds during which the size and the modification time of a file must not change before it is
+        imported.
+    workers: int
+        The maximum number of importers running at the same time.
+    polling: bool
+        Look for new files by polling even if inotify is available.
+    checksum: bool
+        Also compare fast checksums to detect changed files, see file_signature in 2_Image_import.py.
+    run_for: float
+        Stop after this number of seconds, once the files already found are imported. Run until interrupted if None.
+    retries: int
+        The number of times a batch is imported again when the importer fails, after max_delay seconds, then twice as
+        long each time.
+    
+    Note
+    ----
+    The tree is listed once at start, to import the files written while the script was not running. After that, only the
+    watched changes are looked at. The files missing from the manifest are first looked for in their dataset (see
+    find_imported in 2_Image_import.py), in case a run stopped while importing them.
+    """
+
+    root = os.path.normpath(root)
+    manifest = image_import.open_manifest(manifest_path or join(root, "imports.sqlite"))
+    manifest.execute("CREATE TABLE IF NOT EXISTS annotated (image_id INTEGER PRIMARY KEY)")
+    if dataset_of is None:
+        dataset_of = lambda name: image_import.get_IDs(conn, [name], "Dataset").get(name)
+    dataset_ids = {} # Folder name: dataset ID
+
+    # Metadata, and imported images still without Key:Value pairs, by (dataset name, image name)
+    metadata = {}
+    for name in os.listdir(root):
+        if name.endswith(".csv"):
+            metadata.update(read_metadata(join(root, name)))
+    unannotated = {}
+    for path, image_id in manifest.execute("SELECT path, image_id FROM imports WHERE image_id NOT IN (SELECT image_id FROM annotated)"):
+        unannotated[(relpath(path, realpath(root)).split(os.sep)[0], basename(path))] = image_id
+
+    def annotate():
+        keys = [key for key in unannotated if key in metadata]
+        if len(keys) > 0:
+            saved, failed_ids = metadata_import.add_key_value_pairs(conn, [(metadata[key], unannotated[key]) for key in keys], "Image")
+            done = [unannotated.pop(key) for key in keys if unannotated[key] not in failed_ids]
+            with manifest:
+                manifest.executemany("INSERT OR IGNORE INTO annotated VALUES (?)", [(image_id,) for image_id in done])
+
+    watcher = None
+    if not polling:
+        try:
+            watcher = InotifyWatcher(root)
+        except (OSError, AttributeError):
+            print("inotify is not available, polling instead")
+    if watcher is None:
+        watcher = PollingWatcher(root)
+    pending = {} # Path: (signature, time since which it has not changed)
+    batches = {} # Dataset ID: [(path, signature)] of the files ready to import
+    batch_times = {} # Dataset ID: time since which its batch has been waiting
+    running = {} # Future of a call to the importer: (dataset ID, [(path, signature)], attempt)
+    failed = [] # (time of the next attempt, dataset ID, [(path, signature)], attempt) of the batches to import again
+    start = time()
+    changes = watcher.initial
+    annotate()
+    try:
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            stopping = False
+            while not stopping or len(pending) + len(batches) + len(running) + len(failed) > 0:
+                now = time()
+                stopping = run_for is not None and now - start >= run_for # Then only the files already found are imported
+
+                # New files, and new metadata
+                new_metadata = False
+                for path in changes if not stopping else []:
+                    name = basename(path)
+                    if name.endswith(".csv") and dirname(path) == root:
+                        metadata.update(read_metadata(path))
+                        new_metadata = True
+                    elif not name.startswith(".") and not name.endswith(IGNORED_SUFFIXES) and dirname(path) != root:
+                        pending.setdefault(path, (None, now))
+                if new_metadata:
+                    annotate()
+
+                # Complete files
+                unknown = {} # Dataset ID: [(path, signature)] of the files missing from the manifest
+                for path, (signature, since) in list(pending.items()):
+                    try:
+                        new_signature = image_import.file_signature(path)
+                    except FileNotFoundError:
+                        del pending[path]
+                        continue
+                    if new_signature != signature:
+                        pending[path] = (new_signature, now)
+                        continue
+                    if now - since < settle:
+                        continue
+                    del pending[path]
+                    if checksum:
+                        signature = image_import.file_signature(path, True)
+                    known = manifest.execute("SELECT size, mtime, checksum FROM imports WHERE path = ?", (realpath(path),)).fetchone()
+                    if known is not None and tuple(known[:2]) == signature[:2] and (not checksum or known[2] == signature[2]):
+                        continue
+                    folder = relpath(path, root).split(os.sep)[0]
+                    if folder not in dataset_ids:
+                        dataset_id = dataset_of(folder)
+                        if dataset_id is None: # Not remembered, the dataset may be created later
+                            print("{path} ignored: no dataset for the folder {folder}".format(path = path, folder = folder))
+                            continue
+                        dataset_ids[folder] = dataset_id
+                    if known is None:
+                        unknown.setdefault(dataset_ids[folder], []).append((path, signature))
+                        continue
+                    batches.setdefault(dataset_ids[folder], []).append((path, signature))
+                    batch_times.setdefault(dataset_ids[folder], now)
+
+                # Files imported by a run which stopped before recording them are recorded, the others are batched
+                recorded = False
+                for dataset_id, files in unknown.items():
+                    found = image_import.find_imported(conn, [path for path, signature in files], dataset_id)
+                    signatures = dict(files)
+                    with manifest:
+                        manifest.executemany("INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?, ?)",
+                                             [(realpath(path), *signatures[path], image_id) for path, image_id in found.items()])
+                    for path, image_id in found.items():
+                        unannotated[(relpath(path, root).split(os.sep)[0], basename(path))] = image_id
+                        recorded = True
+                    for path, signature in files:
+                        if path not in found:
+                            batches.setdefault(dataset_id, []).append((path, signature))
+                            batch_times.setdefault(dataset_id, now)
+                if recorded:
+                    annotate()
+
+                # Failed batches, once their delay is over
+                for retry in sorted(failed, key = lambda retry: retry[0]):
+                    if len(running) < workers and now >= retry[0]:
+                        failed.remove(retry)
+                        time_next, dataset_id, batch, attempt = retry
+                        running[executor.submit(image_import.import_batch, [path for path, signature in batch], dataset_id)] = (dataset_id, batch, attempt)
+
+                # Micro-batches, full or waiting for too long (all of them when stopping)
+                for dataset_id in list(batches):
+                    while len(running) < workers and dataset_id in batches and (len(batches[dataset_id]) >= batch_size or now - batch_times[dataset_id] >= max_delay or stopping):
+                        batch = batches[dataset_id][:batch_size]
+                        running[executor.submit(image_import.import_batch, [path for path, signature in batch], dataset_id)] = (dataset_id, batch, 0)
+                        batches[dataset_id] = batches[dataset_id][batch_size:]
+                        if len(batches[dataset_id]) == 0:
+                            del batches[dataset_id], batch_times[dataset_id]
+
+                # Finished imports, recorded and annotated
+                for future in [future for future in running if future.done()]:
+                    dataset_id, batch, attempt = running.pop(future)
+                    if future.exception() is not None:
+                        if attempt < retries:
+                            delay = max_delay * 2 ** attempt
+                            failed.append((time() + delay, dataset_id, batch, attempt + 1))
+                            print("The importer failed: {error}, trying again in {delay} seconds".format(error = future.exception(), delay = delay))
+                        else: # Not recorded in the manifest, so imported again by the next run
+                            print("The importer failed: {error}, {n} files not imported".format(error = future.exception(), n = len(batch)))
+                        continue
+                    results = future.result()
+                    signatures = dict(batch)
+                    with manifest:
+                        manifest.executemany("INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?, ?)",
+                                             [(realpath(path), *signatures[path], image_id) for path, image_id in results.items()])
+                    for path, image_id in results.items():
+                        unannotated[(relpath(path, root).split(os.sep)[0], basename(path))] = image_id
+                    annotate()
+                    print("{n} images imported into the dataset {id}{failed}".format(n = len(results), id = dataset_id,
+                          failed = "" if len(results) == len(batch) else ", {n} failed".format(n = len(batch) - len(results))))
+
+                if stopping and len(running) == 0 and len(pending) == 0 and len(failed) > 0: # Only failed batches left
+                    sleep(min(0.5, max(0, min(retry[0] for retry in failed) - time())))
+                    changes = []
+                elif len(running) > 0 and len(pending) == 0:
+                    wait(running, timeout = 0.5, return_when = FIRST_COMPLETED)
+                    changes = watcher.changes(0)
+                else:
+                    changes = watcher.changes(0.5)
+    finally:
+        watcher.close()
+        manifest.close()
+
+
+# FUNCTION CALL
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Import the images written in a sample tree as they arrive, with their Key:Value pairs.")
+    parser.add_argument("root", help = "folder with one subfolder and one .csv file per dataset")
+    parser.add_argument("--manifest", default = "", help = "SQLite file of the imported files, <root>/imports.sqlite by default")
+    parser.add_argument("--batch-size", type = int, default = 50, help = "maximum number of files per call to the importer")
+    parser.add_argument("--max-delay", type = float, default = 5.0, help = "seconds after which a batch is imported even if not full")
+    parser.add_argument("--settle", type = float, default = 2.0, help = "seconds without change before a file is imported")
+    parser.add_argument("--workers", type = int, default = 4, help = "importers running at the same time")
+    parser.add_argument("--polling", action = "store_true", help = "poll the folders even if inotify is available")
+    parser.add_argument("--checksum", action = "store_true", help = "also compare fast checksums to detect changed files")
+    args = parser.parse_args()
+
+    with connect() as conn: # Connection (shared session, closed at exit)
+        cli_login(conn) # The CLI joins the session instead of logging in again
+        try:
+            ingest(conn, args.root, args.manifest, None, args.batch_size, args.max_delay, args.settle, args.workers, args.polling, args.checksum)
+        except KeyboardInterrupt:
+            pass
+
+
+# LINKS
+# inotify: https://man7.org/linux/man-pages/man7/inotify.7.html
+# In-place import: https://omero-guides.readthedocs.io/en/latest/upload/docs/import-cli.html#in-place-import-using-the-cli
@@ -0,0 +1,37 @@
+"""
+The copy of Metrics.py in Threshold_script.py (an OMERO.script is uploaded as a single file) must stay in sync with it
+
+Run with: python -m pytest tests
+"""
+
+
+# IMPORT
+import ast
+from pathlib import Path
+
+
+# SETTINGS
+FILES = Path(__file__).resolve().parent.parent / "Files"
+SHARED = ["BUCKETS", "NULL_TIMER", "payload_size", "Timer", "TracedService", "Metrics"] # Definitions copied into the script
+FILE_OUTPUTS = {"to_prometheus", "save"} # Methods of Metrics left out of the copy
+
+
+# TESTS
+def definitions(path: Path) -> dict:
+    """The top-level functions, classes and single-name assignments of a file, by name."""
+
+    nodes = {}
+    for node in ast.parse(path.read_text(encoding = "utf-8")).body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            nodes[node.name] = node
+        elif isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            nodes[node.targets[0].id] = node
+    return nodes
+
+def test_metrics_copy():
+    original = definitions(FILES / "Metrics.py")
+    copy = definitions(FILES / "Threshold_script.py")
+    original["Metrics"].body = [node for node in original["Metrics"].body if getattr(node, "name", None) not in FILE_OUTPUTS]
+    for name in SHARED:
+        assert name in copy, "{name} is missing from the copy in Threshold_script.py".format(name = name)
+        assert ast.dump(copy[name]) == ast.dump(original[name]), "{name} differs between Metrics.py and Threshold_script.py".format(name = name)
@@ -0,0 +1,24 @@
+"""
+The copies of the query functions of 4_Queries.py in Threshold_script.py (an OMERO.script is uploaded as a single file)
+must stay in sync with them
+
+Run with: python -m pytest tests
+"""
+
+
+# IMPORT
+import ast
+from test_metrics_copy import FILES, definitions
+
+
+# SETTINGS
+SHARED = ["compile_scope", "expand_to_image_ids", "compile_kv_query"] # Definitions copied into the script
+
+
+# TESTS
+def test_queries_copy():
+    original = definitions(FILES / "4_Queries.py")
+    copy = definitions(FILES / "Threshold_script.py")
+    for name in SHARED:
+        assert name in copy, "{name} is missing from the copy in Threshold_script.py".format(name = name)
+        assert ast.dump(copy[name]) == ast.dump(original[name]), "{name} differs between 4_Queries.py and Threshold_script.py".format(name = name)